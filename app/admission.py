@@ -0,0 +1,221 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# The priority classes, from the most to the least urgent. Waiting requests of a class are only admitted once no
+# request of a more urgent class is waiting
+PRIORITY_CLASSES = ("interactive", "bulk")
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be queued because the queue of its priority class is full.
+
+    Attributes:
+        retry_after (int): The number of seconds after which a retry is likely to be admitted.
+    """
+
+    def __init__(self, priority, retry_after):
+        super().__init__(f"The {priority} queue is full, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class RequestCancelled(Exception):
+    """
+    Raised when a request is given up on before its work started, because its deadline passed or its client
+    disconnected.
+
+    Attributes:
+        reason (str): "deadline" or "disconnected".
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Request cancelled: {reason}.")
+        self.reason = reason
+
+
+class CancellationToken:
+    """
+    Tells the work done for a request whether anybody is still waiting for its result.
+
+    Attributes:
+        deadline (float or None): The `time.monotonic()` time after which the result is of no use, None for no
+            deadline.
+        reason (str or None): Why the request was cancelled: "deadline", "disconnected", or None while it is not.
+    """
+
+    def __init__(self, deadline_seconds=None):
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds is not None else None
+        self.reason = None
+
+    def cancel(self, reason="disconnected"):
+        """
+        Cancel the request. The first reason given is kept.
+        """
+        if self.reason is None:
+            self.reason = reason
+
+    def is_cancelled(self):
+        """
+        Return True once the request was cancelled or its deadline passed.
+        """
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "deadline"
+        return self.reason is not None
+
+    def remaining(self):
+        """
+        Return the seconds left until the deadline, or None without a deadline.
+        """
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def check(self):
+        """
+        Raise RequestCancelled if the request was cancelled.
+        """
+        if self.is_cancelled():
+            raise RequestCancelled(self.reason)
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests running the diffusion process, with a bounded queue per priority class in
+    front of it.
+
+    Requests are admitted while fewer than `max_concurrent` are running. Beyond that they wait in the queue of
+    their priority class, which is served in order once the more urgent classes are empty, and are rejected with
+    `Overloaded` when that queue is full. Waiting requests that get cancelled leave the queue right away.
+
+    Attributes:
+        max_concurrent (int): The number of requests running at once.
+        max_queued (dict): The queue size of each priority class, None for an unbounded queue.
+        poll_seconds (float): How often waiting requests check their cancellation token.
+    """
+
+    def __init__(self, max_concurrent=8, max_queued=None, poll_seconds=0.25):
+        self.max_concurrent = max_concurrent
+        self.max_queued = {priority: 16 for priority in PRIORITY_CLASSES}
+        self.max_queued.update(max_queued or {})
+        self.poll_seconds = poll_seconds
+        self._running = 0
+        self._waiting = {priority: [] for priority in PRIORITY_CLASSES}
+        self._condition = threading.Condition()
+        self._mean_hold_seconds = None
+        self._counters = {"admitted": {priority: 0 for priority in PRIORITY_CLASSES},
+                          "rejected": {priority: 0 for priority in PRIORITY_CLASSES},
+                          "cancelled": {priority: 0 for priority in PRIORITY_CLASSES}}
+
+    @contextmanager
+    def admit(self, priority="interactive", cancellation=None):
+        """
+        Hold a running slot for the duration of the block, waiting in the queue of the priority class for it.
+
+        Args:
+            priority (str, optional): The priority class of the request, one of PRIORITY_CLASSES.
+            cancellation (CancellationToken, optional): The cancellation token of the request.
+
+        Raises:
+            Overloaded: If the queue of the priority class is full.
+            RequestCancelled: If the request is cancelled before it is admitted.
+        """
+        self._acquire(priority, cancellation)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - start)
+
+    def stats(self):
+        """
+        Report the running and waiting requests and the admission counters.
+
+        Returns:
+            dict: The running count, the queue depth per priority class and the admitted, rejected and cancelled
+                counters per priority class.
+        """
+        with self._condition:
+            return {"running": self._running,
+                    "queued": {priority: len(waiting) for priority, waiting in self._waiting.items()},
+                    **{name: dict(counts) for name, counts in self._counters.items()}}
+
+    def _acquire(self, priority, cancellation):
+        if priority not in self._waiting:
+            raise ValueError(f"Unknown priority class {priority!r}, expected one of {', '.join(PRIORITY_CLASSES)}.")
+
+        with self._condition:
+            if cancellation is not None and cancellation.is_cancelled():
+                self._counters["cancelled"][priority] += 1
+                raise RequestCancelled(cancellation.reason)
+
+            if self._running < self.max_concurrent and not any(self._waiting.values()):
+                self._running += 1
+                self._counters["admitted"][priority] += 1
+                return
+
+            waiting = self._waiting[priority]
+            max_queued = self.max_queued[priority]
+            if max_queued is not None and len(waiting) >= max_queued:
+                self._counters["rejected"][priority] += 1
+                raise Overloaded(priority, self._retry_after(priority))
+
+            ticket = object()
+            waiting.append(ticket)
+            try:
+                while not (self._running < self.max_concurrent and self._next_ticket() is ticket):
+                    if cancellation is not None and cancellation.is_cancelled():
+                        self._counters["cancelled"][priority] += 1
+                        raise RequestCancelled(cancellation.reason)
+                    timeout = self.poll_seconds
+                    if cancellation is not None and cancellation.deadline is not None:
+                        timeout = max(min(timeout, cancellation.remaining()), 0)
+                    self._condition.wait(timeout=timeout)
+            finally:
+                waiting.remove(ticket)
+                # The head of the queue changed, let the next waiter check whether it is its turn
+                self._condition.notify_all()
+
+            self._running += 1
+            self._counters["admitted"][priority] += 1
+
+    def _release(self, hold_seconds):
+        with self._condition:
+            self._running -= 1
+            # Exponential moving average of the time requests hold their slot, for the Retry-After estimates
+            if self._mean_hold_seconds is None:
+                self._mean_hold_seconds = hold_seconds
+            else:
+                self._mean_hold_seconds += 0.2 * (hold_seconds - self._mean_hold_seconds)
+            self._condition.notify_all()
+
+    def _next_ticket(self):
+        for priority in PRIORITY_CLASSES:
+            if self._waiting[priority]:
+                return self._waiting[priority][0]
+        return None
+
+    def _retry_after(self, priority):
+        # Requests of this class and the more urgent ones are admitted before a retry would be
+        ahead = self._running + sum(len(self._waiting[other])
+                                    for other in PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority) + 1])
+        mean_hold_seconds = self._mean_hold_seconds or 1.0
+        return max(1, math.ceil(mean_hold_seconds * ahead / self.max_concurrent))
+
+
+class PassThroughAdmission:
+    """
+    Admits every request right away, for work that was already admitted by another process, e.g. the tasks a
+    worker process runs for the API process.
+    """
+
+    @contextmanager
+    def admit(self, priority="interactive", cancellation=None):
+        """
+        Run the block unless the request was cancelled. Takes the arguments of `AdmissionController.admit`.
+
+        Raises:
+            RequestCancelled: If the request was cancelled.
+        """
+        if cancellation is not None:
+            cancellation.check()
+        yield
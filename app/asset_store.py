@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from PIL import Image
+
+# Asset IDs are the hexadecimal SHA-256 digest of the asset content
+ASSET_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AssetStore:
+    """
+    A content-addressed store of uploaded images, with an in-memory LRU cache of images derived from them.
+
+    An asset is stored once under the SHA-256 digest of its bytes, so uploading the same logo again returns the
+    same ID. Derivatives, e.g. the logo resized to its slot or the color filtered base image, are computed once
+    per asset and parameters and reused by every request referencing the asset.
+
+    Attributes:
+        root_dir (str): The directory holding the original assets.
+        max_derivative_bytes (int): The size budget of the cached derivatives, counted in decoded pixels.
+    """
+
+    def __init__(self, root_dir, max_derivative_bytes=128 * 1024 * 1024):
+        self.root_dir = root_dir
+        self.max_derivative_bytes = max_derivative_bytes
+        self._derivatives = OrderedDict()
+        self._derivative_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        os.makedirs(root_dir, exist_ok=True)
+
+    @staticmethod
+    def is_asset_id(reference):
+        """
+        Return True if the reference has the shape of an asset ID.
+        """
+        return isinstance(reference, str) and ASSET_ID_PATTERN.match(reference) is not None
+
+    def put(self, fileobj, chunk_size=1024 * 1024):
+        """
+        Store an image, hashing it while it is copied in chunks.
+
+        Args:
+            fileobj (file-like object): The encoded image, opened in binary mode.
+            chunk_size (int, optional): The size of the chunks read at once.
+
+        Returns:
+            dict: The metadata of the asset, see `describe`.
+        """
+        digest = hashlib.sha256()
+        temporary_path = os.path.join(self.root_dir, f"upload.{threading.get_ident()}.tmp")
+        fileobj.seek(0)
+        with open(temporary_path, "wb") as file:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+                digest.update(chunk)
+                file.write(chunk)
+        fileobj.seek(0)
+
+        asset_id = digest.hexdigest()
+        if self.exists(asset_id):
+            os.remove(temporary_path)
+            return self.describe(asset_id)
+
+        with Image.open(temporary_path) as image:
+            metadata = {"asset_id": asset_id,
+                        "format": image.format,
+                        "width": image.width,
+                        "height": image.height,
+                        "size_bytes": os.path.getsize(temporary_path)}
+
+        # The metadata is written last, so an asset only exists once both of its files are complete
+        asset_dir = self._asset_dir(asset_id)
+        os.makedirs(asset_dir, exist_ok=True)
+        os.replace(temporary_path, os.path.join(asset_dir, "original"))
+        with open(os.path.join(asset_dir, "metadata.json.tmp"), "w") as file:
+            json.dump(metadata, file)
+        os.replace(os.path.join(asset_dir, "metadata.json.tmp"), os.path.join(asset_dir, "metadata.json"))
+        return metadata
+
+    def exists(self, asset_id):
+        """
+        Return True if the asset is stored.
+        """
+        return self.is_asset_id(asset_id) and os.path.exists(os.path.join(self._asset_dir(asset_id), "metadata.json"))
+
+    def describe(self, asset_id):
+        """
+        Read the metadata of an asset.
+
+        Args:
+            asset_id (str): The asset ID.
+
+        Raises:
+            KeyError: If the asset is unknown.
+
+        Returns:
+            dict: The asset ID, image format, width, height and size in bytes of the asset.
+        """
+        if not self.exists(asset_id):
+            raise KeyError(asset_id)
+        with open(os.path.join(self._asset_dir(asset_id), "metadata.json")) as file:
+            return json.load(file)
+
+    def open(self, asset_id):
+        """
+        Open the original bytes of an asset.
+
+        Args:
+            asset_id (str): The asset ID.
+
+        Raises:
+            KeyError: If the asset is unknown.
+
+        Returns:
+            file-like object: The encoded image, opened for binary reading.
+        """
+        if not self.exists(asset_id):
+            raise KeyError(asset_id)
+        return open(os.path.join(self._asset_dir(asset_id), "original"), "rb")
+
+    def get_derivative(self, asset_id, name, compute, **params):
+        """
+        Return an image derived from an asset, computing it on a miss.
+
+        Concurrent lookups of the same missing derivative share a single computation.
+
+        Args:
+            asset_id (str): The asset ID.
+            name (str): The kind of derivative, e.g. "logo".
+            compute (callable): Called without arguments on a miss; returns the derived PIL image. It must not be
+                modified by its users, as it is shared.
+            **params: JSON serializable parameters the derivative depends on.
+
+        Returns:
+            PIL.Image.Image: The derived image.
+        """
+        key = (asset_id, name, json.dumps(params, sort_keys=True, default=str))
+        with self._lock:
+            image = self._derivatives.get(key)
+            if image is not None:
+                self._derivatives.move_to_end(key)
+                self._counters["hits"] += 1
+                return image
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            image = compute()
+            with self._lock:
+                self._put(key, image)
+            future.set_result(image)
+            return image
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self):
+        """
+        Report the counters and size of the derivative cache.
+
+        Returns:
+            dict: Hit, miss, coalesced and eviction counters, the hit ratio and the size of the cache.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+            stats["entries"] = len(self._derivatives)
+            stats["bytes"] = self._derivative_bytes
+            return stats
+
+    def _asset_dir(self, asset_id):
+        return os.path.join(self.root_dir, asset_id[:2], asset_id)
+
+    def _put(self, key, image):
+        size = image.width * image.height * len(image.getbands())
+        if size > self.max_derivative_bytes or key in self._derivatives:
+            return
+        self._derivatives[key] = image
+        self._derivative_bytes += size
+        while self._derivative_bytes > self.max_derivative_bytes:
+            _, evicted = self._derivatives.popitem(last=False)
+            self._derivative_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+            self._counters["evictions"] += 1
@@ -0,0 +1,74 @@
+"""
+Benchmark of `extract_features_and_change_their_color` against the original NumPy implementation.
+
+Run from the `app` directory:
+    python -m benchmarks.color_filter
+"""
+import argparse
+
+import numpy as np
+from PIL import Image, ImageOps
+from scipy.ndimage import binary_dilation
+
+from benchmarks.common import make_test_image, time_call, write_results
+from stable_diffusion.helpers import extract_features_and_change_their_color
+
+
+def reference_extract_features_and_change_their_color(original_image, target_color, smooth_factor=0.5,
+                                                      dilation_radius=5):
+    """
+    The original implementation, with an iterated binary dilation and a float blend, kept as the parity baseline.
+    """
+    image_array = np.array(original_image)
+    features_array = 255 - np.array(ImageOps.grayscale(original_image))
+    feature_mask = features_array > 0
+    dilated_feature_mask = binary_dilation(feature_mask, iterations=dilation_radius)
+    result_array = np.where(dilated_feature_mask[:, :, None],
+                            (smooth_factor * np.array(target_color)).astype(np.uint8) +
+                            ((1 - smooth_factor) * image_array).astype(np.uint8),
+                            image_array)
+    return Image.fromarray(result_array.astype(np.uint8))
+
+
+def check_parity(image, **kwargs):
+    """
+    Check that both implementations produce identical pixels.
+
+    Returns:
+        int: The number of differing pixel values.
+    """
+    expected = np.asarray(reference_extract_features_and_change_their_color(image, **kwargs))
+    actual = np.asarray(extract_features_and_change_their_color(image, **kwargs))
+    return int(np.count_nonzero(expected != actual))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="512x512,1024x1024,2048x1536,4032x3024")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="The JSON file the results are written to.")
+    args = parser.parse_args()
+
+    kwargs = {"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5}
+    results = []
+    for size in args.sizes.split(","):
+        width, height = (int(value) for value in size.split("x"))
+        image = make_test_image(width, height)
+
+        mismatches = check_parity(image, **kwargs)
+        reference_seconds = time_call(reference_extract_features_and_change_their_color, args.repeat, image, **kwargs)
+        seconds = time_call(extract_features_and_change_their_color, args.repeat, image, **kwargs)
+
+        results.append({"size": size,
+                        "reference_seconds": reference_seconds,
+                        "seconds": seconds,
+                        "speedup": reference_seconds / seconds,
+                        "mismatched_values": mismatches})
+
+    write_results("color_filter", results, args.output)
+    if any(result["mismatched_values"] for result in results):
+        raise SystemExit("Parity check failed.")
+
+
+if __name__ == "__main__":
+    main()
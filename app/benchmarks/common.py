@@ -0,0 +1,79 @@
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def make_test_image(width, height, seed=0):
+    """
+    Build a photo-like RGB test image with white regions, so the dilation has an effect.
+    """
+    rng = np.random.default_rng(seed)
+    image_array = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    # Blank out random rectangles to white, like the background of a product photo
+    for _ in range(8):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        image_array[y:y + height // 4, x:x + width // 4] = 255
+    return Image.fromarray(image_array)
+
+
+def time_call(fn, repeat, *args, **kwargs):
+    """
+    Return the best wall time of `repeat` calls, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def summarize_latencies(latencies):
+    """
+    Summarize request latencies.
+
+    Args:
+        latencies (list): The latencies, in seconds.
+
+    Returns:
+        dict: The count, mean, p50, p95, p99 and maximum of the latencies, in seconds.
+    """
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"count": 0}
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    return {"count": len(ordered),
+            "mean": statistics.fmean(ordered),
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": ordered[-1]}
+
+
+def write_results(name, results, output=None):
+    """
+    Print benchmark results as JSON, and write them to a file when requested, so that runs can be compared.
+
+    Args:
+        name (str): The name of the benchmark.
+        results (list): The result records.
+        output (str, optional): The path of the JSON file to write.
+    """
+    report = {"benchmark": name,
+              "timestamp": time.time(),
+              "python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
@@ -0,0 +1,95 @@
+"""
+Benchmark of CPU inference: seconds per denoising step at the diffusion resolution of a template layout, across
+weight data types, memory formats and UNet compilation. Needs the model weights, but no GPU.
+
+Run from the `app` directory:
+    python -m benchmarks.cpu_inference --dtypes float32,bfloat16 --channels-last 0,1 --steps 8
+"""
+import argparse
+import functools
+import itertools
+
+from PIL import Image
+
+from benchmarks.common import write_results
+from config import DEFAULT_LAYOUT, MODEL_ID_OR_PATH, MODEL_SNAPSHOT_DIR
+from dynamic_template.layouts import get_diffusion_target
+from stable_diffusion.backends import configure_threads, cpu_supports_bfloat16, get_cpu_quota
+from stable_diffusion.pipeline_registry import PipelineRegistry, load_img2img_pipeline
+from stable_diffusion.stable_diffusor import StableDiffusor
+
+
+def benchmark_configuration(model, dtype, channels_last, compile_unet, layout, steps, repeat):
+    """
+    Time the denoising of one image on the CPU with one configuration.
+
+    Returns:
+        dict: The configuration, the diffusion size and the best seconds per step of `repeat` runs.
+    """
+    # A registry of its own loads the weights in the data type and memory format of this configuration
+    registry = PipelineRegistry(loader=functools.partial(load_img2img_pipeline, snapshot_dir=MODEL_SNAPSHOT_DIR or None))
+    stable_diffusor = StableDiffusor(model_id_or_path=model,
+                                     device="cpu",
+                                     torch_dtype=dtype,
+                                     registry=registry,
+                                     channels_last=channels_last,
+                                     compile_unet=compile_unet)
+    target_size, max_side = get_diffusion_target([layout])
+    base_image = Image.new("RGB", target_size, "gray")
+
+    def denoise(num_steps):
+        stages = {}
+        # With full strength every inference step is run
+        stable_diffusor.generate_similar_image_by_color(base_image=base_image,
+                                                        positive_prompt="a product photo, UHD",
+                                                        negative_prompt="blurry",
+                                                        strength=1.0,
+                                                        steps=num_steps,
+                                                        seed=0,
+                                                        target_size=target_size,
+                                                        max_side=max_side,
+                                                        stage_callback=stages.__setitem__)
+        return stages["denoising"]
+
+    # The first call pays for the allocator, the kernel selection and the compilation
+    denoise(2)
+    seconds = min(denoise(steps) for _ in range(repeat))
+    size = stable_diffusor.prepare_base_image(base_image, target_size=target_size, max_side=max_side).size
+    return {"dtype": dtype,
+            "channels_last": channels_last,
+            "compile_unet": compile_unet,
+            "size": f"{size[0]}x{size[1]}",
+            "steps": steps,
+            "seconds_per_step": seconds / steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=MODEL_ID_OR_PATH)
+    parser.add_argument("--dtypes", default="float32,bfloat16")
+    parser.add_argument("--channels-last", default="0,1", help="The memory formats to compare, 1 for channels-last.")
+    parser.add_argument("--compile", default="0", help="Whether to compile the UNet, e.g. 0,1 to compare.")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT)
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--threads", type=int, help="The intra-op threads; defaults to the CPU quota.")
+    parser.add_argument("--output", help="The JSON file the results are written to.")
+    args = parser.parse_args()
+
+    intra_op_threads, inter_op_threads = configure_threads(args.threads)
+    print(f"CPU quota: {get_cpu_quota()} cores, {intra_op_threads} intra-op and {inter_op_threads} inter-op threads, "
+          f"native bfloat16: {cpu_supports_bfloat16()}")
+
+    results = []
+    for dtype, channels_last, compile_unet in itertools.product(args.dtypes.split(","),
+                                                                args.channels_last.split(","),
+                                                                args.compile.split(",")):
+        result = benchmark_configuration(args.model, dtype, channels_last == "1", compile_unet == "1", args.layout,
+                                         args.steps, args.repeat)
+        results.append({**result, "intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads})
+
+    write_results("cpu_inference", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
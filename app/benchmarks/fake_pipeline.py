@@ -0,0 +1,176 @@
+"""
+A stand-in for `StableDiffusionImg2ImgPipeline` that needs neither a GPU nor model weights.
+
+It costs time in proportion to the denoising steps and the resolution, either by sleeping or by burning CPU, so
+the service can be benchmarked end to end without the real model. Load it through the pipeline registry:
+    PipelineRegistry(loader=FakePipelineLoader(seconds_per_megapixel_step=0.02))
+"""
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from diffusers import PNDMScheduler
+from PIL import Image
+
+# The factor the latents of the Stable Diffusion 1.x VAE are scaled by
+SCALING_FACTOR = 0.18215
+
+
+class FakePipelineOutput:
+    """
+    The output of a fake pipeline call.
+
+    Attributes:
+        images (list): The generated images.
+    """
+
+    def __init__(self, images):
+        self.images = images
+
+
+class FakeImageProcessor:
+    """
+    Mimics the `preprocess` method of the image processor of the pipeline.
+    """
+
+    @staticmethod
+    def preprocess(image):
+        """
+        Convert an image, or a (1, 3, height, width) tensor in [0, 1], to a (1, 3, height, width) tensor in
+        [-1, 1], cropped to a multiple of 8.
+        """
+        if isinstance(image, torch.Tensor):
+            height, width = (side - side % 8 for side in image.shape[2:])
+            return image[:, :, :height, :width] * 2 - 1
+        pixels = np.asarray(image.convert("RGB"), dtype=np.float32) / 127.5 - 1
+        height, width = (side - side % 8 for side in pixels.shape[:2])
+        return torch.from_numpy(pixels[:height, :width].transpose(2, 0, 1).copy()).unsqueeze(0)
+
+
+class FakeVae:
+    """
+    Mimics the `encode` method of the VAE: 8x8 average pooled pixels stand in for the latents.
+
+    Attributes:
+        dtype (torch.dtype): The data type of the latents.
+        config (SimpleNamespace): The configuration holding the scaling factor of the latents.
+    """
+
+    def __init__(self):
+        self.dtype = torch.float32
+        self.config = SimpleNamespace(scaling_factor=SCALING_FACTOR)
+
+    @staticmethod
+    def encode(pixels):
+        pooled = torch.nn.functional.avg_pool2d(pixels, 8)
+        latents = torch.cat([pooled, pooled.mean(dim=1, keepdim=True)], dim=1)
+        # A distribution without spread, so that sampled latents equal the mode
+        return SimpleNamespace(latent_dist=SimpleNamespace(mode=lambda: latents, mean=latents,
+                                                           std=torch.zeros_like(latents)))
+
+    @staticmethod
+    def decode_preview(latents):
+        """
+        Turn fake latents back into an image, 8 times larger.
+        """
+        pixels = (latents[:3] / SCALING_FACTOR + 1) * 127.5
+        image = Image.fromarray(pixels.clamp(0, 255).to(torch.uint8).permute(1, 2, 0).numpy())
+        return image.resize((image.width * 8, image.height * 8))
+
+
+class FakeImg2ImgPipeline:
+    """
+    Mimics the interface of `StableDiffusionImg2ImgPipeline` used by `StableDiffusor`.
+
+    Attributes:
+        seconds_per_megapixel_step (float): The cost of one denoising step for a one megapixel image.
+        mode (str): "sleep" to wait out the cost, "burn" to spend it on CPU work.
+        encode_seconds (float): The cost of encoding one prompt.
+        device (torch.device): The device reported to callers; tensors are always created on the CPU.
+        scheduler (SchedulerMixin): The scheduler, swapped by `StableDiffusor` like on the real pipeline.
+        vae (FakeVae): Encodes images into fake latents, for the latent cache.
+        image_processor (FakeImageProcessor): Prepares images for the VAE.
+        components (dict): The torch modules of the pipeline, none for the fake one.
+        num_timesteps (int): The number of denoising steps of the last call.
+    """
+
+    def __init__(self, seconds_per_megapixel_step=0.02, mode="sleep", encode_seconds=0.005):
+        self.seconds_per_megapixel_step = seconds_per_megapixel_step
+        self.mode = mode
+        self.encode_seconds = encode_seconds
+        self.device = torch.device("cpu")
+        self.scheduler = PNDMScheduler()
+        self.vae = FakeVae()
+        self.image_processor = FakeImageProcessor()
+        self.components = {}
+        self.num_timesteps = 0
+
+    def to(self, device):
+        return self
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, **kwargs):
+        """
+        Return deterministic stand-in embeddings with the shape of the Stable Diffusion 1.x text encoder output.
+        """
+        self._spend(self.encode_seconds)
+        generator = torch.Generator().manual_seed(sum(map(ord, prompt)))
+        return torch.randn(num_images_per_prompt, 77, 768, generator=generator), None
+
+    def __call__(self, image, strength=0.8, num_inference_steps=50, callback_on_step_end=None, prompt=None,
+                 prompt_embeds=None, **kwargs):
+        """
+        Run the fake denoising loop and return the input images as the generated ones. Like the real pipeline,
+        it also takes a batch of 4-channel latents or of image tensors in [0, 1] instead of images, and hands the
+        latents to the step callback.
+        """
+        if isinstance(image, torch.Tensor) and image.shape[1] == 4:
+            latents = image
+            images = [self.vae.decode_preview(item) for item in latents]
+        else:
+            if isinstance(image, torch.Tensor):
+                image = [Image.fromarray((item * 255).round().to(torch.uint8).permute(1, 2, 0).cpu().numpy())
+                         for item in image.float()]
+            images = image if isinstance(image, list) else [image]
+            latents = torch.cat([self.vae.encode(self.image_processor.preprocess(item)).latent_dist.mode()
+                                 for item in images]) * SCALING_FACTOR
+        steps = min(int(num_inference_steps * strength), num_inference_steps)
+        megapixels = sum(item.width * item.height for item in images) / 1e6
+        self.num_timesteps = steps
+
+        for step in range(steps):
+            self._spend(self.seconds_per_megapixel_step * megapixels)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {"latents": latents})
+
+        return FakePipelineOutput([item.convert("RGB") for item in images])
+
+    def _spend(self, seconds):
+        if seconds <= 0:
+            return
+        if self.mode == "sleep":
+            time.sleep(seconds)
+            return
+        deadline = time.perf_counter() + seconds
+        matrix = np.random.default_rng(0).random((64, 64))
+        while time.perf_counter() < deadline:
+            matrix = np.tanh(matrix @ matrix)
+
+
+class FakePipelineLoader:
+    """
+    A `PipelineRegistry` loader returning fake pipelines.
+
+    Attributes:
+        load_seconds (float): The time a load takes, standing in for reading the weights.
+        pipeline_kwargs (dict): The keyword arguments of `FakeImg2ImgPipeline`.
+    """
+
+    def __init__(self, load_seconds=0.0, **pipeline_kwargs):
+        self.load_seconds = load_seconds
+        self.pipeline_kwargs = pipeline_kwargs
+
+    def __call__(self, model_id_or_path, device, torch_dtype):
+        time.sleep(self.load_seconds)
+        return FakeImg2ImgPipeline(**self.pipeline_kwargs)
+
@@ -0,0 +1,177 @@
+"""
+End-to-end load test of the `/ad_template_creator` endpoint at increasing concurrency levels.
+
+By default the app is started in-process with the fake diffusion pipeline, so no GPU or weights are needed. Run
+from the `app` directory:
+    python -m benchmarks.load_test --concurrency 1,4,8 --requests 32
+
+or against a running service:
+    python -m benchmarks.load_test --url http://localhost:8087
+"""
+import argparse
+import http.client
+import io
+import itertools
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks.common import make_test_image, summarize_latencies, write_results
+from benchmarks.fake_pipeline import FakePipelineLoader
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def build_multipart(files):
+    """
+    Encode files as a multipart/form-data body.
+
+    Args:
+        files (dict): The file contents by form field name.
+
+    Returns:
+        tuple: The body and its content type.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, content in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.png"\r\n'
+                     f'Content-Type: image/png\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def parse_server_timing(header):
+    """
+    Parse a Server-Timing header into durations in seconds by metric name.
+    """
+    timings = {}
+    for metric in filter(None, (part.strip() for part in header.split(","))):
+        name, _, duration = metric.partition(";dur=")
+        if duration:
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+def run_level(url, concurrency, total_requests, body, content_type, params, seeds):
+    """
+    Send `total_requests` requests from `concurrency` clients.
+
+    Returns:
+        dict: The latency summary, throughput, error count and mean stage timings of the level.
+    """
+    target = urlsplit(url)
+    latencies, errors, stage_totals = [], [], {}
+    lock = threading.Lock()
+
+    def client(count):
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=600)
+        for _ in range(count):
+            query = urlencode(params + [("seed", next(seeds))])
+            start = time.perf_counter()
+            try:
+                connection.request("POST", f"/ad_template_creator?{query}", body=body,
+                                   headers={"Content-Type": content_type})
+                response = connection.getresponse()
+                response.read()
+                elapsed = time.perf_counter() - start
+                timings = parse_server_timing(response.getheader("Server-Timing", ""))
+                with lock:
+                    if response.status != 200:
+                        errors.append(response.status)
+                        continue
+                    latencies.append(elapsed)
+                    for stage, seconds in timings.items():
+                        stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+            except (OSError, http.client.HTTPException) as exc:
+                with lock:
+                    errors.append(type(exc).__name__)
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=600)
+        connection.close()
+
+    counts = [total_requests // concurrency + (index < total_requests % concurrency) for index in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, counts))
+    wall_seconds = time.perf_counter() - start
+
+    return {"concurrency": concurrency,
+            "requests": total_requests,
+            "errors": len(errors),
+            "wall_seconds": wall_seconds,
+            "throughput_rps": len(latencies) / wall_seconds if wall_seconds else 0.0,
+            "latency_seconds": summarize_latencies(latencies),
+            "mean_stage_seconds": {stage: total / len(latencies) for stage, total in stage_totals.items()}
+            if latencies else {}}
+
+
+def start_in_process_server(seconds_per_megapixel_step, mode):
+    """
+    Start the app on a free local port with the fake pipeline.
+
+    Returns:
+        str: The base URL of the server.
+    """
+    import uvicorn
+    import main
+
+    main.pipeline_registry.loader = FakePipelineLoader(seconds_per_megapixel_step=seconds_per_megapixel_step,
+                                                       mode=mode)
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="The base URL of a running service; the app is started in-process otherwise.")
+    parser.add_argument("--concurrency", default="1,2,4,8")
+    parser.add_argument("--requests", type=int, default=32, help="The number of requests per concurrency level.")
+    parser.add_argument("--image-size", default="1024x1024")
+    parser.add_argument("--steps", type=int, default=25)
+    parser.add_argument("--strength", type=float, default=0.5)
+    parser.add_argument("--layouts", default="classic")
+    parser.add_argument("--fake-step-seconds", type=float, default=0.02,
+                        help="The cost of one fake denoising step per megapixel.")
+    parser.add_argument("--fake-mode", choices=("sleep", "burn"), default="sleep")
+    parser.add_argument("--output", help="The JSON file the results are written to.")
+    args = parser.parse_args()
+
+    url = args.url or start_in_process_server(args.fake_step_seconds, args.fake_mode)
+
+    width, height = (int(value) for value in args.image_size.split("x"))
+    body, content_type = build_multipart({"base_image": encode_png(make_test_image(width, height)),
+                                          "logo_image": encode_png(make_test_image(256, 256, seed=1))})
+    params = [("base_image_color", "#b36a0b"), ("positive_prompt", "a product photo, UHD"),
+              ("negative_prompt", "blurry"), ("strength", args.strength), ("steps", args.steps),
+              ("punchline_text", "AI ad banners lead to higher conversion rates"),
+              ("punchline_text_color", "#eb4034"), ("button_text", "Call to action"),
+              ("button_text_color", "#0051ff")]
+    params += [("layouts", layout) for layout in args.layouts.split(",")]
+    # Every request gets its own seed so that none of them is answered from the result cache
+    seeds = itertools.count(int(time.time()))
+
+    results = []
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        results.append(run_level(url, concurrency, args.requests, body, content_type, params, seeds))
+
+    write_results("load_test", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Microbenchmarks of the image and template rendering functions across image sizes, text lengths and layouts.
+
+Run from the `app` directory:
+    python -m benchmarks.template --font /path/to/font.ttf
+"""
+import argparse
+
+from PIL import Image, ImageDraw
+
+from benchmarks.common import make_test_image, time_call, write_results
+from dynamic_template.dynamic_template_creator import DynamicTemplate
+from dynamic_template.helpers import get_font, resize_and_round_corners, write_multiline_text
+from dynamic_template.layouts import COMPILED_LAYOUTS
+from stable_diffusion.helpers import extract_features_and_change_their_color
+
+SAMPLE_WORDS = "AI generated ad banners lead to higher conversion rates for every brand".split()
+
+
+def make_text(length):
+    """
+    Build a punchline of about `length` characters out of sample words.
+    """
+    words = []
+    while len(" ".join(words)) < length:
+        words.append(SAMPLE_WORDS[len(words) % len(SAMPLE_WORDS)])
+    return " ".join(words)[:length].strip()
+
+
+def benchmark_color_filter(sizes, repeat):
+    kwargs = {"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5}
+    results = []
+    for width, height in sizes:
+        image = make_test_image(width, height)
+        results.append({"function": "extract_features_and_change_their_color",
+                        "size": f"{width}x{height}",
+                        "seconds": time_call(extract_features_and_change_their_color, repeat, image, **kwargs)})
+    return results
+
+
+def benchmark_round_corners(sizes, repeat):
+    results = []
+    for width, height in sizes:
+        image = make_test_image(width, height)
+        for target_size in ((360, 360), (640, 640), (960, 960)):
+            results.append({"function": "resize_and_round_corners",
+                            "size": f"{width}x{height}",
+                            "target_size": f"{target_size[0]}x{target_size[1]}",
+                            "seconds": time_call(resize_and_round_corners, repeat, image, target_size)})
+    return results
+
+
+def benchmark_multiline_text(text_lengths, font_path, repeat):
+    results = []
+    for length in text_lengths:
+        text = make_text(length)
+        font = get_font(font_path, 20)
+
+        def write():
+            canvas = Image.new("RGB", (720, 720), "white")
+            write_multiline_text(ImageDraw.Draw(canvas), text, (720, 528), font, "#000000", 15, 612)
+
+        # The first call fills the wrapping and font caches; the repeated calls measure the cached path
+        results.append({"function": "write_multiline_text",
+                        "text_length": length,
+                        "first_call_seconds": time_call(write, 1),
+                        "seconds": time_call(write, repeat)})
+    return results
+
+
+def benchmark_templates(layouts, text_lengths, font_path, repeat):
+    results = []
+    logo_image = make_test_image(256, 256, seed=1)
+    for layout in layouts:
+        dynamic_template = DynamicTemplate(layout)
+        dynamic_template.font_name = font_path
+        result_image = make_test_image(*dynamic_template.result_image_size)
+        for length in text_lengths:
+            results.append({"function": "generate_dynamic_ad_template",
+                            "layout": layout,
+                            "text_length": length,
+                            "seconds": time_call(dynamic_template.generate_dynamic_ad_template, repeat,
+                                                 result_image, logo_image, make_text(length), "#eb4034",
+                                                 "Call to action", "#0051ff")})
+    return results
+
+
+def parse_sizes(sizes):
+    return [tuple(int(value) for value in size.split("x")) for size in sizes.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="512x512,1024x1024,2048x1536")
+    parser.add_argument("--text-lengths", default="20,80,200")
+    parser.add_argument("--layouts", default=",".join(COMPILED_LAYOUTS))
+    parser.add_argument("--font", default="comicbd.ttf", help="The TrueType font the texts are drawn with.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="The JSON file the results are written to.")
+    args = parser.parse_args()
+
+    sizes = parse_sizes(args.sizes)
+    text_lengths = [int(length) for length in args.text_lengths.split(",")]
+
+    results = (benchmark_color_filter(sizes, args.repeat) +
+               benchmark_round_corners(sizes, args.repeat) +
+               benchmark_multiline_text(text_lengths, args.font, args.repeat) +
+               benchmark_templates(args.layouts.split(","), text_lengths, args.font, args.repeat))
+    write_results("template", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
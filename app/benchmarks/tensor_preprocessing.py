@@ -0,0 +1,162 @@
+"""
+Parity check and copy/latency benchmark of the tensor preprocessing path against the PIL implementation.
+
+The parity check compares the pixels of `change_feature_colors` with the ones of
+`extract_features_and_change_their_color` for RGB, RGBA and grayscale images, one by one and batched with mixed
+colors and radii; any difference fails the run. The benchmark times a batch of decoded images from Pillow to the
+normalized tensors the pipeline runs on, through both paths: the PIL path filters and resizes every image on the
+host, then converts it to a tensor like the image processor of the pipeline does, while the tensor path copies the
+pixels out of Pillow once and does the rest on the device.
+
+Run from the `app` directory:
+    python -m benchmarks.tensor_preprocessing --device cuda --batch-sizes 1,4,8
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.common import make_test_image, write_results
+from config import DEFAULT_LAYOUT
+from dynamic_template.layouts import get_diffusion_target
+from stable_diffusion.helpers import extract_features_and_change_their_color
+from stable_diffusion.stable_diffusor import StableDiffusor
+from stable_diffusion.tensor_preprocessing import (change_feature_colors, image_to_tensor, pixels_to_rgb,
+                                                   preprocess_batch)
+
+# Filter arguments covering the edge cases: no dilation, odd factors and the defaults of the service
+FILTERS = [{"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5},
+           {"target_color": (0, 138, 237), "smooth_factor": 0.3, "dilation_radius": 2},
+           {"target_color": (255, 255, 255), "smooth_factor": 0.77, "dilation_radius": 0}]
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def filter_tensor(images, filters, device):
+    """
+    Color filter PIL images with the tensor implementation, as a single batch.
+
+    Returns:
+        numpy.ndarray: The filtered (batch, height, width, 3) pixels.
+    """
+    pixels = pixels_to_rgb(torch.stack([image_to_tensor(image).to(device) for image in images]))
+    changed = change_feature_colors(pixels,
+                                    target_colors=[item["target_color"] for item in filters],
+                                    smooth_factors=[item["smooth_factor"] for item in filters],
+                                    dilation_radii=[item["dilation_radius"] for item in filters])
+    return changed.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def check_parity(width, height, device):
+    """
+    Check that the tensor implementation produces the pixels of the PIL implementation.
+
+    Returns:
+        dict: The number of differing pixel values, one by one and batched.
+    """
+    images = [make_test_image(width, height, seed=seed) for seed in range(len(FILTERS))]
+    variants = {"RGB": images,
+                "RGBA": [image.convert("RGBA") for image in images],
+                "L": [image.convert("L") for image in images]}
+
+    mismatches = {}
+    for mode, mode_images in variants.items():
+        expected = np.stack([np.asarray(extract_features_and_change_their_color(image, **kwargs))
+                             for image, kwargs in zip(mode_images, FILTERS)])
+        single = np.concatenate([filter_tensor([image], [kwargs], device)
+                                 for image, kwargs in zip(mode_images, FILTERS)])
+        batched = filter_tensor(mode_images, FILTERS, device)
+        mismatches[mode] = int(np.count_nonzero(expected != single))
+        mismatches[f"{mode}_batched"] = int(np.count_nonzero(expected != batched))
+    return mismatches
+
+
+def pil_path(images, target_size, max_side, device):
+    """
+    The PIL path: filter and normalize every image on the host, then convert it like the image processor.
+    """
+    tensors = []
+    for image in images:
+        filtered = StableDiffusor.prepare_base_image(image, hex_code="#b36a0b", target_size=target_size,
+                                                     max_side=max_side)
+        pixels = np.array(filtered).astype(np.float32) / 255
+        tensors.append(torch.from_numpy(pixels).permute(2, 0, 1).unsqueeze(0).to(device))
+    return torch.cat(tensors)
+
+
+def tensor_path(images, target_size, max_side, device):
+    """
+    The tensor path: a single copy out of Pillow per image, then the whole batch on the device.
+    """
+    color_filter = {"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5,
+                    "target_size": target_size, "max_side": max_side}
+    return torch.cat(preprocess_batch([image_to_tensor(image) for image in images],
+                                      [color_filter] * len(images),
+                                      device))
+
+
+def time_path(path, images, target_size, max_side, device, repeat):
+    """
+    Return the best seconds of `repeat` runs of a path, and its output.
+    """
+    timings = []
+    for _ in range(repeat):
+        synchronize(device)
+        start = time.perf_counter()
+        output = path(images, target_size, max_side, device)
+        synchronize(device)
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--size", default="1024x1024", help="The size the base images are decoded at.")
+    parser.add_argument("--parity-size", default="256x192")
+    parser.add_argument("--batch-sizes", default="1,4,8")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="The JSON file the results are written to.")
+    args = parser.parse_args()
+
+    parity_width, parity_height = (int(value) for value in args.parity_size.split("x"))
+    mismatches = check_parity(parity_width, parity_height, args.device)
+
+    width, height = (int(value) for value in args.size.split("x"))
+    target_size, max_side = get_diffusion_target([args.layout])
+    results = []
+    for batch_size in (int(value) for value in args.batch_sizes.split(",")):
+        images = [make_test_image(width, height, seed=seed) for seed in range(batch_size)]
+        # Warm up the kernels and the allocator of the device
+        tensor_path(images, target_size, max_side, args.device)
+
+        pil_seconds, pil_output = time_path(pil_path, images, target_size, max_side, args.device, args.repeat)
+        tensor_seconds, tensor_output = time_path(tensor_path, images, target_size, max_side, args.device,
+                                                  args.repeat)
+        copy_seconds, _ = time_path(lambda items, *_: [image_to_tensor(image) for image in items], images,
+                                    target_size, max_side, args.device, args.repeat)
+
+        results.append({"device": args.device,
+                        "size": args.size,
+                        "diffusion_size": f"{pil_output.shape[3]}x{pil_output.shape[2]}",
+                        "batch_size": batch_size,
+                        "pil_seconds": pil_seconds,
+                        "tensor_seconds": tensor_seconds,
+                        "tensor_host_copy_seconds": copy_seconds,
+                        "speedup": pil_seconds / tensor_seconds,
+                        # Only the resampling filter differs, Lanczos on the host against bicubic on the device
+                        "resample_mean_abs_error": float((pil_output - tensor_output).abs().mean()),
+                        "mismatched_filter_values": mismatches})
+
+    write_results("tensor_preprocessing", results, args.output)
+    if any(mismatches.values()):
+        raise SystemExit("Parity check failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+
+from config import *
+from bulk_jobs import BulkJob, BulkJobRunner, LocalFileResolver
+from main import prepare_bulk_spec, run_bulk_entry
+
+
+def parse_args():
+    """
+    Parse the command line arguments of the bulk generation CLI.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Generate one ad template per line of a JSONL manifest.")
+    parser.add_argument("manifest", nargs="?", help="The JSONL manifest. Image paths are relative to its directory.")
+    parser.add_argument("--resume", metavar="JOB_ID", help="Resume an interrupted job instead of starting one.")
+    parser.add_argument("--images-dir", help="The directory image paths are resolved against "
+                                             "(default is the directory of the manifest).")
+    parser.add_argument("--jobs-dir", default=BULK_JOBS_DIR, help="The directory jobs and results are kept in.")
+    parser.add_argument("--format", dest="output_format", default="png", choices=sorted(IMAGE_FORMATS))
+    parser.add_argument("--compression-level", type=int, default=PNG_COMPRESSION_LEVEL)
+    parser.add_argument("--image-quality", type=int, default=IMAGE_QUALITY)
+    parser.add_argument("--max-in-flight", type=int, default=BULK_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+    if bool(args.manifest) == bool(args.resume):
+        parser.error("Provide either a manifest or --resume JOB_ID.")
+    if args.resume and not args.images_dir:
+        parser.error("--images-dir is required with --resume.")
+    return args
+
+
+def main():
+    args = parse_args()
+    images_dir = args.images_dir or os.path.dirname(os.path.abspath(args.manifest))
+    runner = BulkJobRunner(prepare_spec=prepare_bulk_spec,
+                           run_spec=run_bulk_entry,
+                           resolve_image=LocalFileResolver(images_dir),
+                           jobs_dir=args.jobs_dir,
+                           max_in_flight=args.max_in_flight,
+                           group_window=BULK_GROUP_WINDOW)
+
+    if args.resume:
+        job = BulkJob.load(args.jobs_dir, args.resume)
+        if job is None:
+            raise SystemExit(f"Bulk job {args.resume} not found in {args.jobs_dir}.")
+    else:
+        with open(args.manifest, "rb") as manifest:
+            job = BulkJob.create(args.jobs_dir,
+                                 manifest,
+                                 output_format=args.output_format,
+                                 compression_level=args.compression_level,
+                                 image_quality=args.image_quality)
+
+    print("Bulk job:", job.job_id, "in", job.job_dir)
+    # The job state is persisted as it runs, so an interrupted run can be picked up again with --resume
+    runner.run(job)
+    print(json.dumps(job.to_dict()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Parameters whose values must match for two manifest entries to share a batched pipeline call
+GROUP_FIELDS = ("strength", "guidance_scale", "steps", "scheduler", "layouts")
+
+
+class LocalFileResolver:
+    """
+    Resolves the image references of a manifest to local files.
+
+    Attributes:
+        root (str or None): The directory relative paths are resolved against, and that no reference may escape.
+            None disables local files altogether.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.realpath(root) if root else None
+
+    def __call__(self, reference):
+        """
+        Open the image a reference points to.
+
+        Args:
+            reference (str): A path, relative to the root.
+
+        Raises:
+            ValueError: If local files are disabled or the path is outside the root.
+
+        Returns:
+            file-like object: The image file, opened for binary reading.
+        """
+        if self.root is None:
+            raise ValueError(f"Cannot resolve {reference!r}: local image paths are disabled.")
+        path = os.path.realpath(os.path.join(self.root, reference))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Cannot resolve {reference!r}: the path is outside of {self.root}.")
+        return open(path, "rb")
+
+
+class BulkJob:
+    """
+    A manifest of ad specs processed in bulk, persisted in its own directory so that it can be resumed.
+
+    The directory holds the manifest, the job settings, one result file per succeeded entry and `results.jsonl`,
+    an append-only log with one record per processed entry. Entries already in the log are skipped on resume.
+
+    Attributes:
+        job_id (str): The unique identifier of the job.
+        job_dir (str): The directory of the job.
+        settings (dict): The output settings shared by every entry, e.g. the output format.
+        status (str): One of "queued", "running", "succeeded", "failed" or "interrupted".
+        total (int): The number of entries in the manifest.
+        succeeded (int): The number of entries rendered so far.
+        failed (int): The number of entries that could not be rendered.
+        error (str or None): The error message, set when the whole job failed.
+        created_at (float): The time the job was created.
+        finished_at (float or None): The time the job finished.
+    """
+
+    def __init__(self, job_id, job_dir, settings, total, created_at):
+        self.job_id = job_id
+        self.job_dir = job_dir
+        self.settings = settings
+        self.status = "queued"
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.error = None
+        self.created_at = created_at
+        self.finished_at = None
+        self._recorded = set()
+        self._condition = threading.Condition()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.job_dir, "manifest.jsonl")
+
+    @property
+    def results_path(self):
+        return os.path.join(self.job_dir, "results.jsonl")
+
+    @property
+    def finished(self):
+        """
+        bool: True once the job stopped running, whether it succeeded, failed or was interrupted.
+        """
+        return self.status in ("succeeded", "failed", "interrupted")
+
+    @classmethod
+    def create(cls, jobs_dir, manifest_fileobj, **settings):
+        """
+        Create a job from a manifest, copying the manifest into the job directory in chunks.
+
+        Args:
+            jobs_dir (str): The directory holding all bulk jobs.
+            manifest_fileobj (file-like object): The JSONL manifest, one ad spec per line, opened in binary mode.
+            **settings: The output settings shared by every entry.
+
+        Returns:
+            BulkJob: The queued job.
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(jobs_dir, job_id)
+        os.makedirs(job_dir)
+
+        job = cls(job_id, job_dir, settings, total=0, created_at=time.time())
+        manifest_fileobj.seek(0)
+        with open(job.manifest_path, "wb") as manifest:
+            shutil.copyfileobj(manifest_fileobj, manifest)
+        with open(job.manifest_path, "rb") as manifest:
+            job.total = sum(1 for line in manifest if line.strip())
+        open(job.results_path, "ab").close()
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, jobs_dir, job_id):
+        """
+        Load a job from its directory.
+
+        A job whose saved status is still "running" was cut off by a restart, and is reported as "interrupted".
+
+        Args:
+            jobs_dir (str): The directory holding all bulk jobs.
+            job_id (str): The job identifier.
+
+        Returns:
+            BulkJob or None: The job, or None if it does not exist.
+        """
+        job_dir = os.path.join(jobs_dir, os.path.basename(job_id))
+        try:
+            with open(os.path.join(job_dir, "job.json")) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        job = cls(state["job_id"], job_dir, state["settings"], state["total"], state["created_at"])
+        job.status = "interrupted" if state["status"] in ("queued", "running") else state["status"]
+        job.error = state.get("error")
+        job.finished_at = state.get("finished_at")
+
+        # Drop a record cut off by a crash, so that the records appended on resume start on their own line
+        with open(job.results_path, "rb+") as file:
+            end = 0
+            for line in file:
+                if line.endswith(b"\n"):
+                    end += len(line)
+            file.truncate(end)
+
+        for record in job.iter_results(follow=False):
+            job._count(record)
+        return job
+
+    def save(self):
+        """
+        Persist the settings and status of the job, atomically.
+        """
+        state = {"job_id": self.job_id,
+                 "settings": self.settings,
+                 "status": self.status,
+                 "total": self.total,
+                 "error": self.error,
+                 "created_at": self.created_at,
+                 "finished_at": self.finished_at}
+        path = os.path.join(self.job_dir, "job.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(path + ".tmp", path)
+
+    def set_status(self, status, error=None):
+        """
+        Update and persist the status of the job, waking up readers that follow its results.
+        """
+        with self._condition:
+            self.status = status
+            self.error = error
+            self.finished_at = time.time() if self.finished else None
+            self.save()
+            self._condition.notify_all()
+
+    def is_recorded(self, index):
+        """
+        Return True if the manifest entry at the given index has already been processed.
+        """
+        with self._condition:
+            return index in self._recorded
+
+    def result_path(self, file_name):
+        """
+        Return the path of a result file of the job.
+        """
+        return os.path.join(self.job_dir, os.path.basename(file_name))
+
+    def write_result(self, index, name, content, media_type):
+        """
+        Store the result of an entry and record it in the results log.
+
+        Args:
+            index (int): The position of the entry in the manifest.
+            name (str): The name of the entry.
+            content (bytes): The encoded result.
+            media_type (str): The media type of the result.
+        """
+        file_name = f"{index:06d}_{name}.{media_type.split('/')[-1]}"
+        path = self.result_path(file_name)
+        # The file is complete before it is logged, so an interrupted write is simply redone on resume
+        with open(path + ".tmp", "wb") as file:
+            file.write(content)
+        os.replace(path + ".tmp", path)
+        self.record({"index": index, "name": name, "status": "succeeded", "file": file_name,
+                     "media_type": media_type, "size": len(content)})
+
+    def record(self, record):
+        """
+        Append a record to the results log.
+
+        Args:
+            record (dict): The outcome of an entry, with at least its index and status.
+        """
+        with self._condition:
+            with open(self.results_path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+            self._count(record)
+            self._condition.notify_all()
+
+    def iter_results(self, follow=True):
+        """
+        Read the results log incrementally, without loading it into memory.
+
+        Args:
+            follow (bool): Keep waiting for new records until the job has finished.
+
+        Yields:
+            dict: The next record of the log.
+        """
+        with open(self.results_path) as file:
+            while True:
+                # Records appended before the job finished are all read in the pass after it is seen finished
+                with self._condition:
+                    done = not follow or self.finished
+
+                while True:
+                    position = file.tell()
+                    line = file.readline()
+                    if not line.endswith("\n"):
+                        # Rewind over a partially written line, or one cut off by a crash
+                        file.seek(position)
+                        break
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass
+
+                if done:
+                    return
+                with self._condition:
+                    if not self.finished:
+                        self._condition.wait(timeout=1)
+
+    def to_dict(self):
+        """
+        Describe the job state.
+
+        Returns:
+            dict: The job ID, status, entry counters and error of the job.
+        """
+        return {"job_id": self.job_id,
+                "status": self.status,
+                "total": self.total,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at}
+
+    def _count(self, record):
+        if record["index"] in self._recorded:
+            return
+        self._recorded.add(record["index"])
+        if record["status"] == "succeeded":
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+
+class BulkJobRunner:
+    """
+    Runs bulk jobs through the same pipeline, batching and result cache as single requests.
+
+    Manifest entries are read lazily in windows of `group_window` entries and each window is sorted by the
+    parameters that make up the micro-batch key, so entries in flight at the same time can share pipeline calls.
+    At most `max_in_flight` entries of all jobs are processed at once, keeping memory flat regardless of the size
+    of the manifest.
+
+    Attributes:
+        prepare_spec (callable): Called as prepare_spec(spec) with a manifest entry, returns the keyword arguments
+            of `run_spec` or raises if the entry is invalid.
+        run_spec (callable): Called as run_spec(base_image_file=..., logo_image_file=..., **params), returns the
+            encoded result and its media type.
+        resolve_image (callable): Called with an image reference of the manifest, returns an open binary file.
+        jobs_dir (str): The directory holding all bulk jobs.
+        max_in_flight (int): The number of entries processed concurrently.
+        group_window (int): The number of manifest entries sorted together.
+    """
+
+    def __init__(self, prepare_spec, run_spec, resolve_image, jobs_dir, max_in_flight=8, group_window=256):
+        self.prepare_spec = prepare_spec
+        self.run_spec = run_spec
+        self.resolve_image = resolve_image
+        self.jobs_dir = jobs_dir
+        self.max_in_flight = max_in_flight
+        self.group_window = group_window
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bulk-worker")
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._active = {}
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def create(self, manifest_fileobj, **settings):
+        """
+        Create a bulk job from a manifest and start running it in the background.
+
+        Returns:
+            BulkJob: The queued job.
+        """
+        job = BulkJob.create(self.jobs_dir, manifest_fileobj, **settings)
+        self.start(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Look up a bulk job, running or persisted by an earlier process.
+
+        Returns:
+            BulkJob or None: The job, or None if it does not exist.
+        """
+        with self._lock:
+            job = self._active.get(job_id)
+        return job or BulkJob.load(self.jobs_dir, job_id)
+
+    def resume(self, job_id):
+        """
+        Resume an interrupted job, skipping the entries it already processed.
+
+        Returns:
+            BulkJob or None: The job, or None if it does not exist. Jobs that are not interrupted are returned as
+                they are.
+        """
+        with self._lock:
+            job = self._active.get(job_id) or BulkJob.load(self.jobs_dir, job_id)
+            if job is None or job.status != "interrupted":
+                return job
+            self._active[job.job_id] = job
+        self._launch(job)
+        return job
+
+    def start(self, job):
+        """
+        Run a job on a background thread.
+        """
+        with self._lock:
+            self._active[job.job_id] = job
+        self._launch(job)
+
+    def _launch(self, job):
+        job.set_status("queued")
+        threading.Thread(target=self.run, args=(job,), name=f"bulk-job-{job.job_id[:8]}", daemon=True).start()
+
+    def run(self, job):
+        """
+        Process every entry of a job not processed yet, blocking until all of them are done.
+
+        Args:
+            job (BulkJob): The job to run.
+        """
+        job.set_status("running")
+        # The entries of this job in flight; the semaphore shared by all jobs only throttles them
+        pending = set()
+        pending_lock = threading.Lock()
+
+        def entry_done(future):
+            self._in_flight.release()
+            with pending_lock:
+                pending.discard(future)
+
+        try:
+            for window in self._iter_windows(job):
+                for index, spec, params in sorted(window, key=lambda entry: entry[2]["group"]):
+                    self._in_flight.acquire()
+                    future = self._executor.submit(self._run_entry, job, index, spec, params["kwargs"])
+                    with pending_lock:
+                        pending.add(future)
+                    future.add_done_callback(entry_done)
+            # Wait for the entries still in flight
+            self._drain(pending, pending_lock)
+            job.set_status("succeeded")
+        except Exception as exc:
+            self._drain(pending, pending_lock)
+            job.set_status("failed", error=str(exc) or type(exc).__name__)
+        finally:
+            with self._lock:
+                self._active.pop(job.job_id, None)
+
+    @staticmethod
+    def _drain(pending, pending_lock):
+        with pending_lock:
+            futures = list(pending)
+        wait(futures)
+
+    def _iter_windows(self, job):
+        window = []
+        with open(job.manifest_path, encoding="utf-8") as manifest:
+            index = 0
+            for line in manifest:
+                if not line.strip():
+                    continue
+                index, current = index + 1, index
+                if job.is_recorded(current):
+                    continue
+
+                try:
+                    spec = json.loads(line)
+                    if not isinstance(spec, dict):
+                        raise ValueError("Expected a JSON object.")
+                    kwargs = self.prepare_spec(spec)
+                except Exception as exc:
+                    job.record({"index": current, "status": "failed", "error": describe_error(exc)})
+                    continue
+
+                group = tuple(str(kwargs.get(field)) for field in GROUP_FIELDS)
+                window.append((current, spec, {"kwargs": {**job.settings, **kwargs}, "group": group}))
+                if len(window) >= self.group_window:
+                    yield window
+                    window = []
+        if window:
+            yield window
+
+    def _run_entry(self, job, index, spec, kwargs):
+        name = entry_name(spec, index)
+        try:
+            with self.resolve_image(spec["base_image"]) as base_image_file, \
+                    self.resolve_image(spec["logo_image"]) as logo_image_file:
+                content, media_type = self.run_spec(base_image_file=base_image_file,
+                                                    logo_image_file=logo_image_file,
+                                                    **kwargs)
+            job.write_result(index, name, content, media_type)
+        except Exception as exc:
+            job.record({"index": index, "name": name, "status": "failed", "error": describe_error(exc)})
+
+
+def entry_name(spec, index):
+    """
+    Return the file-safe name of a manifest entry, its `name` field or its position in the manifest.
+    """
+    name = str(spec.get("name", f"entry_{index}"))
+    return "".join(c if c.isalnum() or c in "._-" else "_" for c in name)
+
+
+def describe_error(exc):
+    """
+    Return the message of an error, using the detail of HTTP exceptions raised by the request validators.
+    """
+    return str(getattr(exc, "detail", None) or exc) or type(exc).__name__
@@ -0,0 +1,107 @@
+import os
+import tempfile
+
+# Model served by the API, where it runs ("auto" picks CUDA, then MPS, then the CPU) and the data type of its weights
+# ("auto" picks float16 on GPUs and bfloat16 or float32 on CPUs)
+MODEL_ID_OR_PATH = os.getenv("MODEL_ID_OR_PATH", "prompthero/openjourney-v4")
+MODEL_DEVICE = os.getenv("MODEL_DEVICE", "auto")
+MODEL_DTYPE = os.getenv("MODEL_DTYPE", "auto")
+
+# CPU inference: the intra-op threads (0 sizes them to the CPU quota of the container), the inter-op threads (0 for
+# one), the channels-last memory format ("auto" enables it on the CPU only) and compiling the UNet with torch.compile
+CPU_INTRA_OP_THREADS = int(os.getenv("CPU_INTRA_OP_THREADS", "0")) or None
+CPU_INTER_OP_THREADS = int(os.getenv("CPU_INTER_OP_THREADS", "0")) or None
+CHANNELS_LAST = {"1": True, "0": False}.get(os.getenv("CHANNELS_LAST", "auto"))
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+
+# Run the color filter of each batch as tensor operations on the device instead of with PIL and NumPy per image
+TENSOR_PREPROCESSING = os.getenv("TENSOR_PREPROCESSING", "0") == "1"
+
+# Upper bound for the weights kept resident by the pipeline registry, unbounded when unset
+PIPELINE_MEMORY_BUDGET_MB = int(os.getenv("PIPELINE_MEMORY_BUDGET_MB", "0")) or None
+
+# Micro-batching of concurrent img2img requests, disabled when the batch size is 1
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", "10"))
+
+# Device memory: how the pipeline trades speed for memory ("full", "balanced", "low" or "minimal"), and the device
+# memory the batches are planned to fit in (0 only respects the memory left free on the device)
+MEMORY_MODE = os.getenv("MEMORY_MODE", "full")
+DEVICE_MEMORY_BUDGET_MB = int(os.getenv("DEVICE_MEMORY_BUDGET_MB", "0")) or None
+
+# Asynchronous jobs: concurrently running jobs, how long finished results are kept, and the jobs queued or running
+# at once (0 for an unbounded queue), beyond which new jobs are rejected with 429
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "600"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "64")) or None
+
+# Result cache: in-memory LRU budget and on-disk tier, the disk tier is disabled when the directory is empty
+RESULT_CACHE_MEMORY_MB = int(os.getenv("RESULT_CACHE_MEMORY_MB", "256"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ad_result_cache"))
+RESULT_CACHE_DISK_MB = int(os.getenv("RESULT_CACHE_DISK_MB", "2048"))
+
+# Memory budget of the cached prompt embeddings
+PROMPT_CACHE_MEMORY_MB = int(os.getenv("PROMPT_CACHE_MEMORY_MB", "64"))
+
+# Memory budget of the cached VAE latents of color filtered base images, the cache is disabled when it is 0
+LATENT_CACHE_MEMORY_MB = int(os.getenv("LATENT_CACHE_MEMORY_MB", "64"))
+
+# Default encoder settings of the generated templates
+PNG_COMPRESSION_LEVEL = int(os.getenv("PNG_COMPRESSION_LEVEL", "1"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+
+# Uploads above these limits are rejected before they are decoded
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "20"))
+MAX_UPLOAD_MEGAPIXELS = int(os.getenv("MAX_UPLOAD_MEGAPIXELS", "50"))
+
+# Multi-variant rendering: threads rendering template variants and the maximum variants per request
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+MAX_TEMPLATE_VARIANTS = int(os.getenv("MAX_TEMPLATE_VARIANTS", "32"))
+
+# Ad layouts: a JSON file of extra layout specs registered at startup, and the layouts rendered by default
+LAYOUTS_FILE = os.getenv("LAYOUTS_FILE", "")
+DEFAULT_LAYOUT = os.getenv("DEFAULT_LAYOUT", "classic")
+
+# Bulk jobs: where manifests and results are kept, the directory local image paths are resolved against (local
+# paths are rejected when it is empty), the entries processed concurrently and how many are sorted together
+BULK_JOBS_DIR = os.getenv("BULK_JOBS_DIR", os.path.join(tempfile.gettempdir(), "ad_bulk_jobs"))
+BULK_LOCAL_ROOT = os.getenv("BULK_LOCAL_ROOT", "")
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", str(2 * MAX_BATCH_SIZE)))
+BULK_GROUP_WINDOW = int(os.getenv("BULK_GROUP_WINDOW", "256"))
+
+# Asset store: where uploaded logos and base images are kept, and the memory budget of their derived images
+ASSET_STORE_DIR = os.getenv("ASSET_STORE_DIR", os.path.join(tempfile.gettempdir(), "ad_assets"))
+ASSET_DERIVATIVE_CACHE_MB = int(os.getenv("ASSET_DERIVATIVE_CACHE_MB", "128"))
+
+# Opt-in request profiling: requests sent with an "X-Profile: 1" header get a cProfile report instead of their
+# result. Keep it off in production
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+
+# Worker processes: the number of processes holding a pipeline each, fed from the API process (0 runs everything in
+# the API process), the devices they are spread over, the CPU cores each is pinned to (0 splits the CPU quota evenly)
+# and the requests each runs at once
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+WORKER_DEVICES = [device for device in os.getenv("WORKER_DEVICES", "").split(",") if device] or [MODEL_DEVICE]
+WORKER_CPU_THREADS = int(os.getenv("WORKER_CPU_THREADS", "0")) or None
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(MAX_BATCH_SIZE)))
+
+# Admission control: requests running the diffusion process at once, and the queue size of each priority class in
+# front of it (0 for an unbounded queue). Interactive requests are rejected with 429 when their queue is full
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT",
+                                         str(2 * MAX_BATCH_SIZE * max(WORKER_PROCESSES, 1))))
+ADMISSION_MAX_QUEUED_INTERACTIVE = int(os.getenv("ADMISSION_MAX_QUEUED_INTERACTIVE", "16")) or None
+ADMISSION_MAX_QUEUED_BULK = int(os.getenv("ADMISSION_MAX_QUEUED_BULK", "0")) or None
+
+# How often synchronous requests check whether their client disconnected
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+# Model startup: the directory holding safetensors snapshots of the models, loaded memory-mapped on restarts
+# (snapshots are disabled when empty), and the denoising steps of the warm-up inference (0 skips it)
+MODEL_SNAPSHOT_DIR = os.getenv("MODEL_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "ad_model_snapshots"))
+WARMUP_STEPS = int(os.getenv("WARMUP_STEPS", "2"))
+
+# Progressive previews streamed by `/ad_template_creator/stream`: the denoising steps between two previews, the scale
+# of the preview templates relative to their layout and their JPEG quality
+PREVIEW_EVERY_STEPS = int(os.getenv("PREVIEW_EVERY_STEPS", "5"))
+PREVIEW_SCALE = float(os.getenv("PREVIEW_SCALE", "0.5"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "70"))
@@ -1,7 +1,9 @@
 try:
     from .helpers import *
+    from .layouts import get_layout
 except ImportError:
     from helpers import *
+    from layouts import get_layout
 
 
 class DynamicTemplate:
@@ -9,21 +11,22 @@ class DynamicTemplate:
     A class for generating dynamic ad templates with a logo, base image, punchline text, and a call-to-action button.
 
     Attributes:
+        layout (CompiledLayout): The precompiled geometry of the template, see `layouts.LAYOUT_SPECS`.
         result_image_size (tuple): The size (width, height) of the output image.
+        diffusion_max_side (int or None): The maximum longer side of the image diffused for this template.
         logo_image_size (tuple): The size (width, height) of the logo image.
         template_width (int): The width of the template.
         template_height (int): The height of the template.
-        logo_image_top_margin (int): The top margin for placing the logo.
-        spacing_between_result_image_and_logo_image (int): Spacing between the result image and the logo image.
         font_name (str): The font name for punchline text and button text.
         font_size (int): The font size for punchline text.
-        spacing_between_result_image_and_punchline_text (int): Spacing between the result image and punchline text.
+        punchline_text_spacing (int): Spacing between the lines of the punchline text.
+        punchline_text_maximum_height (int): The lowest y the punchline text may reach.
         button_text_padding (int): Padding around the button text.
         spacing_between_punchline_text_and_button (int): Spacing between punchline text and the call-to-action button.
 
     Methods:
-        __init__():
-            Initializes a DynamicTemplate object with default values.
+        __init__(layout='classic', scale=1.0):
+            Initializes a DynamicTemplate object with the values of the given layout, scaled by `scale`.
 
         generate_dynamic_ad_template(result_image, logo_image, punchline_text, punchline_text_color,
                                      button_text, button_text_color) -> Pillow.Image:
@@ -41,21 +44,19 @@ class DynamicTemplate:
                 Pillow.Image: The resulting template image.
     """
 
-    def __init__(self):
-        # Default values for template parameters
-        self.result_image_size = (360, 360)
-        self.logo_image_size = (128, 128)
-        self.template_width = 720
-        self.template_height = 720
-        self.logo_image_top_margin = 10
-        self.spacing_between_result_image_and_logo_image = 20
-        self.font_name = "comicbd.ttf"
-        self.font_size = 20
-        self.spacing_between_result_image_and_punchline_text = 10
-        self.punchline_text_spacing = 15
-        self.punchline_text_maximum_height = int(self.template_height * 0.85)
-        self.button_text_padding = 10
-        self.spacing_between_punchline_text_and_button = 10
+    def __init__(self, layout="classic", scale=1.0):
+        # Template parameters, taken from the precompiled layout, e.g. scaled down for previews
+        self.layout = get_layout(layout).scaled(scale)
+        self.result_image_size = self.layout.image_size
+        self.diffusion_max_side = self.layout.diffusion_max_side
+        self.logo_image_size = self.layout.logo_size
+        self.template_width, self.template_height = self.layout.canvas_size
+        self.font_name = self.layout.font_name
+        self.font_size = self.layout.font_size
+        self.punchline_text_spacing = self.layout.line_spacing
+        self.punchline_text_maximum_height = self.layout.text_max_bottom
+        self.button_text_padding = self.layout.button_padding
+        self.spacing_between_punchline_text_and_button = self.layout.button_spacing
 
     def generate_dynamic_ad_template(self,
                                      result_image,
@@ -79,36 +80,30 @@ class DynamicTemplate:
             Pillow.Image: The resulting template image.
         """
 
-        # Load images
+        layout = self.layout
+
+        # Load images, reusing the precomputed rounded-corner mask of the layout
         result_img = resize_and_round_corners(result_image,
-                                              self.result_image_size)
+                                              self.result_image_size,
+                                              mask=layout.image_mask)
 
-        logo_img = logo_image.resize(self.logo_image_size)
+        # Logos from the asset store already come at the size of the slot
+        logo_img = logo_image
+        if logo_image.size != self.logo_image_size:
+            logo_img = logo_image.resize(self.logo_image_size)
 
         # Create a blank template
         template = Image.new("RGB", (self.template_width, self.template_height), "white")
         draw = ImageDraw.Draw(template)
 
-        # Paste logo at the top center
-        logo_image_position = ((self.template_width - logo_img.width) // 2, self.logo_image_top_margin)
-        template.paste(logo_img, logo_image_position)
-
-        # Paste base image in the middle
-        result_image_position = (
-            (self.template_width - result_img.width) // 2,
-            logo_image_position[1] + logo_img.height + self.spacing_between_result_image_and_logo_image
-        )
-
-        template.paste(result_img, result_image_position)
-
-        # Draw punchline text in the middle
-        punchline_font = ImageFont.truetype(self.font_name, self.font_size)
+        # Paste logo and base image into their slots
+        template.paste(logo_img, layout.logo_position)
+        template.paste(result_img, layout.image_position)
 
-        _, _, text_width, text_height = draw.textbbox((0, 0), punchline_text, font=punchline_font)
+        # Draw punchline text in the text box
+        punchline_font = get_font(self.font_name, self.font_size)
 
-        punchline_text_position = (self.template_width,
-                                   result_img.height + result_image_position[
-                                       1] + self.spacing_between_result_image_and_punchline_text)
+        punchline_text_position = (layout.text_width, layout.text_top)
 
         last_text_height, punchline_text_font_size = write_multiline_text(draw=draw,
                                                                           text=punchline_text,
@@ -116,13 +111,15 @@ class DynamicTemplate:
                                                                           font=punchline_font,
                                                                           font_color=punchline_text_color,
                                                                           margin=self.punchline_text_spacing,
-                                                                          max_height=self.punchline_text_maximum_height)
+                                                                          max_height=self.punchline_text_maximum_height,
+                                                                          min_font_size=layout.min_font_size,
+                                                                          x_offset=layout.text_left)
 
-        # Draw button text at the bottom center
-        button_font = ImageFont.truetype(self.font_name, punchline_text_font_size)
+        # Draw button text below the punchline text
+        button_font = get_font(self.font_name, punchline_text_font_size)
         _, _, button_width, button_height = draw.textbbox((0, 0), button_text, font=button_font)
         button_position = (
-            (self.template_width - button_width - self.button_text_padding) // 2,
+            layout.text_left + (layout.text_width - button_width - self.button_text_padding) // 2,
             last_text_height + self.spacing_between_punchline_text_and_button
         )
 
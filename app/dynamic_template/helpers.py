@@ -1,73 +1,162 @@
-import textwrap
-from PIL import Image, ImageDraw, ImageFont
+import functools
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 
-def resize_and_round_corners(image, target_size=(360, 360), corner_radius=20):
+def resize_and_round_corners(image, target_size=(360, 360), corner_radius=20, mask=None):
     """
     Resize the image and create a new image with rounded corners.
 
     Args:
-        image (Pillow.Image): Input image.
+        image (Pillow.Image): Input image. It is center cropped first when its aspect ratio differs from the
+            target size.
         target_size (tuple): The target size of the image (default is (360, 360)).
         corner_radius (int): The radius of the rounded corners (default is 20).
+        mask (Pillow.Image, optional): A precomputed rounded-corner mask of the target size, used instead of
+            drawing one from `corner_radius`.
 
     Returns:
         Pillow.Image: The resulting image with rounded corners.
     """
     # Resize the image to the target size
-    resized_image = image.resize(target_size)
+    if image.width * target_size[1] == image.height * target_size[0]:
+        resized_image = image.resize(target_size)
+    else:
+        resized_image = ImageOps.fit(image, target_size)
 
     # Create a new image with rounded corners
     rounded_image = Image.new("RGB", resized_image.size, "white")
-    mask = Image.new("L", resized_image.size, 0)
-    draw = ImageDraw.Draw(mask)
-    draw.rounded_rectangle([(0, 0), resized_image.size], radius=corner_radius, fill=255)
+    if mask is None:
+        mask = Image.new("L", resized_image.size, 0)
+        draw = ImageDraw.Draw(mask)
+        draw.rounded_rectangle([(0, 0), resized_image.size], radius=corner_radius, fill=255)
     rounded_image.paste(resized_image, mask=mask)
 
     # Save the resulting image
     return rounded_image
 
 
-def write_multiline_text(draw, text, position, font, font_color, margin, max_height):
+@functools.lru_cache(maxsize=256)
+def get_font(font_path, font_size):
+    """
+    Load a TrueType font, once per process for each path and size.
+
+    Args:
+        font_path (str): The path or name of the font file.
+        font_size (int): The font size.
+
+    Returns:
+        ImageFont.FreeTypeFont: The loaded font.
+    """
+    return ImageFont.truetype(font_path, font_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def wrap_text(text, font_path, font_size, max_width):
+    """
+    Wrap text into lines that fit within a width, measured with the glyph advances of the font.
+
+    Args:
+        text (str): The text to be wrapped.
+        font_path (str): The path or name of the font file.
+        font_size (int): The font size.
+        max_width (int): The maximum width of a line, in pixels. Words wider than this get a line of their own.
+
+    Returns:
+        tuple: One (line, bounding box) pair per line.
+    """
+    font = get_font(font_path, font_size)
+    space_width = font.getlength(" ")
+
+    lines = []
+    line_words = []
+    line_width = 0
+    for word in text.split():
+        word_width = font.getlength(word)
+        if line_words and line_width + space_width + word_width > max_width:
+            lines.append(" ".join(line_words))
+            line_words = [word]
+            line_width = word_width
+        else:
+            line_width += word_width + (space_width if line_words else 0)
+            line_words.append(word)
+    if line_words:
+        lines.append(" ".join(line_words))
+
+    return tuple((line, font.getbbox(line)) for line in lines)
+
+
+@functools.lru_cache(maxsize=1024)
+def fit_font_size(text, font_path, max_font_size, max_width, max_height, min_font_size=8, margin=0):
+    """
+    Find the largest font size at which the wrapped text fits within a height, by binary search.
+
+    The height of the text is measured the way `write_multiline_text` advances through the lines: the bottom of
+    each line's bounding box plus the margin.
+
+    Args:
+        text (str): The text to be written.
+        font_path (str): The path or name of the font file.
+        max_font_size (int): The preferred font size, returned when the text fits at it.
+        max_width (int): The maximum width of a line, in pixels.
+        max_height (int): The maximum total height of the lines, in pixels.
+        min_font_size (int): The smallest font size, returned when the text does not fit at any size.
+        margin (int): The margin after every line (default is 0).
+
+    Returns:
+        int: The font size.
+    """
+    def fits(font_size):
+        lines = wrap_text(text, font_path, font_size, max_width)
+        return sum(bbox[3] + margin for _, bbox in lines) <= max_height
+
+    if fits(max_font_size):
+        return max_font_size
+
+    best_font_size = min(min_font_size, max_font_size)
+    low, high = best_font_size, max_font_size - 1
+    while low <= high:
+        font_size = (low + high) // 2
+        if fits(font_size):
+            best_font_size = font_size
+            low = font_size + 1
+        else:
+            high = font_size - 1
+    return best_font_size
+
+
+def write_multiline_text(draw, text, position, font, font_color, margin, max_height, min_font_size=8, x_offset=0):
     """
     Write multiline text on an image with a specified font, color, and maximum height.
 
+    The font is shrunk to the largest size at which the text fits above `max_height`.
+
     Args:
         draw (ImageDraw.Draw): The drawing context.
         text (str): The text to be written.
-        position (tuple): The starting position of the text.
+        position (tuple): The width of the text area and the starting y position of the text.
         font (ImageFont.FreeTypeFont): The font to be used.
         font_color (str): The color of the text.
         margin (int): The margin between lines.
         max_height (int): The maximum height allowed for the text.
+        min_font_size (int): The smallest font size the text is shrunk to (default is 8).
+        x_offset (int): The left edge of the text area (default is 0).
 
     Returns:
         tuple: The final position and font size.
     """
+    # Shrink the font until the wrapped text fits within the specified height
+    font_size = fit_font_size(text, font.path, font.size, position[0], max_height - position[1], min_font_size,
+                              margin)
+    font = get_font(font.path, font_size)
+
     # Wrap text to fit within the specified width
-    font_width = font.getbbox("A")[2] // 1.5
-    wrapped_text = textwrap.fill(text, width=int(position[0] / font_width))
-
-    # Draw the wrapped text
-    lines = wrapped_text.split("\n")
-    total_text_height = sum(font.getbbox(line)[3] - font.getbbox(line)[1] for line in lines)
-    safe_margin_y = position[1] + total_text_height
-
-    if safe_margin_y + total_text_height > max_height:
-        while True:
-            if position[1] < safe_margin_y <= max_height:
-                break
-            else:
-                font = ImageFont.truetype("arial.ttf", font.size - 2)
-                total_text_height = sum(font.getbbox(line)[3] - font.getbbox(line)[1] for line in lines)
-                safe_margin_y = position[1] + total_text_height
+    lines = wrap_text(text, font.path, font_size, position[0])
 
     text_position_y = position[1]
 
-    for line in lines:
-        _, _, text_width, text_height = draw.textbbox((0, 0), line, font=font)
+    for line, (_, _, text_width, text_height) in lines:
         # Draw the text in the center
-        draw.text(((position[0] - text_width) // 2, text_position_y), line, font=font, fill=font_color)
+        draw.text((x_offset + (position[0] - text_width) // 2, text_position_y), line, font=font, fill=font_color)
 
         text_position_y += text_height + margin  # Set the next y position for a new line
 
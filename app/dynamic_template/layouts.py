@@ -0,0 +1,273 @@
+import json
+import threading
+
+from PIL import Image, ImageDraw
+
+# Declarative ad layouts. Every slot is a rectangle in canvas pixels; the text box spans from its top down to
+# `max_bottom`, and the call-to-action button is drawn below the punchline text.
+LAYOUT_SPECS = {
+    # The original 720x720 template
+    "classic": {
+        "canvas": {"width": 720, "height": 720},
+        "logo_slot": {"x": 296, "y": 10, "width": 128, "height": 128},
+        "image_slot": {"x": 180, "y": 158, "width": 360, "height": 360, "corner_radius": 20},
+        "text_box": {"x": 0, "y": 528, "width": 720, "max_bottom": 612},
+        "font": {"name": "comicbd.ttf", "size": 20, "min_size": 8},
+        "line_spacing": 15,
+        "button_padding": 10,
+        "button_spacing": 10,
+        "diffusion_max_side": None,
+    },
+    "square": {
+        "canvas": {"width": 1080, "height": 1080},
+        "logo_slot": {"x": 476, "y": 24, "width": 128, "height": 128},
+        "image_slot": {"x": 220, "y": 176, "width": 640, "height": 640, "corner_radius": 28},
+        "text_box": {"x": 60, "y": 836, "width": 960, "max_bottom": 980},
+        "font": {"name": "comicbd.ttf", "size": 34, "min_size": 12},
+        "line_spacing": 16,
+        "button_padding": 14,
+        "button_spacing": 14,
+        "diffusion_max_side": 768,
+    },
+    "landscape": {
+        "canvas": {"width": 1200, "height": 628},
+        "logo_slot": {"x": 838, "y": 32, "width": 128, "height": 128},
+        "image_slot": {"x": 24, "y": 24, "width": 580, "height": 580, "corner_radius": 28},
+        "text_box": {"x": 628, "y": 184, "width": 548, "max_bottom": 480},
+        "font": {"name": "comicbd.ttf", "size": 32, "min_size": 12},
+        "line_spacing": 14,
+        "button_padding": 14,
+        "button_spacing": 16,
+        "diffusion_max_side": 768,
+    },
+    "story": {
+        "canvas": {"width": 1080, "height": 1920},
+        "logo_slot": {"x": 476, "y": 96, "width": 128, "height": 128},
+        "image_slot": {"x": 60, "y": 304, "width": 960, "height": 960, "corner_radius": 40},
+        "text_box": {"x": 60, "y": 1320, "width": 960, "max_bottom": 1600},
+        "font": {"name": "comicbd.ttf", "size": 48, "min_size": 16},
+        "line_spacing": 20,
+        "button_padding": 20,
+        "button_spacing": 24,
+        "diffusion_max_side": 768,
+    },
+}
+
+
+def create_rounded_corner_mask(size, corner_radius):
+    """
+    Create the mask of a rectangle with rounded corners.
+
+    Args:
+        size (tuple): The (width, height) of the mask.
+        corner_radius (int): The radius of the rounded corners.
+
+    Returns:
+        Pillow.Image: An "L" mode mask, opaque inside the rounded rectangle.
+    """
+    mask = Image.new("L", size, 0)
+    draw = ImageDraw.Draw(mask)
+    draw.rounded_rectangle([(0, 0), size], radius=corner_radius, fill=255)
+    return mask
+
+
+class CompiledLayout:
+    """
+    A layout spec resolved into the positions, sizes and masks used to render it.
+
+    Compiled layouts are immutable and shared by every render, so no geometry is recomputed per call.
+
+    Attributes:
+        name (str): The name of the layout.
+        spec (dict): The layout spec it was compiled from.
+        canvas_size (tuple): The (width, height) of the template.
+        logo_position (tuple): The top left corner of the logo.
+        logo_size (tuple): The (width, height) of the logo.
+        image_position (tuple): The top left corner of the generated image.
+        image_size (tuple): The (width, height) of the generated image.
+        image_mask (Pillow.Image): The rounded-corner mask of the generated image.
+        text_left (int): The left edge of the text box.
+        text_top (int): The top edge of the text box.
+        text_width (int): The width of the text box.
+        text_max_bottom (int): The lowest y the punchline text may reach.
+        font_name (str): The font of the punchline text and button text.
+        font_size (int): The preferred font size of the punchline text.
+        min_font_size (int): The smallest font size long punchlines are shrunk to.
+        line_spacing (int): The spacing between punchline text lines.
+        button_padding (int): The padding around the button text.
+        button_spacing (int): The spacing between the punchline text and the button.
+        diffusion_max_side (int or None): The maximum longer side of the image diffused for this layout.
+    """
+
+    def __init__(self, name, spec):
+        canvas, logo_slot, image_slot, text_box, font = (spec["canvas"], spec["logo_slot"], spec["image_slot"],
+                                                         spec["text_box"], spec["font"])
+
+        self.name = name
+        self.spec = spec
+        self.canvas_size = (canvas["width"], canvas["height"])
+        self.logo_position = (logo_slot["x"], logo_slot["y"])
+        self.logo_size = (logo_slot["width"], logo_slot["height"])
+        self.image_position = (image_slot["x"], image_slot["y"])
+        self.image_size = (image_slot["width"], image_slot["height"])
+        self.image_mask = create_rounded_corner_mask(self.image_size, image_slot.get("corner_radius", 0))
+        self.text_left = text_box["x"]
+        self.text_top = text_box["y"]
+        self.text_width = text_box["width"]
+        self.text_max_bottom = text_box["max_bottom"]
+        self.font_name = font["name"]
+        self.font_size = font["size"]
+        self.min_font_size = min(font.get("min_size", font["size"]), font["size"])
+        self.line_spacing = spec.get("line_spacing", 0)
+        self.button_padding = spec.get("button_padding", 0)
+        self.button_spacing = spec.get("button_spacing", 0)
+        self.diffusion_max_side = spec.get("diffusion_max_side")
+
+        for slot_name, (x, y), (width, height) in (("logo_slot", self.logo_position, self.logo_size),
+                                                   ("image_slot", self.image_position, self.image_size),
+                                                   ("text_box", (self.text_left, self.text_top),
+                                                    (self.text_width, self.text_max_bottom - self.text_top))):
+            if width <= 0 or height <= 0 or x < 0 or y < 0 or x + width > canvas["width"] or \
+                    y + height > canvas["height"]:
+                raise ValueError(f"The {slot_name} of layout {name!r} does not fit in its canvas.")
+
+        self._scaled = {}
+        self._scaled_lock = threading.Lock()
+
+    def scaled(self, scale):
+        """
+        Return this layout scaled down or up, e.g. to render low resolution previews. Scaled layouts are compiled
+        once per scale.
+
+        Args:
+            scale (float): The factor every position, size and spacing is multiplied by.
+
+        Returns:
+            CompiledLayout: The scaled layout.
+        """
+        if scale == 1:
+            return self
+        with self._scaled_lock:
+            if scale not in self._scaled:
+                self._scaled[scale] = CompiledLayout(self.name, scale_layout_spec(self.spec, scale))
+            return self._scaled[scale]
+
+
+def scale_layout_spec(spec, scale):
+    """
+    Scale the geometry of a layout spec. Positions and sizes are rounded down, so the slots keep fitting in the
+    canvas.
+
+    Args:
+        spec (dict): The layout spec, in the format of LAYOUT_SPECS.
+        scale (float): The factor every position, size and spacing is multiplied by.
+
+    Returns:
+        dict: The scaled layout spec.
+    """
+    def scale_value(value):
+        return max(int(value * scale), 1)
+
+    scaled = dict(spec)
+    for section in ("canvas", "logo_slot", "image_slot", "text_box"):
+        scaled[section] = {key: scale_value(value) if key in ("width", "height", "max_bottom", "corner_radius")
+                           else int(value * scale) for key, value in spec[section].items()}
+    scaled["font"] = {**spec["font"], "size": scale_value(spec["font"]["size"])}
+    if "min_size" in spec["font"]:
+        scaled["font"]["min_size"] = scale_value(spec["font"]["min_size"])
+    for key in ("line_spacing", "button_padding", "button_spacing"):
+        if key in spec:
+            scaled[key] = int(spec[key] * scale)
+    return scaled
+
+
+def compile_layouts(specs):
+    """
+    Compile layout specs.
+
+    Args:
+        specs (dict): Layout specs by name, in the format of LAYOUT_SPECS.
+
+    Raises:
+        ValueError: If a slot of a layout does not fit in its canvas.
+
+    Returns:
+        dict: The compiled layouts by name.
+    """
+    return {name: CompiledLayout(name, spec) for name, spec in specs.items()}
+
+
+def load_layout_specs(path):
+    """
+    Load additional layout specs from a JSON file, in the format of LAYOUT_SPECS.
+
+    Args:
+        path (str): The path of the JSON file.
+
+    Returns:
+        dict: The layout specs by name.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+# Layouts are compiled once, when the module is first imported
+COMPILED_LAYOUTS = compile_layouts(LAYOUT_SPECS)
+
+
+def register_layouts(specs):
+    """
+    Compile layout specs and make them available by name, replacing layouts with the same name.
+
+    Args:
+        specs (dict): Layout specs by name, in the format of LAYOUT_SPECS.
+    """
+    COMPILED_LAYOUTS.update(compile_layouts(specs))
+
+
+def get_layout(name):
+    """
+    Look up a compiled layout.
+
+    Args:
+        name (str): The name of the layout.
+
+    Raises:
+        KeyError: If the layout is unknown.
+
+    Returns:
+        CompiledLayout: The compiled layout.
+    """
+    return COMPILED_LAYOUTS[name]
+
+
+def get_diffusion_target(layout_names):
+    """
+    Find the diffusion resolution that serves several layouts from a single generated image.
+
+    Args:
+        layout_names (iterable): The names of the layouts.
+
+    Returns:
+        tuple: The (width, height) covering every image slot and the maximum longer side of the diffused image,
+            None when any of the layouts does not limit it.
+    """
+    layouts = [get_layout(name) for name in layout_names]
+    target_size = (max(layout.image_size[0] for layout in layouts), max(layout.image_size[1] for layout in layouts))
+    max_sides = [layout.diffusion_max_side for layout in layouts]
+    max_side = None if None in max_sides else max(max_sides)
+    return target_size, max_side
+
+
+def get_logo_target(layout_names):
+    """
+    Find the logo resolution that serves several layouts.
+
+    Args:
+        layout_names (iterable): The names of the layouts.
+
+    Returns:
+        tuple: The (width, height) covering every logo slot.
+    """
+    layouts = [get_layout(name) for name in layout_names]
+    return max(layout.logo_size[0] for layout in layouts), max(layout.logo_size[1] for layout in layouts)
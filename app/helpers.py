@@ -1,3 +1,19 @@
+import io
+import os
+import json
+import zipfile
+from PIL import Image
+
+# Output encoders selectable per request: the Pillow format name and the media type of the response
+IMAGE_FORMATS = {
+    "png": {"format": "PNG", "media_type": "image/png"},
+    "jpeg": {"format": "JPEG", "media_type": "image/jpeg"},
+    "webp": {"format": "WEBP", "media_type": "image/webp"},
+}
+
+# Upload formats accepted as base and logo images; MPO is the JPEG variant written by many phone cameras
+ALLOWED_UPLOAD_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "BMP", "GIF", "TIFF"}
+
 
 def is_valid_hex_color_code(color_code):
     """
@@ -14,7 +30,7 @@ def is_valid_hex_color_code(color_code):
 
 def is_valid_image(file):
     """
-    Check if the uploaded file is a valid image.
+    Check if the uploaded file is a valid image. Only the image header is parsed, the pixels are not decoded.
 
     Args:
         file (UploadFile): The uploaded file to be validated.
@@ -22,11 +38,79 @@ def is_valid_image(file):
     Returns:
         bool: True if the file is a valid image, False otherwise.
     """
+    image_format, _ = get_image_header(file.file)
+    return image_format in ALLOWED_UPLOAD_FORMATS
+
+
+def get_upload_size(file):
+    """
+    Get the size of an uploaded file without reading it.
+
+    Args:
+        file (UploadFile): The uploaded file.
+
+    Returns:
+        int: The size of the file in bytes.
+    """
+    return get_file_size(file.file)
+
+
+def get_file_size(fileobj):
+    """
+    Get the size of a file object without reading it. The file is rewound afterwards.
+
+    Args:
+        fileobj (file-like object): The file.
+
+    Returns:
+        int: The size of the file in bytes.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+def get_image_header(fileobj):
+    """
+    Read the format and dimensions of an image from its header.
+
+    Args:
+        fileobj (file-like object): The encoded image, positioned anywhere; it is rewound afterwards.
+
+    Returns:
+        tuple: The Pillow format name and the (width, height) of the image, or (None, None) if the file is not
+            a readable image.
+    """
     try:
-        file.read()
-        return True
+        fileobj.seek(0)
+        with Image.open(fileobj) as image:
+            return image.format, image.size
     except Exception:
-        return False
+        return None, None
+    finally:
+        fileobj.seek(0)
+
+
+def decode_image(fileobj, draft_size=None):
+    """
+    Decode an image, at reduced resolution when possible.
+
+    Args:
+        fileobj (file-like object): The encoded image.
+        draft_size (tuple, optional): The (width, height) the image is going to be displayed at. JPEG images are
+            then decoded with Pillow's draft mode directly at the smallest 1/2, 1/4 or 1/8 scale that still covers
+            this size, which skips most of the decoding work for large photos.
+
+    Returns:
+        PIL.Image.Image: The decoded image.
+    """
+    fileobj.seek(0)
+    image = Image.open(fileobj)
+    if draft_size is not None:
+        image.draft(image.mode, draft_size)
+    image.load()
+    return image
 
 
 def is_valid_text(text):
@@ -40,3 +124,97 @@ def is_valid_text(text):
         bool: True if the text is valid, False otherwise.
     """
     return bool(text.strip())
+
+
+def is_valid_output_format(output_format, compression_level, quality):
+    """
+    Check if the requested output encoder and its settings are valid.
+
+    Args:
+        output_format (str): The requested output format.
+        compression_level (int): The requested PNG compression level.
+        quality (int): The requested JPEG/WebP quality.
+
+    Returns:
+        bool: True if the output settings are valid, False otherwise.
+    """
+    return output_format in IMAGE_FORMATS and 0 <= compression_level <= 9 and 1 <= quality <= 100
+
+
+def encode_image(image, output_format="png", compression_level=1, quality=90):
+    """
+    Encode an image into an in-memory buffer.
+
+    Args:
+        image (PIL.Image.Image): The image to be encoded.
+        output_format (str): One of IMAGE_FORMATS (default is "png").
+        compression_level (int): The zlib compression level of PNG output, from 0 (fastest) to 9 (smallest).
+            Defaults to 1, which is several times faster than Pillow's default of 6 for slightly larger files.
+        quality (int): The quality of JPEG and WebP output, from 1 to 100 (default is 90).
+
+    Returns:
+        bytes: The encoded image.
+    """
+    pillow_format = IMAGE_FORMATS[output_format]["format"]
+    buffer = io.BytesIO()
+    if pillow_format == "PNG":
+        image.save(buffer, format=pillow_format, compress_level=compression_level)
+    else:
+        image.save(buffer, format=pillow_format, quality=quality)
+    return buffer.getvalue()
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    A write-only, non-seekable buffer whose content is taken out piece by piece while it is being written.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip_stream(entries):
+    """
+    Build a zip archive incrementally, yielding its bytes as the entries come in.
+
+    The entries are stored without compression, as encoded images do not compress any further.
+
+    Args:
+        entries (iterable): (file name, content bytes) pairs, consumed lazily.
+
+    Yields:
+        bytes: The next part of the zip archive.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for name, content in entries:
+            archive.writestr(name, content)
+            yield buffer.take()
+    yield buffer.take()
+
+
+def format_server_sent_event(event, data):
+    """
+    Format a Server-Sent Event with a JSON payload.
+
+    Args:
+        event (str): The name of the event.
+        data (dict): The payload of the event.
+
+    Returns:
+        bytes: The event, terminated by the blank line that dispatches it.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
@@ -0,0 +1,416 @@
+import bisect
+import contextvars
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Bucket upper bounds of the stage durations, in seconds, from sub-millisecond image work to long diffusion runs
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+
+class Histogram:
+    """
+    A Prometheus histogram with cumulative buckets, optionally split by one label.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        label (str or None): The name of the label the observations are split by.
+        buckets (tuple): The upper bounds of the buckets, in increasing order.
+    """
+
+    def __init__(self, name, documentation, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        """
+        Record an observation.
+
+        Args:
+            value (float): The observed value.
+            label_value (str, optional): The value of the label, when the histogram has one.
+        """
+        with self._lock:
+            series = self._series.setdefault(label_value, {"counts": [0] * len(self.buckets), "sum": 0.0,
+                                                           "count": 0})
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        """
+        Render the histogram in the Prometheus text format.
+
+        Returns:
+            list: The lines of the metric.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items(), key=lambda item: str(item[0])):
+                labels = f'{self.label}="{label_value}",' if self.label else ""
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {series["count"]}')
+                suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+                lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+                lines.append(f"{self.name}_count{suffix} {series['count']}")
+        return lines
+
+
+def render_metric(name, documentation, values, metric_type="gauge", label=None):
+    """
+    Render a gauge or counter in the Prometheus text format.
+
+    Args:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        values (float or dict): The value of the metric, or its values by label value when `label` is given.
+        metric_type (str, optional): "gauge" or "counter" (default is "gauge").
+        label (str, optional): The name of the label the values are split by.
+
+    Returns:
+        list: The lines of the metric.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    if label is None:
+        lines.append(f"{name} {values}")
+    else:
+        lines.extend(f'{name}{{{label}="{label_value}"}} {value}' for label_value, value in values.items())
+    return lines
+
+
+def render_bucket_counts(name, documentation, counts):
+    """
+    Render a histogram of integer observations, e.g. batch sizes, from the number of times each value was seen.
+
+    Args:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        counts (dict): The number of observations per value.
+
+    Returns:
+        list: The lines of the metric.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} histogram"]
+    cumulative = 0
+    for value in sorted(counts):
+        cumulative += counts[value]
+        lines.append(f'{name}_bucket{{le="{value}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+    lines.append(f"{name}_sum {sum(value * count for value, count in counts.items())}")
+    lines.append(f"{name}_count {cumulative}")
+    return lines
+
+
+def get_peak_rss_bytes():
+    """
+    Return the peak resident memory of the process, in bytes, or None where it cannot be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StartupProgress:
+    """
+    The progress of the background warm-up run at startup, reported by the readiness probe.
+
+    Attributes:
+        status (str): "warming_up", "ready" or "failed".
+        stages (dict): The time spent in each finished warm-up stage, in seconds, in order.
+        current_stage (str or None): The stage running now.
+        error (str or None): The error the warm-up failed with.
+    """
+
+    def __init__(self):
+        self.status = "warming_up"
+        self.stages = {}
+        self.current_stage = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as a warm-up stage.
+
+        Args:
+            name (str): The stage name.
+        """
+        self.current_stage = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name] = time.perf_counter() - start
+                self.current_stage = None
+
+    def succeed(self):
+        """
+        Mark the warm-up as done.
+        """
+        self.status = "ready"
+
+    def fail(self, exc):
+        """
+        Mark the warm-up as failed.
+
+        Args:
+            exc (Exception): The error the warm-up failed with.
+        """
+        self.error = str(exc) or type(exc).__name__
+        self.status = "failed"
+
+    @property
+    def ready(self):
+        """
+        bool: True once the warm-up is done.
+        """
+        return self.status == "ready"
+
+    def to_dict(self):
+        """
+        Describe the warm-up state.
+
+        Returns:
+            dict: The status, the running stage, the stage timings in seconds, the total time and the error.
+        """
+        with self._lock:
+            stages = dict(self.stages)
+        return {"status": self.status,
+                "current_stage": self.current_stage,
+                "stages": stages,
+                "total_seconds": sum(stages.values()),
+                "error": self.error}
+
+
+# The duration of every stage of a request, across all requests
+STAGE_DURATION = Histogram("ad_stage_duration_seconds", "Time spent in each stage of ad generation.", label="stage")
+
+# Bucket upper bounds of the peak device memory of a request, in bytes, from 256 MiB to 80 GiB
+MEMORY_BUCKETS = tuple(2 ** exponent for exponent in range(28, 36)) + (80 * 2 ** 30,)
+
+# The peak device memory of the diffusion batches every request took part in
+PEAK_DEVICE_MEMORY = Histogram("ad_request_peak_device_memory_bytes",
+                               "Peak device memory allocated while the diffusion batches of a request ran.",
+                               buckets=MEMORY_BUCKETS)
+
+
+class RequestTimings:
+    """
+    The stage timings of a single request, reported in its Server-Timing header.
+
+    Attributes:
+        stages (dict): The total time spent in each stage, in seconds, in the order the stages were first seen.
+        profiles (list or None): The cProfile profiles collected for the request, None when profiling is off.
+        peak_device_memory_bytes (int or None): The highest peak device memory of the diffusion batches the request
+            took part in, None when it was not measured.
+    """
+
+    def __init__(self, profile=False):
+        self.stages = {}
+        self.profiles = [] if profile else None
+        self.peak_device_memory_bytes = None
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        """
+        Add time spent in a stage. Stages entered several times, e.g. once per layout, are summed up.
+        """
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_peak_memory(self, peak_bytes):
+        """
+        Record the peak device memory of work done for the request, keeping the highest.
+        """
+        with self._lock:
+            self.peak_device_memory_bytes = max(self.peak_device_memory_bytes or 0, peak_bytes)
+
+    def add_profile(self, profile):
+        """
+        Collect a cProfile profile of work done for the request.
+        """
+        with self._lock:
+            self.profiles.append(profile)
+
+    def server_timing(self, total_seconds=None):
+        """
+        Format the timings as a Server-Timing header value, in milliseconds.
+
+        Args:
+            total_seconds (float, optional): The total duration of the request, reported as the "total" metric.
+
+        Returns:
+            str: The header value.
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+        if total_seconds is not None:
+            stages.append(("total", total_seconds))
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)
+
+    def profile_report(self, limit=60):
+        """
+        Render the collected profiles as a pstats report sorted by cumulative time.
+
+        Args:
+            limit (int, optional): The number of functions listed.
+
+        Returns:
+            str: The report, or an empty string when nothing was profiled.
+        """
+        with self._lock:
+            profiles = list(self.profiles or [])
+        if not profiles:
+            return ""
+        stream = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request(profile=False):
+    """
+    Start collecting the stage timings of the request handled in the current context.
+
+    Args:
+        profile (bool, optional): Also profile the work run through `profiled` for this request.
+
+    Returns:
+        RequestTimings: The timings of the request.
+    """
+    timings = RequestTimings(profile=profile)
+    _request_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    """
+    Return the timings of the request handled in the current context, or None outside of a request.
+    """
+    return _request_timings.get()
+
+
+def record_stage(stage, seconds, timings=None):
+    """
+    Record time spent in a stage, in the stage histogram and in the timings of the request.
+
+    Args:
+        stage (str): The stage name.
+        seconds (float): The time spent.
+        timings (RequestTimings, optional): The request timings to add to; defaults to the current request.
+    """
+    STAGE_DURATION.observe(seconds, stage)
+    timings = timings if timings is not None else current_timings()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    """
+    Time the enclosed block as a stage of the current request.
+
+    Args:
+        stage (str): The stage name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def stage_recorder():
+    """
+    Bind the timings of the current request to a callback, for stages timed on threads outside of its context,
+    such as the batch dispatcher of the diffusion pipeline.
+
+    Returns:
+        callable: Called as callback(stage, seconds).
+    """
+    timings = current_timings()
+    return lambda stage, seconds: record_stage(stage, seconds, timings)
+
+
+def record_peak_memory(peak_bytes, timings=None):
+    """
+    Record the peak device memory of a diffusion batch, in the memory histogram and in the timings of the request.
+
+    Args:
+        peak_bytes (int): The peak device memory allocated while the batch ran.
+        timings (RequestTimings, optional): The request timings to add to; defaults to the current request.
+    """
+    PEAK_DEVICE_MEMORY.observe(peak_bytes)
+    timings = timings if timings is not None else current_timings()
+    if timings is not None:
+        timings.add_peak_memory(peak_bytes)
+
+
+def memory_recorder():
+    """
+    Bind the timings of the current request to a callback reporting the peak device memory of its diffusion
+    batches, which run outside of its context.
+
+    Returns:
+        callable: Called as callback(peak_bytes).
+    """
+    timings = current_timings()
+    return lambda peak_bytes: record_peak_memory(peak_bytes, timings)
+
+
+def profiled(fn):
+    """
+    Wrap a function so that it runs under cProfile when the current request asked to be profiled.
+
+    cProfile only sees the thread it is enabled on, so work handed over to other threads, like the batched
+    pipeline call, shows up as waiting time in the report.
+
+    Args:
+        fn (callable): The function to wrap; it is called on the current thread.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    def wrapper(*args, **kwargs):
+        timings = current_timings()
+        if timings is None or timings.profiles is None:
+            return fn(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            timings.add_profile(profile)
+
+    return wrapper
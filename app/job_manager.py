@@ -0,0 +1,201 @@
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job cannot be queued because the job queue is full.
+
+    Attributes:
+        retry_after (int): The number of seconds after which a retry is likely to be accepted.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"The job queue is full, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class Job:
+    """
+    A unit of work queued on a JobManager.
+
+    Attributes:
+        job_id (str): The unique identifier of the job.
+        status (str): One of "queued", "running", "succeeded" or "failed".
+        step (int): The last completed denoising step.
+        total_steps (int or None): The number of denoising steps, once known.
+        result (object): The value returned by the job function, set when the job succeeded.
+        error (str or None): The error message, set when the job failed.
+        error_status (int or None): The HTTP status of the error, set when the job failed.
+        created_at (float): The time the job was submitted.
+        finished_at (float or None): The time the job succeeded or failed.
+    """
+
+    def __init__(self):
+        self.job_id = uuid.uuid4().hex
+        self.status = "queued"
+        self.step = 0
+        self.total_steps = None
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def progress(self):
+        """
+        float: The fraction of denoising steps completed, 1.0 once the job succeeded.
+        """
+        if self.status == "succeeded":
+            return 1.0
+        if not self.total_steps:
+            return 0.0
+        return min(self.step / self.total_steps, 1.0)
+
+    def report_progress(self, step, total_steps):
+        """
+        Record the progress of the job. Passed as the step callback of the diffusion process.
+
+        Args:
+            step (int): The last completed denoising step.
+            total_steps (int): The total number of denoising steps.
+        """
+        self.step = step
+        self.total_steps = total_steps
+
+    def to_dict(self):
+        """
+        Describe the job state.
+
+        Returns:
+            dict: The job ID, status, progress, step count, error and error status of the job.
+        """
+        return {"job_id": self.job_id,
+                "status": self.status,
+                "progress": self.progress,
+                "step": self.step,
+                "total_steps": self.total_steps,
+                "error": self.error,
+                "error_status": self.error_status}
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded pool of worker threads and keeps their results for a limited time.
+
+    Queued jobs hold their inputs, e.g. the uploaded images, until they run, so the number of jobs queued or running
+    is bounded and jobs beyond it are rejected with `JobQueueFull`.
+
+    Attributes:
+        max_workers (int): The number of jobs that run concurrently.
+        result_ttl_seconds (float): How long a finished job and its result are kept.
+        max_queued (int or None): The number of jobs queued or running at once, None for an unbounded queue.
+        describe_error (callable or None): Called as describe_error(exc) with the exception of a failed job;
+            returns the (HTTP status, message) the job reports, so that internal error details are not exposed.
+            None reports the exception message with status 500.
+    """
+
+    def __init__(self, max_workers=2, result_ttl_seconds=600, max_queued=None, describe_error=None):
+        self.max_workers = max_workers
+        self.result_ttl_seconds = result_ttl_seconds
+        self.max_queued = max_queued
+        self.describe_error = describe_error
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self._jobs = {}
+        self._pending = 0
+        self._mean_run_seconds = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a job. The job function receives the job's progress reporter as the `step_callback` keyword.
+
+        Args:
+            fn (callable): The function to run.
+            *args: Positional arguments for `fn`.
+            **kwargs: Keyword arguments for `fn`.
+
+        Raises:
+            JobQueueFull: If `max_queued` jobs are already queued or running.
+
+        Returns:
+            Job: The queued job.
+        """
+        self._purge_expired()
+
+        job = Job()
+        with self._lock:
+            if self.max_queued is not None and self._pending >= self.max_queued:
+                raise JobQueueFull(self._retry_after())
+            self._jobs[job.job_id] = job
+            self._pending += 1
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """
+        Look up a job.
+
+        Args:
+            job_id (str): The job identifier.
+
+        Returns:
+            Job or None: The job, or None if it is unknown or its result has expired.
+        """
+        self._purge_expired()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_depth(self):
+        """
+        Return the number of jobs that are queued or running.
+        """
+        with self._lock:
+            return self._pending
+
+    def shutdown(self):
+        """
+        Stop accepting jobs and wait for the running ones to finish.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        start = time.monotonic()
+        try:
+            job.result = fn(*args, step_callback=job.report_progress, **kwargs)
+            job.status = "succeeded"
+        except Exception as exc:
+            if self.describe_error is not None:
+                job.error_status, job.error = self.describe_error(exc)
+            else:
+                job.error_status, job.error = 500, str(exc) or type(exc).__name__
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            run_seconds = time.monotonic() - start
+            with self._lock:
+                self._pending -= 1
+                # Exponential moving average of the job run time, for the Retry-After estimates
+                if self._mean_run_seconds is None:
+                    self._mean_run_seconds = run_seconds
+                else:
+                    self._mean_run_seconds += 0.2 * (run_seconds - self._mean_run_seconds)
+
+    def _retry_after(self):
+        # Every job queued or running finishes before a retry would start
+        mean_run_seconds = self._mean_run_seconds or 1.0
+        return max(1, math.ceil(mean_run_seconds * self._pending / self.max_workers))
+
+    def _purge_expired(self):
+        expiry = time.time() - self.result_ttl_seconds
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < expiry]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -1,18 +1,46 @@
 # Third-party libraries
 import io
+import os
+import re
+import json
+import time
+import base64
+import functools
+import threading
+import contextvars
+import asyncio
 import uvicorn
-import nest_asyncio
 from PIL import Image
-from pyngrok import conf
-from pyngrok import ngrok
-from fastapi.responses import FileResponse
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, Header, UploadFile, HTTPException, Query, Request
 
 # Custom functions
+from config import *
 from helpers import *
-from stable_diffusion.stable_diffusor import StableDiffusor
+from job_manager import JobManager, JobQueueFull
+from admission import (AdmissionController, CancellationToken, Overloaded, PassThroughAdmission, PRIORITY_CLASSES,
+                       RequestCancelled)
+from instrumentation import (PEAK_DEVICE_MEMORY, STAGE_DURATION, StartupProgress, get_peak_rss_bytes, memory_recorder,
+                             profiled, render_bucket_counts, render_metric, span, stage_recorder, start_request)
+from asset_store import AssetStore
+from worker_pool import WorkerPool
+from bulk_jobs import BulkJobRunner, LocalFileResolver
+from result_cache import ResultCache, make_cache_key, file_digest
+from stable_diffusion.stable_diffusor import GenerationCancelled, StableDiffusor
+from stable_diffusion.backends import configure_threads
+from stable_diffusion.lazy_imports import preload_modules
+from stable_diffusion.memory import DeviceOutOfMemory, get_peak_device_memory
+from stable_diffusion.pipeline_registry import PipelineRegistry, load_img2img_pipeline
+from stable_diffusion.latent_cache import LatentCache
+from stable_diffusion.prompt_cache import PromptEmbeddingCache
+from stable_diffusion.schedulers import QUALITY_TIERS, resolve_quality_tier, effective_steps
 from dynamic_template.dynamic_template_creator import DynamicTemplate
+from dynamic_template.layouts import (COMPILED_LAYOUTS, get_diffusion_target, get_logo_target, load_layout_specs,
+                                      register_layouts)
 
 # Initiating a FastAPI instance sets the stage for crafting APIs with Python's efficiency.
 app = FastAPI()
@@ -27,120 +55,1809 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+# A single registry keeps the diffusion weights resident and shares them across requests
+pipeline_registry = PipelineRegistry(
+    memory_budget_bytes=PIPELINE_MEMORY_BUDGET_MB * 1024 * 1024 if PIPELINE_MEMORY_BUDGET_MB else None,
+    loader=functools.partial(load_img2img_pipeline, snapshot_dir=MODEL_SNAPSHOT_DIR or None)
+)
+# Reused positive and negative prompts are encoded once and served from the embedding cache
+prompt_embedding_cache = PromptEmbeddingCache(max_bytes=PROMPT_CACHE_MEMORY_MB * 1024 * 1024)
+# Reused base images and colors start denoising from their cached latents, skipping the color filter and the VAE
+latent_cache = LatentCache(max_bytes=LATENT_CACHE_MEMORY_MB * 1024 * 1024) if LATENT_CACHE_MEMORY_MB else None
+stable_diffusor = StableDiffusor(model_id_or_path=MODEL_ID_OR_PATH,
+                                 device=MODEL_DEVICE,
+                                 torch_dtype=MODEL_DTYPE,
+                                 registry=pipeline_registry,
+                                 max_batch_size=MAX_BATCH_SIZE,
+                                 max_batch_wait_ms=MAX_BATCH_WAIT_MS,
+                                 prompt_cache=prompt_embedding_cache,
+                                 latent_cache=latent_cache,
+                                 memory_mode=MEMORY_MODE,
+                                 memory_budget_bytes=DEVICE_MEMORY_BUDGET_MB * 1024 * 1024
+                                 if DEVICE_MEMORY_BUDGET_MB else None,
+                                 channels_last=CHANNELS_LAST,
+                                 compile_unet=TORCH_COMPILE,
+                                 tensor_preprocessing=TENSOR_PREPROCESSING)
+
+# Requests waiting for the diffusion process are bounded, and interactive ones are served before bulk ones
+admission_controller = AdmissionController(max_concurrent=ADMISSION_MAX_CONCURRENT,
+                                           max_queued={"interactive": ADMISSION_MAX_QUEUED_INTERACTIVE,
+                                                       "bulk": ADMISSION_MAX_QUEUED_BULK})
+
+# Identical ad specs are served from the cache instead of paying for the diffusion process again
+result_cache = ResultCache(max_memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+                           disk_dir=RESULT_CACHE_DIR or None,
+                           max_disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024)
+
+# Logos and base images uploaded once are referenced by ID, along with images derived from them
+asset_store = AssetStore(ASSET_STORE_DIR, max_derivative_bytes=ASSET_DERIVATIVE_CACHE_MB * 1024 * 1024)
+
+# Template variants are rendered concurrently on their own pool, separate from the diffusion workers
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="template-renderer")
+
+# Jobs run the diffusion process on a bounded pool of worker threads, off the event loop
+# Failed jobs report the status and detail the synchronous endpoint would answer with, not the raw exception
+job_manager = JobManager(max_workers=JOB_WORKERS, result_ttl_seconds=JOB_RESULT_TTL_SECONDS,
+                         max_queued=JOB_MAX_QUEUED, describe_error=lambda exc: describe_job_error(exc))
+
+# Extra layouts are compiled along with the built-in ones, once, before the first request
+if LAYOUTS_FILE:
+    register_layouts(load_layout_specs(LAYOUTS_FILE))
+
+
+# The progress of the background warm-up, reported by `/readyz`
+startup_progress = StartupProgress()
+
+
+@app.on_event("startup")
+def start_warm_up():
+    """
+    Start the warm-up in the background, so that the server answers its probes while the model loads.
+    """
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def warm_up():
+    """
+    Bring the service up to speed before it reports ready: load the diffusion pipeline and run it once, or start
+    the worker processes doing so each in worker pool mode.
+    """
+    try:
+        if worker_pool is None:
+            warm_up_pipeline(startup_progress)
+        else:
+            with startup_progress.stage("worker_warm_up"):
+                worker_pool.start()
+                worker_pool.wait_ready()
+        startup_progress.succeed()
+    except Exception as exc:
+        startup_progress.fail(exc)
+
+
+def warm_up_pipeline(progress, num_threads=None):
+    """
+    Size the CPU thread pools, import the heavy dependencies, load the diffusion pipeline and run a dummy generation
+    through it at the size of the default layout, so that the first request finds the weights resident and the
+    allocator, the kernel autotuning and the first-call code paths warmed up.
+
+    Args:
+        progress (StartupProgress): Records the time spent in each stage.
+        num_threads (int, optional): The intra-op threads; defaults to CPU_INTRA_OP_THREADS, or the CPU quota.
+    """
+    with progress.stage("imports"):
+        # Before torch is imported, so that every thread picks the setting up
+        configure_threads(num_threads or CPU_INTRA_OP_THREADS, CPU_INTER_OP_THREADS)
+        preload_modules()
+
+    with progress.stage("pipeline_load"), span("pipeline_load"):
+        stable_diffusor.create_pipeline()
+
+    if WARMUP_STEPS:
+        with progress.stage("warm_up_inference"):
+            target_size, max_side = get_diffusion_target([DEFAULT_LAYOUT])
+            # With full strength every inference step is run
+            stable_diffusor.generate_similar_image_by_color(base_image=Image.new("RGB", target_size, "gray"),
+                                                            positive_prompt="",
+                                                            negative_prompt="",
+                                                            strength=1.0,
+                                                            steps=WARMUP_STEPS,
+                                                            seed=0,
+                                                            target_size=target_size,
+                                                            max_side=max_side)
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    """
+    Stop the worker processes once they finished their tasks.
+    """
+    if worker_pool is not None:
+        worker_pool.shutdown()
+
+
+def init_worker(device, num_threads):
+    """
+    Prepare a worker process of the worker pool: pin it to its device and thread budget and warm up its pipeline.
+
+    Args:
+        device (str): The device the pipeline of the worker runs on.
+        num_threads (int): The number of CPU threads of the worker.
+    """
+    global worker_pool, admission_controller
+    # The tasks handed to a worker run in the worker itself, and were admitted by the API process already
+    worker_pool = None
+    admission_controller = PassThroughAdmission()
+    stable_diffusor.device = device
+    warm_up_pipeline(StartupProgress(), num_threads=num_threads)
+
+
+# In worker pool mode, worker processes hold the pipelines and do the diffusion, rendering and encoding work
+worker_pool = None
+if WORKER_PROCESSES:
+    worker_pool = WorkerPool(initializer=init_worker,
+                             num_workers=WORKER_PROCESSES,
+                             devices=WORKER_DEVICES,
+                             threads_per_worker=WORKER_CPU_THREADS,
+                             concurrency=WORKER_CONCURRENCY)
+
+
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    """
+    Collect the stage timings of every request and report them in its Server-Timing header, along with the peak
+    device memory of its diffusion batches in the X-Peak-Device-Memory header, in bytes, when it was measured.
+
+    When profiling is enabled, requests sent with an "X-Profile: 1" header are answered with a cProfile report of
+    their work instead of their result, and their original status in the X-Profiled-Status header.
+    """
+    profile = PROFILING_ENABLED and request.headers.get("X-Profile") == "1"
+    timings = start_request(profile=profile)
+    start = time.perf_counter()
+    response = await call_next(request)
+
+    if profile:
+        # Drain the response so that the report covers all of its work, including streamed results
+        async for _ in response.body_iterator:
+            pass
+        response = PlainTextResponse(timings.profile_report(),
+                                     headers={"X-Profiled-Status": str(response.status_code)})
+
+    response.headers["Server-Timing"] = timings.server_timing(time.perf_counter() - start)
+    if timings.peak_device_memory_bytes is not None:
+        response.headers["X-Peak-Device-Memory"] = str(timings.peak_device_memory_bytes)
+    return response
+
+
+def validate_upload_image(file, name):
+    """
+    Validate an uploaded image from its size and header, before any pixel is decoded.
+
+    Args:
+        file (UploadFile): The uploaded image.
+        name (str): The name of the upload, used in error messages.
+
+    Raises:
+        HTTPException: If the upload is not a valid image or exceeds the byte or pixel limits.
+    """
+    validate_image_file(file.file, name)
+
+
+def validate_image_file(fileobj, name):
+    """
+    Validate an encoded image from its size and header, before any pixel is decoded.
+
+    Args:
+        fileobj (file-like object): The encoded image.
+        name (str): The name of the image, used in error messages.
+
+    Raises:
+        HTTPException: If the file is not a valid image or exceeds the byte or pixel limits.
+    """
+    if get_file_size(fileobj) > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413,
+                            detail=f"Invalid {name}. Please provide an image file of at most {MAX_UPLOAD_MB} MB.")
+
+    image_format, size = get_image_header(fileobj)
+    if image_format not in ALLOWED_UPLOAD_FORMATS:
+        raise HTTPException(status_code=422, detail=f"Invalid {name}. Please provide a valid image file.")
+
+    width, height = size
+    if width * height > MAX_UPLOAD_MEGAPIXELS * 1000 * 1000:
+        raise HTTPException(status_code=413,
+                            detail=f"Invalid {name}. Please provide an image of at most "
+                                   f"{MAX_UPLOAD_MEGAPIXELS} megapixels.")
+
+
+def validate_image_source(upload, asset_id, name):
+    """
+    Validate an image given either as an upload or as the ID of a stored asset.
+
+    Args:
+        upload (UploadFile or None): The uploaded image.
+        asset_id (str): The asset ID, or an empty string.
+        name (str): The name of the image, used in error messages.
+
+    Raises:
+        HTTPException: If neither or both are given, the upload is invalid or the asset is unknown.
+    """
+    if (upload is None) == (not asset_id):
+        raise HTTPException(status_code=422, detail=f"Invalid {name}. Please provide either {name} or {name}_asset.")
+
+    if upload is not None:
+        validate_upload_image(upload, name)
+    elif not asset_store.exists(asset_id):
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid {name}_asset. Please provide the ID of an uploaded asset.")
+
+
+def validate_ad_template_inputs(base_image,
+                                base_image_color,
+                                logo_image,
+                                punchline_text,
+                                punchline_text_color,
+                                button_text,
+                                button_text_color,
+                                base_image_asset="",
+                                logo_image_asset=""):
+    """
+    Validate the user inputs of an ad template request.
+
+    Raises:
+        HTTPException: If any of the inputs is invalid.
+    """
+    # Check if base_image_color is a valid hexadecimal color code
+    if not is_valid_hex_color_code(base_image_color):
+        raise HTTPException(status_code=422,
+                            detail="Invalid base_image_color. Please provide a valid hexadecimal color code.")
+
+    # Check if punchline_text_color is a valid hexadecimal color code
+    if not is_valid_hex_color_code(punchline_text_color):
+        raise HTTPException(status_code=422,
+                            detail="Invalid punchline_text_color. Please provide a valid hexadecimal color code.")
+
+    # Check if button_text_color is a valid hexadecimal color code
+    if not is_valid_hex_color_code(button_text_color):
+        raise HTTPException(status_code=422,
+                            detail="Invalid button_text_color. Please provide a valid hexadecimal color code.")
+
+    # Check if base_image and logo_image are valid images within the upload limits, reading only their headers,
+    # or stored assets
+    validate_image_source(base_image, base_image_asset, "base_image")
+    validate_image_source(logo_image, logo_image_asset, "logo_image")
+
+    # Check if text inputs are valid
+    if not is_valid_text(punchline_text):
+        raise HTTPException(status_code=422,
+                            detail="Invalid punchline_text. Please provide a valid non-empty text.")
+
+    if not is_valid_text(button_text):
+        raise HTTPException(status_code=422, detail="Invalid button_text. Please provide a valid non-empty text.")
+
+
+def parse_template_variants(variants, base_image_color):
+    """
+    Parse and validate the template variants of a multi-variant request.
+
+    Args:
+        variants (str): A JSON list of objects with the punchline_text, punchline_text_color, button_text and
+            button_text_color of each variant, and optionally its own base_image_color and name.
+        base_image_color (str): The color used by variants that do not set their own.
+
+    Raises:
+        HTTPException: If the variants are malformed or any of their values is invalid.
+
+    Returns:
+        list: One dictionary per variant, with every field filled in.
+    """
+    try:
+        parsed_variants = json.loads(variants)
+    except ValueError:
+        parsed_variants = None
+
+    if not isinstance(parsed_variants, list) or not 0 < len(parsed_variants) <= MAX_TEMPLATE_VARIANTS:
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid variants. Please provide a JSON list of 1 to {MAX_TEMPLATE_VARIANTS} "
+                                   f"template variants.")
+
+    template_variants = []
+    for index, variant in enumerate(parsed_variants):
+        if not isinstance(variant, dict):
+            raise HTTPException(status_code=422, detail=f"Invalid variant {index}. Please provide a JSON object.")
+
+        template_variant = {"name": re.sub(r"[^\w.-]", "_", str(variant.get("name", f"variant_{index}"))),
+                            "base_image_color": variant.get("base_image_color", base_image_color)}
+        for field in ("punchline_text", "punchline_text_color", "button_text", "button_text_color"):
+            template_variant[field] = variant.get(field, "")
+        for field in ("base_image_color", "punchline_text_color", "button_text_color"):
+            if not isinstance(template_variant[field], str) or not is_valid_hex_color_code(template_variant[field]):
+                raise HTTPException(status_code=422,
+                                    detail=f"Invalid {field} in variant {index}. "
+                                           f"Please provide a valid hexadecimal color code.")
+        for field in ("punchline_text", "button_text"):
+            if not isinstance(template_variant[field], str) or not is_valid_text(template_variant[field]):
+                raise HTTPException(status_code=422,
+                                    detail=f"Invalid {field} in variant {index}. "
+                                           f"Please provide a valid non-empty text.")
+        template_variants.append(template_variant)
+
+    return template_variants
+
+
+def validate_output_format(output_format, compression_level, image_quality):
+    """
+    Validate the output encoder settings of a request.
+
+    Raises:
+        HTTPException: If the output format or its settings are invalid.
+    """
+    if not is_valid_output_format(output_format, compression_level, image_quality):
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid output settings. Please provide a format among "
+                                   f"{', '.join(IMAGE_FORMATS)}, a compression_level from 0 to 9 and an "
+                                   f"image_quality from 1 to 100.")
+
+
+def validate_layouts(layouts):
+    """
+    Validate the layouts of a request.
+
+    Args:
+        layouts (list): The names of the layouts to render.
+
+    Raises:
+        HTTPException: If no layout is given or any of them is unknown.
+
+    Returns:
+        list: The layout names, without duplicates.
+    """
+    layouts = list(dict.fromkeys(layouts))
+    if not layouts or any(layout not in COMPILED_LAYOUTS for layout in layouts):
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid layouts. Please provide one or more of: {', '.join(COMPILED_LAYOUTS)}.")
+    return layouts
+
+
+def get_media_type(output_format, layouts):
+    """
+    Return the media type of an encoded result: the image itself for a single layout, a zip archive otherwise.
+    """
+    return IMAGE_FORMATS[output_format]["media_type"] if len(layouts) == 1 else "application/zip"
+
+
+def resolve_generation_steps(quality, steps):
+    """
+    Resolve the inference steps and scheduler of a request.
+
+    Args:
+        quality (str): The quality tier, or an empty string to use `steps` with the default scheduler.
+        steps (int): The number of inference steps requested explicitly.
+
+    Raises:
+        HTTPException: If the quality tier is unknown.
+
+    Returns:
+        tuple: The number of inference steps and the scheduler name.
+    """
+    if not quality:
+        return steps, "default"
+    try:
+        return resolve_quality_tier(quality)
+    except ValueError:
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid quality. Please provide one of: {', '.join(QUALITY_TIERS)}.")
+
+
+def validate_priority(priority):
+    """
+    Validate the priority class of a request.
+
+    Raises:
+        HTTPException: If the priority class is unknown.
+    """
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=422,
+                            detail=f"Invalid X-Priority. Please provide one of: {', '.join(PRIORITY_CLASSES)}.")
+
+
+def create_cancellation_token(deadline_ms):
+    """
+    Create the cancellation token of a request from its deadline.
+
+    Args:
+        deadline_ms (int or None): The milliseconds the client is willing to wait for the result, None for no
+            deadline.
+
+    Raises:
+        HTTPException: If the deadline is not positive.
+
+    Returns:
+        CancellationToken: The cancellation token of the request.
+    """
+    if deadline_ms is not None and deadline_ms <= 0:
+        raise HTTPException(status_code=422, detail="Invalid X-Deadline-Ms. Please provide a positive duration.")
+    return CancellationToken(deadline_ms / 1000 if deadline_ms is not None else None)
+
+
+async def watch_disconnect(request, cancellation):
+    """
+    Cancel the work of a request once its client disconnects. Runs until the request is cancelled or the task
+    is cancelled itself.
+
+    Args:
+        request (Request): The request.
+        cancellation (CancellationToken): The cancellation token of the request.
+    """
+    while not cancellation.is_cancelled():
+        if await request.is_disconnected():
+            cancellation.cancel("disconnected")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+
+def admission_http_exception(exc, cancellation):
+    """
+    Translate an admission rejection or a cancellation into its HTTP error.
+
+    Args:
+        exc (Exception): The Overloaded, RequestCancelled or GenerationCancelled error.
+        cancellation (CancellationToken): The cancellation token of the request.
+
+    Returns:
+        HTTPException: 429 with a Retry-After header when the queue is full, 504 when the deadline passed, and
+            499 when the client disconnected.
+    """
+    if isinstance(exc, Overloaded):
+        return HTTPException(status_code=429, detail="Too many requests. Please retry later.",
+                             headers={"Retry-After": str(exc.retry_after)})
+    if cancellation.reason == "deadline":
+        return HTTPException(status_code=504, detail="The deadline passed before the ad template was generated.")
+    return HTTPException(status_code=499, detail="Client closed the request.")
+
+
+def generation_http_exception(exc, cancellation):
+    """
+    Translate an error of the generation into the HTTP error the endpoints answer with.
+
+    Args:
+        exc (Exception): The error.
+        cancellation (CancellationToken): The cancellation token of the request.
+
+    Returns:
+        HTTPException: The HTTP error.
+    """
+    if isinstance(exc, HTTPException):
+        return exc
+    if isinstance(exc, (Overloaded, RequestCancelled, GenerationCancelled)):
+        return admission_http_exception(exc, cancellation)
+    if isinstance(exc, DeviceOutOfMemory):
+        return HTTPException(status_code=503, detail="Not enough device memory for this image. Please retry later "
+                                                     "or with a smaller image.")
+    return HTTPException(status_code=500, detail="Internal Server Error. Please try again later.")
+
+
+def describe_job_error(exc):
+    """
+    Translate the error of a failed job into the HTTP error the synchronous endpoint would answer with.
+
+    Args:
+        exc (Exception): The error.
+
+    Returns:
+        tuple: The HTTP status and detail of the error.
+    """
+    http_exception = generation_http_exception(exc, CancellationToken())
+    return http_exception.status_code, http_exception.detail
+
+
+def generate_result_image(base_image_obj,
+                          base_image_color,
+                          positive_prompt,
+                          negative_prompt,
+                          strength,
+                          guidance_scale,
+                          steps,
+                          seed=None,
+                          scheduler="default",
+                          step_callback=None,
+                          layouts=(DEFAULT_LAYOUT,),
+                          base_image_asset=None,
+                          priority="interactive",
+                          cancellation=None,
+                          base_image_digest=None,
+                          preview_callback=None,
+                          preview_every=PREVIEW_EVERY_STEPS):
+    """
+    Run the diffusion process on the base image, once for all layouts, at a resolution covering the image slot of
+    every layout. The request waits for its turn in the admission queue of its priority class first.
+
+    Args:
+        base_image_obj (PIL.Image.Image): The main image for the template, None when `base_image_asset` is given.
+        step_callback (callable, optional): Called as step_callback(step, total_steps) after every denoising step.
+        layouts (iterable): The names of the layouts the image is rendered into.
+        base_image_asset (str, optional): The asset ID of the main image. Its color filtered version is cached in
+            the asset store and reused by later requests with the same color and layouts.
+        priority (str, optional): The priority class of the request, one of PRIORITY_CLASSES.
+        cancellation (CancellationToken, optional): Stops the generation once the request is given up on.
+        base_image_digest (bytes, optional): The SHA-256 digest of the encoded main image, which its cached latents
+            are looked up by. Defaults to `base_image_asset`, which is the digest of the asset.
+        preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) with a low
+            resolution approximation of the image every `preview_every` denoising steps.
+        preview_every (int, optional): The number of denoising steps between two previews.
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Raises:
+        Overloaded: If the admission queue of the priority class is full.
+        RequestCancelled: If the request was cancelled while it waited for its turn.
+        GenerationCancelled: If the request was cancelled during the diffusion process.
+        DeviceOutOfMemory: If the image does not fit in the device memory.
+
+    Returns:
+        PIL.Image.Image: The generated image.
+    """
+    with admission_controller.admit(priority, cancellation):
+        target_size, max_side = get_diffusion_target(layouts)
+        base_image_digest = base_image_digest or base_image_asset
+
+        if worker_pool is not None:
+            # The color filter and the diffusion process run in a worker process
+            if base_image_obj is None:
+                base_image_obj = get_asset_image(base_image_asset, draft_size=target_size)
+            return worker_pool.run(run_result_image_task,
+                                   {"base_image": base_image_obj},
+                                   step_callback=step_callback,
+                                   cancellation=cancellation,
+                                   preview_callback=preview_callback,
+                                   preview_every=preview_every,
+                                   base_image_color=base_image_color,
+                                   positive_prompt=positive_prompt,
+                                   negative_prompt=negative_prompt,
+                                   strength=strength,
+                                   guidance_scale=guidance_scale,
+                                   steps=steps,
+                                   seed=seed,
+                                   scheduler=scheduler,
+                                   layouts=list(layouts),
+                                   priority=priority,
+                                   base_image_digest=base_image_digest)
+
+        prepared_base_image = None
+        if base_image_asset is not None:
+            def color_filter():
+                base_image = get_asset_image(base_image_asset, draft_size=target_size)
+                with span("color_filter"):
+                    return stable_diffusor.prepare_base_image(base_image,
+                                                              hex_code=base_image_color,
+                                                              target_size=target_size,
+                                                              max_side=max_side)
+
+            prepared_base_image = asset_store.get_derivative(base_image_asset,
+                                                             "color_filtered",
+                                                             color_filter,
+                                                             hex_code=base_image_color,
+                                                             target_size=target_size,
+                                                             max_side=max_side)
+
+        # Generate similar image using color
+        return stable_diffusor.generate_similar_image_by_color(base_image=base_image_obj,
+                                                               positive_prompt=positive_prompt,
+                                                               negative_prompt=negative_prompt,
+                                                               hex_code=base_image_color,
+                                                               strength=strength,
+                                                               guidance_scale=guidance_scale,
+                                                               steps=steps,
+                                                               seed=seed,
+                                                               scheduler=scheduler,
+                                                               target_size=target_size,
+                                                               max_side=max_side,
+                                                               step_callback=step_callback,
+                                                               prepared_base_image=prepared_base_image,
+                                                               stage_callback=stage_recorder(),
+                                                               is_cancelled=cancellation.is_cancelled
+                                                               if cancellation is not None else None,
+                                                               memory_callback=memory_recorder(),
+                                                               base_image_digest=base_image_digest,
+                                                               preview_callback=preview_callback,
+                                                               preview_every=preview_every)
+
+
+def render_ad_template(result_image, logo_image_obj, punchline_text, punchline_text_color, button_text,
+                       button_text_color, layout=DEFAULT_LAYOUT):
+    """
+    Render the ad template around a generated image.
+
+    Args:
+        result_image (PIL.Image.Image): The output of `generate_result_image`, resized to the image slot.
+        logo_image_obj (PIL.Image.Image): The logo image to be included in the template.
+        layout (str): The name of the layout to render.
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Returns:
+        PIL.Image.Image: The ad template.
+    """
+    # Create the ad template using user inputs
+    dynamic_template_creator = DynamicTemplate(layout)
+    with span("render"):
+        return dynamic_template_creator.generate_dynamic_ad_template(
+            result_image=result_image,
+            logo_image=logo_image_obj,
+            punchline_text=punchline_text,
+            punchline_text_color=punchline_text_color,
+            button_text=button_text,
+            button_text_color=button_text_color,
+        )
+
+
+def render_preview_template(preview_image, logo_image_obj, punchline_text, punchline_text_color, button_text,
+                            button_text_color, layout=DEFAULT_LAYOUT, scale=PREVIEW_SCALE):
+    """
+    Render a low resolution preview of the ad template around a preview of the image being generated.
+
+    Args:
+        preview_image (PIL.Image.Image): The preview of the generated image, as reported by `generate_result_image`.
+        logo_image_obj (PIL.Image.Image): The logo image to be included in the template.
+        layout (str): The name of the layout to render.
+        scale (float): The size of the preview relative to the layout.
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Returns:
+        bytes: The JPEG encoded preview.
+    """
+    dynamic_template_creator = DynamicTemplate(layout, scale=scale)
+    with span("preview"):
+        preview = dynamic_template_creator.generate_dynamic_ad_template(
+            result_image=preview_image,
+            logo_image=logo_image_obj,
+            punchline_text=punchline_text,
+            punchline_text_color=punchline_text_color,
+            button_text=button_text,
+            button_text_color=button_text_color,
+        )
+        return encode_image(preview, output_format="jpeg", quality=PREVIEW_QUALITY)
+
+
+def create_ad_template(base_image_obj,
+                       base_image_color,
+                       positive_prompt,
+                       negative_prompt,
+                       strength,
+                       guidance_scale,
+                       steps,
+                       logo_image_obj,
+                       punchline_text,
+                       punchline_text_color,
+                       button_text,
+                       button_text_color,
+                       seed=None,
+                       scheduler="default",
+                       step_callback=None,
+                       layouts=(DEFAULT_LAYOUT,),
+                       base_image_asset=None,
+                       priority="interactive",
+                       cancellation=None,
+                       base_image_digest=None,
+                       preview_callback=None,
+                       preview_every=PREVIEW_EVERY_STEPS):
+    """
+    Generate the ad template in every layout. Runs the diffusion process, so it must be called off the event loop.
+
+    Args:
+        base_image_obj (PIL.Image.Image): The main image for the template.
+        logo_image_obj (PIL.Image.Image): The logo image to be included in the template.
+        step_callback (callable, optional): Called as step_callback(step, total_steps) after every denoising step.
+        layouts (iterable): The names of the layouts to render.
+        base_image_asset (str, optional): The asset ID of the main image, used instead of `base_image_obj`.
+        priority (str, optional): The priority class of the request, one of PRIORITY_CLASSES.
+        cancellation (CancellationToken, optional): Stops the generation once the request is given up on.
+        base_image_digest (bytes, optional): The SHA-256 digest of the encoded main image.
+        preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) with a low
+            resolution approximation of the generated image every `preview_every` denoising steps.
+        preview_every (int, optional): The number of denoising steps between two previews.
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Returns:
+        list: (layout name, PIL.Image.Image) pairs with the generated ad template in every layout, in order.
+    """
+    result_image = generate_result_image(base_image_obj=base_image_obj,
+                                         base_image_color=base_image_color,
+                                         positive_prompt=positive_prompt,
+                                         negative_prompt=negative_prompt,
+                                         strength=strength,
+                                         guidance_scale=guidance_scale,
+                                         steps=steps,
+                                         seed=seed,
+                                         scheduler=scheduler,
+                                         step_callback=step_callback,
+                                         layouts=layouts,
+                                         base_image_asset=base_image_asset,
+                                         priority=priority,
+                                         cancellation=cancellation,
+                                         base_image_digest=base_image_digest,
+                                         preview_callback=preview_callback,
+                                         preview_every=preview_every)
+
+    def render(layout):
+        return layout, render_ad_template(result_image=result_image,
+                                          logo_image_obj=logo_image_obj,
+                                          punchline_text=punchline_text,
+                                          punchline_text_color=punchline_text_color,
+                                          button_text=button_text,
+                                          button_text_color=button_text_color,
+                                          layout=layout)
+
+    # A single layout is rendered in place, several concurrently on the render pool, each in a copy of the
+    # request context so that their timings are reported with the request
+    if len(layouts) == 1:
+        return [render(layouts[0])]
+    futures = [render_executor.submit(contextvars.copy_context().run, render, layout) for layout in layouts]
+    return [future.result() for future in futures]
+
+
+def encode_ad_templates(add_templates, output_format, compression_level, image_quality):
+    """
+    Encode the ad templates of every layout.
+
+    Args:
+        add_templates (list): (layout name, PIL.Image.Image) pairs, as returned by `create_ad_template`.
+        output_format (str): The output encoder, one of IMAGE_FORMATS.
+        compression_level (int): The PNG compression level.
+        image_quality (int): The JPEG/WebP quality.
+
+    Returns:
+        list: (file name, bytes) pairs, one per layout.
+    """
+    with span("encode"):
+        return [(f"{layout}.{output_format}", encode_image(add_template,
+                                                           output_format=output_format,
+                                                           compression_level=compression_level,
+                                                           quality=image_quality))
+                for layout, add_template in add_templates]
+
+
+def run_ad_template_task(images, output_format, compression_level, image_quality, **kwargs):
+    """
+    Worker pool task generating and encoding the ad template in every layout.
+
+    Args:
+        images (dict): The decoded "base_image" and "logo_image".
+        output_format (str): The output encoder, one of IMAGE_FORMATS.
+        compression_level (int): The PNG compression level.
+        image_quality (int): The JPEG/WebP quality.
+        **kwargs: The remaining arguments of `create_ad_template`.
+
+    Returns:
+        list: (file name, bytes) pairs, one per layout.
+    """
+    add_templates = create_ad_template(base_image_obj=images["base_image"],
+                                       logo_image_obj=images["logo_image"],
+                                       **kwargs)
+    return encode_ad_templates(add_templates, output_format, compression_level, image_quality)
+
+
+def run_result_image_task(images, **kwargs):
+    """
+    Worker pool task running the diffusion process on the decoded "base_image". Takes the arguments of
+    `generate_result_image`.
+
+    Returns:
+        PIL.Image.Image: The generated image.
+    """
+    return generate_result_image(base_image_obj=images["base_image"], **kwargs)
+
+
+def get_asset_image(asset_id, draft_size=None):
+    """
+    Decode a stored image asset, once per draft size.
+
+    Args:
+        asset_id (str): The asset ID.
+        draft_size (tuple, optional): The (width, height) the image is going to be displayed at.
+
+    Returns:
+        PIL.Image.Image: The decoded image, shared with other requests.
+    """
+    def decode():
+        with asset_store.open(asset_id) as file, span("decode"):
+            return decode_image(file, draft_size=draft_size)
+
+    return asset_store.get_derivative(asset_id, "decoded", decode, draft_size=draft_size)
+
+
+def load_logo_image(logo_image_file, logo_image_asset, layouts):
+    """
+    Load the logo image at about the size of the logo slots of the layouts.
+
+    Args:
+        logo_image_file (file-like object or None): The encoded logo image.
+        logo_image_asset (str or None): The asset ID of the logo image, used when no file is given. The logo is
+            then resized to the logo slot once and reused by later requests.
+        layouts (iterable): The names of the layouts the logo is rendered into.
+
+    Returns:
+        PIL.Image.Image: The logo image.
+    """
+    logo_size = get_logo_target(layouts)
+    if logo_image_file is not None:
+        with span("decode"):
+            return decode_image(logo_image_file, draft_size=logo_size)
+
+    return asset_store.get_derivative(logo_image_asset,
+                                      "logo",
+                                      lambda: get_asset_image(logo_image_asset, draft_size=logo_size).resize(logo_size),
+                                      size=logo_size)
+
+
+def create_ad_template_encoded(base_image_file=None,
+                               logo_image_file=None,
+                               output_format="png",
+                               compression_level=PNG_COMPRESSION_LEVEL,
+                               image_quality=IMAGE_QUALITY,
+                               step_callback=None,
+                               layouts=(DEFAULT_LAYOUT,),
+                               base_image_asset=None,
+                               logo_image_asset=None,
+                               priority="interactive",
+                               cancellation=None,
+                               preview_callback=None,
+                               preview_every=PREVIEW_EVERY_STEPS,
+                               **params):
+    """
+    Generate the ad template image and encode it in memory, going through the result cache.
+
+    Identical requests, i.e. the same image bytes and parameters, are answered from the cache, and concurrent
+    identical requests share a single generation. Asset IDs are the digests of the asset bytes, so a request
+    referencing an asset shares its cache entries with one uploading the same image. Requests without a seed ask
+    for a new random generation, so they are never answered from the cache.
+
+    Args:
+        base_image_file (file-like object, optional): The encoded main image.
+        logo_image_file (file-like object, optional): The encoded logo image.
+        output_format (str): The output encoder, one of IMAGE_FORMATS.
+        compression_level (int): The PNG compression level.
+        image_quality (int): The JPEG/WebP quality.
+        step_callback (callable, optional): Called as step_callback(step, total_steps) after every denoising step.
+        layouts (list): The names of the layouts to render.
+        base_image_asset (str, optional): The asset ID of the main image, used when no file is given.
+        logo_image_asset (str, optional): The asset ID of the logo image, used when no file is given.
+        priority (str, optional): The priority class of the request, one of PRIORITY_CLASSES.
+        cancellation (CancellationToken, optional): Stops the generation once the request is given up on.
+        preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) with a low
+            resolution approximation of the generated image every `preview_every` denoising steps. Results served
+            from the cache, or shared with an identical request already in progress, report no previews.
+        preview_every (int, optional): The number of denoising steps between two previews.
+        **params: The remaining arguments of `create_ad_template`.
+
+    Returns:
+        bytes: The encoded ad template for a single layout, or a zip archive with one encoded template per layout.
+    """
+    # The digest of the main image keys the result cache here and the latent cache in the diffusion process
+    base_image_digest = file_digest(base_image_file) if base_image_file is not None \
+        else bytes.fromhex(base_image_asset)
+
+    def generate():
+        # Decode the uploads straight at about the size they are displayed at
+        base_image_obj = None
+        if base_image_file is not None:
+            with span("decode"):
+                base_image_obj = decode_image(base_image_file, draft_size=get_diffusion_target(layouts)[0])
+        logo_image_obj = load_logo_image(logo_image_file, logo_image_asset, layouts)
+
+        if worker_pool is None:
+            add_templates = create_ad_template(base_image_obj=base_image_obj,
+                                               logo_image_obj=logo_image_obj,
+                                               step_callback=step_callback,
+                                               layouts=layouts,
+                                               base_image_asset=None if base_image_file is not None
+                                               else base_image_asset,
+                                               priority=priority,
+                                               cancellation=cancellation,
+                                               base_image_digest=base_image_digest,
+                                               preview_callback=preview_callback,
+                                               preview_every=preview_every,
+                                               **params)
+            encoded = encode_ad_templates(add_templates, output_format, compression_level, image_quality)
+        else:
+            # The decoded images go to a worker process, which diffuses, renders and encodes them
+            if base_image_obj is None:
+                base_image_obj = get_asset_image(base_image_asset, draft_size=get_diffusion_target(layouts)[0])
+            with admission_controller.admit(priority, cancellation):
+                encoded = worker_pool.run(run_ad_template_task,
+                                          {"base_image": base_image_obj, "logo_image": logo_image_obj},
+                                          step_callback=step_callback,
+                                          cancellation=cancellation,
+                                          preview_callback=preview_callback,
+                                          preview_every=preview_every,
+                                          output_format=output_format,
+                                          compression_level=compression_level,
+                                          image_quality=image_quality,
+                                          layouts=list(layouts),
+                                          priority=priority,
+                                          base_image_digest=base_image_digest,
+                                          **params)
+        if len(encoded) == 1:
+            return encoded[0][1]
+        return b"".join(iter_zip_stream(encoded))
+
+    cache_key = make_cache_key(base_image_digest,
+                               file_digest(logo_image_file) if logo_image_file is not None
+                               else bytes.fromhex(logo_image_asset),
+                               model_id=MODEL_ID_OR_PATH,
+                               output_format=output_format,
+                               compression_level=compression_level,
+                               image_quality=image_quality,
+                               layouts=list(layouts),
+                               **params)
+    while True:
+        try:
+            return result_cache.get_or_compute(cache_key, generate, cached=params.get("seed") is not None)
+        except (RequestCancelled, GenerationCancelled):
+            # A generation shared with a request that gave up on it is started over, unless this one gave up too
+            if cancellation is not None and cancellation.is_cancelled():
+                raise
+
+
+def create_ad_template_job_result(output_format="png", layouts=(DEFAULT_LAYOUT,), **kwargs):
+    """
+    Job function generating an encoded ad template. Takes the arguments of `create_ad_template_encoded`.
+
+    Returns:
+        tuple: The encoded ad template and its media type.
+    """
+    content = create_ad_template_encoded(output_format=output_format, layouts=layouts, **kwargs)
+    return content, get_media_type(output_format, layouts)
+
+
+def prepare_bulk_spec(spec):
+    """
+    Validate an entry of a bulk manifest and resolve it into the arguments of `create_ad_template_encoded`.
+
+    Args:
+        spec (dict): The ad spec: `base_image` and `logo_image` references along with the arguments of the
+            `ad_template_creator` endpoint, which take the same defaults.
+
+    Raises:
+        HTTPException: If any of the values is invalid.
+
+    Returns:
+        dict: The generation arguments of the entry.
+    """
+    for field in ("base_image", "logo_image"):
+        if not isinstance(spec.get(field), str) or not spec[field]:
+            raise HTTPException(status_code=422, detail=f"Invalid {field}. Please provide an image reference.")
+
+    params = {"base_image_color": spec.get("base_image_color", ""),
+              "positive_prompt": spec.get("positive_prompt", ""),
+              "negative_prompt": spec.get("negative_prompt", ""),
+              "strength": float(spec.get("strength", 0.5)),
+              "guidance_scale": float(spec.get("guidance_scale", 7.5)),
+              "punchline_text": spec.get("punchline_text", ""),
+              "punchline_text_color": spec.get("punchline_text_color", ""),
+              "button_text": spec.get("button_text", ""),
+              "button_text_color": spec.get("button_text_color", ""),
+              "seed": None if spec.get("seed") is None else int(spec["seed"])}
+
+    for field in ("base_image_color", "punchline_text_color", "button_text_color"):
+        if not isinstance(params[field], str) or not is_valid_hex_color_code(params[field]):
+            raise HTTPException(status_code=422,
+                                detail=f"Invalid {field}. Please provide a valid hexadecimal color code.")
+    for field in ("punchline_text", "button_text"):
+        if not isinstance(params[field], str) or not is_valid_text(params[field]):
+            raise HTTPException(status_code=422, detail=f"Invalid {field}. Please provide a valid non-empty text.")
+
+    params["steps"], params["scheduler"] = resolve_generation_steps(spec.get("quality", ""),
+                                                                    int(spec.get("steps", 25)))
+    params["layouts"] = validate_layouts(spec.get("layouts", [DEFAULT_LAYOUT]))
+    return params
+
+
+def run_bulk_entry(base_image_file, logo_image_file, **kwargs):
+    """
+    Generate the encoded ad template of a bulk manifest entry. Takes the arguments of `create_ad_template_encoded`.
+
+    Raises:
+        HTTPException: If any of the images is invalid.
+
+    Returns:
+        tuple: The encoded ad template and its media type.
+    """
+    validate_image_file(base_image_file, "base_image")
+    validate_image_file(logo_image_file, "logo_image")
+    return create_ad_template_job_result(base_image_file=base_image_file,
+                                         logo_image_file=logo_image_file,
+                                         priority="bulk",
+                                         **kwargs)
+
+
+local_file_resolver = LocalFileResolver(BULK_LOCAL_ROOT or None)
+
+
+def resolve_bulk_image(reference):
+    """
+    Resolve an image reference of a bulk manifest: the ID of a stored asset, or else a local path.
+
+    Returns:
+        file-like object: The encoded image, opened for binary reading.
+    """
+    if asset_store.exists(reference):
+        return asset_store.open(reference)
+    return local_file_resolver(reference)
+
+
+# Bulk manifests go through the same pipeline, batching and result cache as single requests
+bulk_job_runner = BulkJobRunner(prepare_spec=prepare_bulk_spec,
+                                run_spec=run_bulk_entry,
+                                resolve_image=resolve_bulk_image,
+                                jobs_dir=BULK_JOBS_DIR,
+                                max_in_flight=BULK_MAX_IN_FLIGHT,
+                                group_window=BULK_GROUP_WINDOW)
+
 
 @app.post("/ad_template_creator")
 async def ad_template_creator(
-        base_image: UploadFile = File(...),
+        request: Request,
+        base_image: Optional[UploadFile] = File(None),
         base_image_color: str = "",
         positive_prompt: str = "",
         negative_prompt: str = "",
         strength: float = 0.5,
         guidance_scale: float = 7.5,
         steps: int = 25,
-        logo_image: UploadFile = File(...),
+        quality: str = "",
+        logo_image: Optional[UploadFile] = File(None),
         punchline_text: str = "",
         punchline_text_color: str = "",
         button_text: str = "",
         button_text_color: str = "",
-) -> FileResponse:
+        seed: Optional[int] = None,
+        output_format: str = Query("png", alias="format"),
+        compression_level: int = PNG_COMPRESSION_LEVEL,
+        image_quality: int = IMAGE_QUALITY,
+        layouts: List[str] = Query([DEFAULT_LAYOUT]),
+        base_image_asset: str = "",
+        logo_image_asset: str = "",
+        x_deadline_ms: Optional[int] = Header(None),
+        x_priority: str = Header("interactive"),
+) -> Response:
     """
     Create a dynamic ad template based on user inputs.
 
+    Generation goes through the admission queue: when the queue is full the request is rejected right away with
+    429 and a Retry-After header. The generation is cancelled, mid-denoising if need be, once the deadline given in
+    the X-Deadline-Ms header passes or the client disconnects.
+
     Args:
-        base_image (UploadFile): The main image for the template.
+        request (Request): The request, watched for client disconnects.
+        base_image (UploadFile, optional): The main image for the template. Required unless `base_image_asset`
+            is given.
         base_image_color (str): The color code used for image manipulation.
         positive_prompt (str): The positive prompt for image generation.
         negative_prompt (str): The negative prompt for image generation.
         strength (float, optional): The strength parameter for the diffusion process (default is 0.5).
         guidance_scale (float, optional): The scale parameter for guidance in the diffusion process (default is 7.5).
-        steps (int, optional): The number of steps in the diffusion process (default is 25).
-        logo_image (UploadFile): The logo image to be included in the template.
+        steps (int, optional): The number of inference steps in the diffusion process (default is 25).
+        quality (str, optional): The quality tier, one of "draft", "standard" or "high". Overrides `steps` with
+            the tier's number of inference steps and scheduler (default is to use `steps`).
+        logo_image (UploadFile, optional): The logo image to be included in the template. Required unless
+            `logo_image_asset` is given.
         punchline_text (str): The punchline text to be displayed in the template.
         punchline_text_color (str): The color code for the punchline text.
         button_text (str): The text for the button in the template.
         button_text_color (str): The color code for the button text.
+        seed (int, optional): The seed of the diffusion process. Identical inputs with the same seed produce the
+            same template (default is a random seed).
+        output_format (str, optional): The output encoder, passed as `format`: "png", "jpeg" or "webp"
+            (default is "png").
+        compression_level (int, optional): The PNG compression level from 0 to 9 (default is 1, favoring speed).
+        image_quality (int, optional): The JPEG/WebP quality from 1 to 100 (default is 90).
+        layouts (list, optional): The layouts to render from the single generated image, e.g. "classic", "square",
+            "landscape" or "story" (default is "classic").
+        base_image_asset (str, optional): The ID of an asset uploaded to `/assets`, used instead of `base_image`.
+        logo_image_asset (str, optional): The ID of an asset uploaded to `/assets`, used instead of `logo_image`.
+        x_deadline_ms (int, optional): The X-Deadline-Ms header, the milliseconds the client is willing to wait for
+            the result (default is no deadline).
+        x_priority (str, optional): The X-Priority header, the priority class of the request, "interactive" or
+            "bulk" (default is "interactive").
 
     Raises:
-        HTTPException: If any validation fails or an internal server error occurs.
+        HTTPException: If any validation fails, the admission queue is full (429), the deadline passed (504), the
+            client disconnected (499), the image does not fit in the device memory (503) or an internal server
+            error occurs.
 
     Returns:
-        FileResponse: The generated ad template file.
+        Response: The encoded ad template, or a zip archive with one template per layout when several are
+            requested, with the inference steps, the denoising steps actually run and the scheduler in the
+            X-Inference-Steps, X-Effective-Steps and X-Scheduler headers, and the time spent in each stage in the
+            Server-Timing header.
     """
 
     try:
-        # Check if base_image_color is a valid hexadecimal color code
-        if not is_valid_hex_color_code(base_image_color):
-            raise HTTPException(status_code=422,
-                                detail="Invalid base_image_color. Please provide a valid hexadecimal color code.")
+        with span("validation"):
+            validate_ad_template_inputs(base_image=base_image,
+                                        base_image_color=base_image_color,
+                                        logo_image=logo_image,
+                                        punchline_text=punchline_text,
+                                        punchline_text_color=punchline_text_color,
+                                        button_text=button_text,
+                                        button_text_color=button_text_color,
+                                        base_image_asset=base_image_asset,
+                                        logo_image_asset=logo_image_asset)
+            validate_output_format(output_format, compression_level, image_quality)
+            layouts = validate_layouts(layouts)
+            steps, scheduler = resolve_generation_steps(quality, steps)
+            validate_priority(x_priority)
+            cancellation = create_cancellation_token(x_deadline_ms)
 
-        # Check if punchline_text_color is a valid hexadecimal color code
-        if not is_valid_hex_color_code(punchline_text_color):
-            raise HTTPException(status_code=422,
-                                detail="Invalid punchline_text_color. Please provide a valid hexadecimal color code.")
+        # Generate the template on a worker thread so that the event loop keeps serving other requests, and watch
+        # the client meanwhile so that the generation stops if it goes away
+        watcher = asyncio.ensure_future(watch_disconnect(request, cancellation))
+        try:
+            add_template_bytes = await run_in_threadpool(profiled(create_ad_template_encoded),
+                                                         base_image_file=base_image.file if base_image else None,
+                                                         logo_image_file=logo_image.file if logo_image else None,
+                                                         base_image_asset=base_image_asset or None,
+                                                         logo_image_asset=logo_image_asset or None,
+                                                         output_format=output_format,
+                                                         compression_level=compression_level,
+                                                         image_quality=image_quality,
+                                                         base_image_color=base_image_color,
+                                                         positive_prompt=positive_prompt,
+                                                         negative_prompt=negative_prompt,
+                                                         strength=strength,
+                                                         guidance_scale=guidance_scale,
+                                                         steps=steps,
+                                                         punchline_text=punchline_text,
+                                                         punchline_text_color=punchline_text_color,
+                                                         button_text=button_text,
+                                                         button_text_color=button_text_color,
+                                                         seed=seed,
+                                                         scheduler=scheduler,
+                                                         layouts=layouts,
+                                                         priority=x_priority,
+                                                         cancellation=cancellation)
+        finally:
+            watcher.cancel()
 
-        # Check if button_text_color is a valid hexadecimal color code
-        if not is_valid_hex_color_code(button_text_color):
-            raise HTTPException(status_code=422,
-                                detail="Invalid button_text_color. Please provide a valid hexadecimal color code.")
+        headers = {"X-Inference-Steps": str(steps),
+                   "X-Effective-Steps": str(effective_steps(steps, strength)),
+                   "X-Scheduler": scheduler}
+        # The encoded bytes are sent straight from memory; the response sets their Content-Length
+        return Response(content=add_template_bytes,
+                        media_type=get_media_type(output_format, layouts),
+                        headers=headers)
 
-        # Check if base_image is a valid image
-        if not is_valid_image(base_image):
-            raise HTTPException(status_code=422, detail="Invalid base_image. Please provide a valid image file.")
+    except Exception as exc:
+        raise generation_http_exception(exc, cancellation)
 
-        # Check if logo_image is a valid image
-        if not is_valid_image(logo_image):
-            raise HTTPException(status_code=422, detail="Invalid logo_image. Please provide a valid image file.")
 
-        # Check if text inputs are valid
-        if not is_valid_text(punchline_text):
-            raise HTTPException(status_code=422,
-                                detail="Invalid punchline_text. Please provide a valid non-empty text.")
+async def copy_upload(file):
+    """
+    Copy an upload into memory, for work that outlives the request and its temporary upload file.
 
-        if not is_valid_text(button_text):
-            raise HTTPException(status_code=422, detail="Invalid button_text. Please provide a valid non-empty text.")
+    Args:
+        file (UploadFile): The uploaded file.
 
-        # Read and process base image
-        contents_base = await base_image.read()
-        base_image_obj = Image.open(io.BytesIO(contents_base))
+    Returns:
+        io.BytesIO: The content of the upload.
+    """
+    with span("upload_read"):
+        return io.BytesIO(await file.read())
 
-        # Read logo image
-        contents_logo = await logo_image.read()
-        logo_image_obj = Image.open(io.BytesIO(contents_logo))
 
-        # Generate similar image using color
-        stable_diffusor = StableDiffusor()
-        result_image = stable_diffusor.generate_similar_image_by_color(base_image=base_image_obj,
-                                                                       positive_prompt=positive_prompt,
-                                                                       negative_prompt=negative_prompt,
-                                                                       hex_code=base_image_color,
-                                                                       strength=strength,
-                                                                       guidance_scale=guidance_scale,
-                                                                       steps=steps)
-
-        # Create the ad template using user inputs
-        dynamic_template_creator = DynamicTemplate()
-        add_template = dynamic_template_creator.generate_dynamic_ad_template(
-            result_image=result_image,
-            logo_image=logo_image_obj,
-            punchline_text=punchline_text,
-            punchline_text_color=punchline_text_color,
-            button_text=button_text,
-            button_text_color=button_text_color,
-        )
+@app.post("/ad_template_creator/stream")
+async def ad_template_creator_stream(
+        request: Request,
+        base_image: Optional[UploadFile] = File(None),
+        base_image_color: str = "",
+        positive_prompt: str = "",
+        negative_prompt: str = "",
+        strength: float = 0.5,
+        guidance_scale: float = 7.5,
+        steps: int = 25,
+        quality: str = "",
+        logo_image: Optional[UploadFile] = File(None),
+        punchline_text: str = "",
+        punchline_text_color: str = "",
+        button_text: str = "",
+        button_text_color: str = "",
+        seed: Optional[int] = None,
+        output_format: str = Query("png", alias="format"),
+        compression_level: int = PNG_COMPRESSION_LEVEL,
+        image_quality: int = IMAGE_QUALITY,
+        layouts: List[str] = Query([DEFAULT_LAYOUT]),
+        base_image_asset: str = "",
+        logo_image_asset: str = "",
+        preview_every: int = PREVIEW_EVERY_STEPS,
+        preview_scale: float = PREVIEW_SCALE,
+        x_deadline_ms: Optional[int] = Header(None),
+        x_priority: str = Header("interactive"),
+) -> StreamingResponse:
+    """
+    Create a dynamic ad template, streaming low resolution previews of it while it is generated.
+
+    The response is a stream of Server-Sent Events. While the image is denoised, a "preview" event is sent every
+    `preview_every` steps with the step, the total steps and the template of the first layout rendered around an
+    approximation of the image, as a JPEG data URI. The stream ends with a "result" event holding the encoded
+    template like `ad_template_creator` returns it, or an "error" event with the HTTP status and detail that
+    endpoint would answer with. Previews the client is too slow to take are skipped, and closing the stream
+    cancels the generation, so abandoned previews free up the device.
+
+    Args:
+        preview_every (int, optional): The number of denoising steps between two previews (default is 5).
+        preview_scale (float, optional): The size of the previews relative to the layout, from 0 to 1 (default is
+            0.5).
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Raises:
+        HTTPException: If any validation fails, before the stream starts.
+
+    Returns:
+        StreamingResponse: The "text/event-stream" of previews followed by the result. The payload of the "result"
+            event holds the base64 encoded template in "content", along with its "media_type" and the
+            "inference_steps", "effective_steps" and "scheduler" of the X- headers of `ad_template_creator`.
+    """
+    with span("validation"):
+        validate_ad_template_inputs(base_image=base_image,
+                                    base_image_color=base_image_color,
+                                    logo_image=logo_image,
+                                    punchline_text=punchline_text,
+                                    punchline_text_color=punchline_text_color,
+                                    button_text=button_text,
+                                    button_text_color=button_text_color,
+                                    base_image_asset=base_image_asset,
+                                    logo_image_asset=logo_image_asset)
+        validate_output_format(output_format, compression_level, image_quality)
+        layouts = validate_layouts(layouts)
+        steps, scheduler = resolve_generation_steps(quality, steps)
+        validate_priority(x_priority)
+        cancellation = create_cancellation_token(x_deadline_ms)
+        if preview_every < 1:
+            raise HTTPException(status_code=422, detail="Invalid preview_every. Please provide a positive number "
+                                                        "of steps.")
+        if not 0 < preview_scale <= 1:
+            raise HTTPException(status_code=422, detail="Invalid preview_scale. Please provide a scale from 0 to 1.")
+
+    # The uploads outlive the request handler, which returns as soon as the stream starts
+    base_image_file = await copy_upload(base_image) if base_image else None
+    logo_image_file = await copy_upload(logo_image) if logo_image else None
+    try:
+        preview_logo = await run_in_threadpool(load_logo_image, logo_image_file, logo_image_asset or None, layouts)
+    except Exception as exc:
+        raise generation_http_exception(exc, cancellation)
+
+    loop = asyncio.get_running_loop()
+    previews = asyncio.Queue()
+
+    def on_preview(step, total_steps, image):
+        # Called on the diffusion thread; the template is rendered around the preview on the render pool instead,
+        # so that the batch it came from is not held up
+        loop.call_soon_threadsafe(previews.put_nowait, (step, total_steps, image))
+
+    async def events():
+        watcher = asyncio.ensure_future(watch_disconnect(request, cancellation))
+        generation = asyncio.ensure_future(run_in_threadpool(profiled(create_ad_template_encoded),
+                                                             base_image_file=base_image_file,
+                                                             logo_image_file=logo_image_file,
+                                                             base_image_asset=base_image_asset or None,
+                                                             logo_image_asset=logo_image_asset or None,
+                                                             output_format=output_format,
+                                                             compression_level=compression_level,
+                                                             image_quality=image_quality,
+                                                             base_image_color=base_image_color,
+                                                             positive_prompt=positive_prompt,
+                                                             negative_prompt=negative_prompt,
+                                                             strength=strength,
+                                                             guidance_scale=guidance_scale,
+                                                             steps=steps,
+                                                             punchline_text=punchline_text,
+                                                             punchline_text_color=punchline_text_color,
+                                                             button_text=button_text,
+                                                             button_text_color=button_text_color,
+                                                             seed=seed,
+                                                             scheduler=scheduler,
+                                                             layouts=layouts,
+                                                             priority=x_priority,
+                                                             cancellation=cancellation,
+                                                             preview_callback=on_preview,
+                                                             preview_every=preview_every))
+
+        def end_previews(task):
+            # Retrieve the error here, so that it is not reported as lost when the stream was closed early
+            if not task.cancelled():
+                task.exception()
+            # None marks the end of the previews
+            previews.put_nowait(None)
+
+        generation.add_done_callback(end_previews)
+        try:
+            while True:
+                preview = await previews.get()
+                # Only the newest preview is rendered when the client fell behind
+                while preview is not None and not previews.empty():
+                    preview = previews.get_nowait()
+                if preview is None:
+                    break
+
+                step, total_steps, preview_image = preview
+                content = await loop.run_in_executor(render_executor,
+                                                     contextvars.copy_context().run,
+                                                     functools.partial(render_preview_template,
+                                                                       preview_image=preview_image,
+                                                                       logo_image_obj=preview_logo,
+                                                                       punchline_text=punchline_text,
+                                                                       punchline_text_color=punchline_text_color,
+                                                                       button_text=button_text,
+                                                                       button_text_color=button_text_color,
+                                                                       layout=layouts[0],
+                                                                       scale=preview_scale))
+                yield format_server_sent_event("preview", {
+                    "step": step,
+                    "total_steps": total_steps,
+                    "image": "data:image/jpeg;base64," + base64.b64encode(content).decode("ascii"),
+                })
+
+            try:
+                add_template_bytes = generation.result()
+            except Exception as exc:
+                error = generation_http_exception(exc, cancellation)
+                yield format_server_sent_event("error", {"status": error.status_code, "detail": error.detail})
+                return
+
+            yield format_server_sent_event("result", {
+                "media_type": get_media_type(output_format, layouts),
+                "inference_steps": steps,
+                "effective_steps": effective_steps(steps, strength),
+                "scheduler": scheduler,
+                "content": base64.b64encode(add_template_bytes).decode("ascii"),
+            })
+        finally:
+            watcher.cancel()
+            # The stream was closed before the result; stop the generation rather than finishing it for nobody
+            if not generation.done():
+                cancellation.cancel("disconnected")
+
+    return StreamingResponse(events(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/ad_template_variants")
+async def ad_template_variants(
+        request: Request,
+        base_image: UploadFile = File(...),
+        base_image_color: str = "",
+        positive_prompt: str = "",
+        negative_prompt: str = "",
+        strength: float = 0.5,
+        guidance_scale: float = 7.5,
+        steps: int = 25,
+        quality: str = "",
+        logo_image: UploadFile = File(...),
+        variants: str = Form(...),
+        seed: Optional[int] = None,
+        output_format: str = Query("png", alias="format"),
+        compression_level: int = PNG_COMPRESSION_LEVEL,
+        image_quality: int = IMAGE_QUALITY,
+        layouts: List[str] = Query([DEFAULT_LAYOUT]),
+        x_deadline_ms: Optional[int] = Header(None),
+        x_priority: str = Header("interactive"),
+) -> StreamingResponse:
+    """
+    Create several ad template variants from a single generation.
+
+    The diffusion process runs once per distinct base image color among the variants, and all variants are then
+    rendered concurrently, in every requested layout, and streamed back in a zip archive as soon as each one is
+    ready. Like `ad_template_creator`, the generation goes through the admission queue and is cancelled once the
+    deadline passes or the client disconnects.
+
+    Args:
+        variants (str): A JSON list of template variants, each an object with punchline_text,
+            punchline_text_color, button_text, button_text_color and optionally base_image_color and name.
+
+        The remaining arguments are the ones of the `ad_template_creator` endpoint.
+
+    Raises:
+        HTTPException: If any validation fails, the admission queue is full (429), the deadline passed (504), the
+            client disconnected (499), the image does not fit in the device memory (503) or an internal server
+            error occurs.
+
+    Returns:
+        StreamingResponse: A zip archive with one encoded template per variant and layout, named after the variant
+            and, when several layouts are requested, the layout.
+    """
+    try:
+        with span("validation"):
+            template_variants = parse_template_variants(variants, base_image_color)
+            validate_upload_image(base_image, "base_image")
+            validate_upload_image(logo_image, "logo_image")
+            validate_output_format(output_format, compression_level, image_quality)
+            layouts = validate_layouts(layouts)
+            steps, scheduler = resolve_generation_steps(quality, steps)
+            validate_priority(x_priority)
+            cancellation = create_cancellation_token(x_deadline_ms)
+
+        def decode_uploads():
+            with span("decode"):
+                return (decode_image(base_image.file, draft_size=get_diffusion_target(layouts)[0]),
+                        decode_image(logo_image.file, draft_size=get_logo_target(layouts)),
+                        file_digest(base_image.file))
+
+        base_image_obj, logo_image_obj, base_image_digest = await run_in_threadpool(decode_uploads)
+
+        # Diffuse once per distinct color; running the colors concurrently lets them share batched pipeline calls
+        colors = sorted({variant["base_image_color"] for variant in template_variants})
+        watcher = asyncio.ensure_future(watch_disconnect(request, cancellation))
+        try:
+            result_images = await asyncio.gather(*(run_in_threadpool(generate_result_image,
+                                                                     base_image_obj=base_image_obj,
+                                                                     base_image_color=color,
+                                                                     positive_prompt=positive_prompt,
+                                                                     negative_prompt=negative_prompt,
+                                                                     strength=strength,
+                                                                     guidance_scale=guidance_scale,
+                                                                     steps=steps,
+                                                                     seed=seed,
+                                                                     scheduler=scheduler,
+                                                                     layouts=layouts,
+                                                                     priority=x_priority,
+                                                                     cancellation=cancellation,
+                                                                     base_image_digest=base_image_digest)
+                                                   for color in colors))
+        finally:
+            watcher.cancel()
+        result_images = dict(zip(colors, result_images))
+
+    except Exception as exc:
+        raise generation_http_exception(exc, cancellation)
+
+    def render_variant(entry_name, variant, layout):
+        add_template = render_ad_template(result_image=result_images[variant["base_image_color"]],
+                                          logo_image_obj=logo_image_obj,
+                                          punchline_text=variant["punchline_text"],
+                                          punchline_text_color=variant["punchline_text_color"],
+                                          button_text=variant["button_text"],
+                                          button_text_color=variant["button_text_color"],
+                                          layout=layout)
+        with span("encode"):
+            content = encode_image(add_template,
+                                   output_format=output_format,
+                                   compression_level=compression_level,
+                                   quality=image_quality)
+        return f"{entry_name}.{output_format}", content
+
+    # Render all variants on the thread pool and stream each one as soon as it is encoded. Variant names may
+    # repeat, so archive entries are prefixed with the variant position
+    futures = [render_executor.submit(contextvars.copy_context().run,
+                                      render_variant,
+                                      f"{index:03d}_{variant['name']}" + (f"_{layout}" if len(layouts) > 1 else ""),
+                                      variant,
+                                      layout)
+               for index, variant in enumerate(template_variants) for layout in layouts]
+    entries = (future.result() for future in as_completed(futures))
+
+    return StreamingResponse(iter_zip_stream(entries),
+                             media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=ad_templates.zip"})
+
+
+@app.post("/jobs", status_code=202)
+async def create_ad_template_job(
+        base_image: Optional[UploadFile] = File(None),
+        base_image_color: str = "",
+        positive_prompt: str = "",
+        negative_prompt: str = "",
+        strength: float = 0.5,
+        guidance_scale: float = 7.5,
+        steps: int = 25,
+        quality: str = "",
+        logo_image: Optional[UploadFile] = File(None),
+        punchline_text: str = "",
+        punchline_text_color: str = "",
+        button_text: str = "",
+        button_text_color: str = "",
+        seed: Optional[int] = None,
+        output_format: str = Query("png", alias="format"),
+        compression_level: int = PNG_COMPRESSION_LEVEL,
+        image_quality: int = IMAGE_QUALITY,
+        layouts: List[str] = Query([DEFAULT_LAYOUT]),
+        base_image_asset: str = "",
+        logo_image_asset: str = "",
+        x_priority: str = Header("bulk"),
+) -> dict:
+    """
+    Queue the creation of a dynamic ad template and return right away. Takes the arguments of
+    `ad_template_creator`; poll `/jobs/{job_id}` for progress and fetch `/jobs/{job_id}/result` once it succeeded.
+    Jobs go through the admission queue in the "bulk" priority class unless the X-Priority header says otherwise.
+    When JOB_MAX_QUEUED jobs are already queued or running, the job is rejected with 429 and a Retry-After header.
+
+    Raises:
+        HTTPException: If any validation fails, or the job queue is full.
 
-        # Create a temporary file path for the result image
-        result_image_path = "output.png"
+    Returns:
+        dict: The job ID and state of the queued job.
+    """
+    with span("validation"):
+        validate_ad_template_inputs(base_image=base_image,
+                                    base_image_color=base_image_color,
+                                    logo_image=logo_image,
+                                    punchline_text=punchline_text,
+                                    punchline_text_color=punchline_text_color,
+                                    button_text=button_text,
+                                    button_text_color=button_text_color,
+                                    base_image_asset=base_image_asset,
+                                    logo_image_asset=logo_image_asset)
+        validate_output_format(output_format, compression_level, image_quality)
+        layouts = validate_layouts(layouts)
+        steps, scheduler = resolve_generation_steps(quality, steps)
+        validate_priority(x_priority)
+
+    try:
+        job = job_manager.submit(create_ad_template_job_result,
+                                 base_image_file=await copy_upload(base_image) if base_image else None,
+                                 logo_image_file=await copy_upload(logo_image) if logo_image else None,
+                                 base_image_asset=base_image_asset or None,
+                                 logo_image_asset=logo_image_asset or None,
+                                 output_format=output_format,
+                                 compression_level=compression_level,
+                                 image_quality=image_quality,
+                                 base_image_color=base_image_color,
+                                 positive_prompt=positive_prompt,
+                                 negative_prompt=negative_prompt,
+                                 strength=strength,
+                                 guidance_scale=guidance_scale,
+                                 steps=steps,
+                                 punchline_text=punchline_text,
+                                 punchline_text_color=punchline_text_color,
+                                 button_text=button_text,
+                                 button_text_color=button_text_color,
+                                 seed=seed,
+                                 scheduler=scheduler,
+                                 layouts=layouts,
+                                 priority=x_priority)
+    except JobQueueFull as exc:
+        raise HTTPException(status_code=429, detail="Too many queued jobs. Please retry later.",
+                            headers={"Retry-After": str(exc.retry_after)})
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> dict:
+    """
+    Endpoint reporting the status, progress and step count of a job.
+
+    Raises:
+        HTTPException: If the job is unknown or has expired.
+
+    Returns:
+        dict: The job state.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str) -> Response:
+    """
+    Endpoint returning the ad template generated by a job.
+
+    Raises:
+        HTTPException: If the job is unknown, expired, failed or not finished yet.
+
+    Returns:
+        Response: The encoded ad template, or a zip archive of its layouts.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status, detail=f"Job failed: {job.error}")
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}, poll /jobs/{job_id} until it succeeded.")
+    content, media_type = job.result
+    return Response(content=content, media_type=media_type)
+
+
+@app.post("/assets", status_code=201)
+async def upload_asset(image: UploadFile = File(...)) -> dict:
+    """
+    Store a logo or base image for reuse. Uploading the same bytes again returns the same asset.
+
+    Args:
+        image (UploadFile): The image to store.
+
+    Raises:
+        HTTPException: If the upload is not a valid image within the upload limits.
+
+    Returns:
+        dict: The asset ID, to pass as `base_image_asset` or `logo_image_asset`, along with the image format,
+            dimensions and size.
+    """
+    validate_upload_image(image, "image")
+    return await run_in_threadpool(asset_store.put, image.file)
+
+
+@app.get("/assets/{asset_id}")
+def get_asset(asset_id: str) -> dict:
+    """
+    Endpoint describing a stored asset.
+
+    Raises:
+        HTTPException: If the asset is unknown.
+
+    Returns:
+        dict: The asset ID, image format, dimensions and size.
+    """
+    try:
+        return asset_store.describe(asset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Asset not found.")
+
+
+@app.post("/bulk_jobs", status_code=202)
+async def create_bulk_job(
+        manifest: UploadFile = File(...),
+        output_format: str = Query("png", alias="format"),
+        compression_level: int = PNG_COMPRESSION_LEVEL,
+        image_quality: int = IMAGE_QUALITY,
+) -> dict:
+    """
+    Queue a bulk job generating one ad template per line of a JSONL manifest.
+
+    Each line is an ad spec with the arguments of `ad_template_creator`, where `base_image` and `logo_image`
+    reference images instead of uploading them, by asset ID or local path, along with an optional `name`. Follow
+    the results on `/bulk_jobs/{job_id}/results` as they are produced.
+
+    Args:
+        manifest (UploadFile): The JSONL manifest.
+        output_format (str, optional): The output encoder of every entry, passed as `format` (default is "png").
+        compression_level (int, optional): The PNG compression level from 0 to 9 (default is 1).
+        image_quality (int, optional): The JPEG/WebP quality from 1 to 100 (default is 90).
+
+    Raises:
+        HTTPException: If the output settings are invalid.
+
+    Returns:
+        dict: The job ID, state and entry count of the queued job.
+    """
+    validate_output_format(output_format, compression_level, image_quality)
+    job = await run_in_threadpool(bulk_job_runner.create,
+                                  manifest.file,
+                                  output_format=output_format,
+                                  compression_level=compression_level,
+                                  image_quality=image_quality)
+    return job.to_dict()
+
+
+def get_bulk_job_or_404(job_id):
+    """
+    Look up a bulk job.
+
+    Raises:
+        HTTPException: If the job is unknown.
+
+    Returns:
+        BulkJob: The job.
+    """
+    job = bulk_job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Bulk job not found.")
+    return job
+
+
+@app.get("/bulk_jobs/{job_id}")
+def get_bulk_job(job_id: str) -> dict:
+    """
+    Endpoint reporting the status and entry counters of a bulk job.
+
+    Returns:
+        dict: The job state.
+    """
+    return get_bulk_job_or_404(job_id).to_dict()
 
-        # Save the result image
-        add_template.save(result_image_path, format="PNG")
 
-        # Return the temporary file to the user
-        return FileResponse(result_image_path, media_type="image/png", filename="output.png")
+@app.post("/bulk_jobs/{job_id}/resume")
+def resume_bulk_job(job_id: str) -> dict:
+    """
+    Resume an interrupted bulk job; entries it already processed are not generated again.
+
+    Raises:
+        HTTPException: If the job is unknown.
+
+    Returns:
+        dict: The job state.
+    """
+    job = bulk_job_runner.resume(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Bulk job not found.")
+    return job.to_dict()
+
+
+@app.get("/bulk_jobs/{job_id}/results")
+def get_bulk_job_results(job_id: str, stream: str = "ndjson"):
+    """
+    Stream the results of a bulk job as they are produced, until the job finishes.
+
+    Args:
+        job_id (str): The job identifier.
+        stream (str, optional): "ndjson" for one JSON record per entry with the URL of its result, or "zip" for
+            a zip archive of the results themselves (default is "ndjson").
+
+    Raises:
+        HTTPException: If the job is unknown or the stream type is invalid.
+
+    Returns:
+        StreamingResponse: The NDJSON records or the zip archive.
+    """
+    job = get_bulk_job_or_404(job_id)
+
+    if stream == "ndjson":
+        def records():
+            for record in job.iter_results():
+                if record["status"] == "succeeded":
+                    record["url"] = f"/bulk_jobs/{job_id}/results/{record['file']}"
+                yield json.dumps(record) + "\n"
+
+        return StreamingResponse(records(), media_type="application/x-ndjson")
+
+    if stream == "zip":
+        def entries():
+            # Results are read back from disk one at a time
+            for record in job.iter_results():
+                if record["status"] == "succeeded":
+                    with open(job.result_path(record["file"]), "rb") as file:
+                        yield record["file"], file.read()
+
+        return StreamingResponse(iter_zip_stream(entries()),
+                                 media_type="application/zip",
+                                 headers={"Content-Disposition": f"attachment; filename={job_id}.zip"})
+
+    raise HTTPException(status_code=422, detail="Invalid stream. Please provide ndjson or zip.")
+
+
+@app.get("/bulk_jobs/{job_id}/results/{file_name}")
+def get_bulk_job_result(job_id: str, file_name: str) -> FileResponse:
+    """
+    Endpoint returning a single result of a bulk job.
+
+    Raises:
+        HTTPException: If the job or the result is unknown.
+
+    Returns:
+        FileResponse: The encoded ad template.
+    """
+    path = get_bulk_job_or_404(job_id).result_path(file_name)
+    if file_name in ("job.json", "manifest.jsonl", "results.jsonl") or file_name.endswith(".tmp") or \
+            not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Result not found.")
+    return FileResponse(path)
+
+
+@app.get("/healthz")
+def get_liveness():
+    """
+    Liveness probe: answers as long as the server is up, including while it warms up.
 
-    except HTTPException as http_exc:
-        raise http_exc  # FastAPI HTTP exceptions are already well-formatted
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Internal Server Error. Please try again later.")
+    Returns:
+        dict: The liveness status.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def get_readiness() -> JSONResponse:
+    """
+    Readiness probe: reports the warm-up state and the time spent in each startup stage.
+
+    Returns:
+        JSONResponse: The warm-up state, with status 200 once the service is ready to take traffic and 503 before
+            or when the warm-up failed.
+    """
+    return JSONResponse(startup_progress.to_dict(), status_code=200 if startup_progress.ready else 503)
 
 
 @app.get("/")
@@ -154,6 +1871,101 @@ def read_root():
     return {"health_check": "OK"}
 
 
+@app.get("/models")
+def get_models():
+    """
+    Endpoint reporting the diffusion pipelines resident in memory, and the worker processes in worker pool mode.
+
+    Returns:
+        dict: The resident pipelines of the API process and their total size in bytes, and the state of every
+            worker process.
+    """
+    return {"resident_models": pipeline_registry.resident_models(),
+            "resident_bytes": pipeline_registry.resident_bytes(),
+            "memory_budget_bytes": pipeline_registry.memory_budget_bytes,
+            "memory_mode": stable_diffusor.memory_mode,
+            "batch_memory_per_image_bytes": stable_diffusor.batch_size_governor.stats()
+            if stable_diffusor.batch_size_governor is not None else {},
+            "workers": worker_pool.stats() if worker_pool is not None else []}
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """
+    Endpoint reporting the hit, miss and eviction counters of the result, prompt embedding, latent and asset
+    derivative caches.
+
+    Returns:
+        dict: The statistics of each cache, None for the latent cache when it is disabled.
+    """
+    return {"result_cache": result_cache.stats(),
+            "asset_derivatives": asset_store.stats(),
+            "prompt_embedding_cache": prompt_embedding_cache.stats(),
+            "latent_cache": latent_cache.stats() if latent_cache is not None else None}
+
+
+@app.get("/metrics")
+def get_metrics() -> PlainTextResponse:
+    """
+    Endpoint exporting the service metrics in the Prometheus text format: the stage duration histograms, queue
+    depths, admission counters, micro-batch sizes, cache hit ratios and peak memory.
+
+    Returns:
+        PlainTextResponse: The metrics.
+    """
+    lines = STAGE_DURATION.render()
+
+    lines += render_metric("ad_job_queue_depth", "Jobs queued or running.", job_manager.queue_depth())
+    admission_stats = admission_controller.stats()
+    lines += render_metric("ad_admission_running", "Requests running the diffusion process.",
+                           admission_stats["running"])
+    lines += render_metric("ad_admission_queue_depth", "Requests waiting for admission.",
+                           admission_stats["queued"], label="priority")
+    for name, documentation in (("admitted", "Requests admitted to the diffusion process."),
+                                ("rejected", "Requests rejected because their admission queue was full."),
+                                ("cancelled", "Requests cancelled while they waited for admission.")):
+        lines += render_metric(f"ad_admission_{name}_total", documentation, admission_stats[name], "counter",
+                               label="priority")
+    if stable_diffusor.batch_scheduler is not None:
+        batch_stats = stable_diffusor.batch_scheduler.stats()
+        lines += render_metric("ad_batch_queue_depth", "Requests waiting for a pipeline batch.",
+                               batch_stats["pending"])
+        lines += render_bucket_counts("ad_batch_size", "Requests per batched pipeline call.",
+                                      batch_stats["batch_size_counts"])
+
+    cache_stats = {"result": result_cache.stats(),
+                   "prompt_embedding": prompt_embedding_cache.stats(),
+                   "asset_derivative": asset_store.stats()}
+    if latent_cache is not None:
+        cache_stats["latent"] = latent_cache.stats()
+    lines += render_metric("ad_cache_hits_total", "Cache hits.",
+                           {name: stats["hits"] for name, stats in cache_stats.items()}, "counter", label="cache")
+    lines += render_metric("ad_cache_misses_total", "Cache misses.",
+                           {name: stats["misses"] for name, stats in cache_stats.items()}, "counter", label="cache")
+    lines += render_metric("ad_cache_hit_ratio", "Share of cache lookups that hit.",
+                           {name: stats["hit_ratio"] for name, stats in cache_stats.items()}, label="cache")
+
+    if worker_pool is not None:
+        worker_stats = {str(worker["worker"]): worker for worker in worker_pool.stats()}
+        lines += render_metric("ad_worker_in_flight", "Tasks in flight on each worker process.",
+                               {index: worker["in_flight"] for index, worker in worker_stats.items()},
+                               label="worker")
+        lines += render_metric("ad_worker_restarts_total", "Restarts of each worker process after a crash.",
+                               {index: worker["restarts"] for index, worker in worker_stats.items()}, "counter",
+                               label="worker")
+
+    lines += render_metric("ad_pipeline_resident_bytes", "Weights held by the resident pipelines.",
+                           pipeline_registry.resident_bytes())
+    peak_rss_bytes = get_peak_rss_bytes()
+    if peak_rss_bytes is not None:
+        lines += render_metric("ad_process_peak_rss_bytes", "Peak resident memory of the process.", peak_rss_bytes)
+    lines += render_metric("ad_device_peak_memory_bytes", "Peak memory allocated on the CUDA device.",
+                           get_peak_device_memory())
+    lines += PEAK_DEVICE_MEMORY.render()
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
 @app.get("/favicon.ico")
 def get_favicon():
     """
@@ -166,6 +1978,10 @@ def get_favicon():
 
 
 if __name__ == "__main__":
+    # Only needed to expose a local server, kept out of the import path of the API
+    import nest_asyncio
+    from pyngrok import conf, ngrok
+
     conf.get_default().auth_token = "<insert_your_authtoken_here>"
     ngrok_tunnel = ngrok.connect(8087)
     print("Public URL:", ngrok_tunnel.public_url)
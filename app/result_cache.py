@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def make_cache_key(*blobs, **params):
+    """
+    Build a content-addressed cache key.
+
+    Args:
+        *blobs (bytes): Raw inputs or their digests, e.g. of the uploaded images, hashed in order.
+        **params: JSON serializable parameters, hashed independently of their order.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest of the inputs.
+    """
+    digest = hashlib.sha256()
+    for blob in blobs:
+        # Prefix every blob with its length so that different splits of the same bytes do not collide
+        digest.update(len(blob).to_bytes(8, "big"))
+        digest.update(blob)
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def file_digest(fileobj, chunk_size=1024 * 1024):
+    """
+    Hash a file in chunks, without loading it into memory.
+
+    Args:
+        fileobj (file-like object): The file to hash; it is rewound before and after hashing.
+        chunk_size (int, optional): The size of the chunks read at once.
+
+    Returns:
+        bytes: The SHA-256 digest of the file content.
+    """
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.digest()
+
+
+class ResultCache:
+    """
+    A two-tier cache of encoded results: an in-memory LRU backed by an on-disk directory.
+
+    Concurrent lookups of the same missing key share a single computation instead of running it once per caller.
+
+    Attributes:
+        max_memory_bytes (int): The size budget of the in-memory tier.
+        disk_dir (str or None): The directory of the on-disk tier. None disables it.
+        max_disk_bytes (int): The size budget of the on-disk tier.
+    """
+
+    def __init__(self, max_memory_bytes=256 * 1024 * 1024, disk_dir=None, max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+                          "memory_evictions": 0, "disk_evictions": 0}
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.is_file())
+
+    def get(self, key):
+        """
+        Look up a cached result, promoting on-disk hits into memory.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            bytes or None: The cached result, or None on a miss.
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._counters["hits"] += 1
+                self._counters["memory_hits"] += 1
+                return value
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["hits"] += 1
+            self._counters["disk_hits"] += 1
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Store a result in both tiers.
+
+        Args:
+            key (str): The cache key.
+            value (bytes): The result.
+        """
+        with self._lock:
+            self._put_memory(key, value)
+        self._write_disk(key, value)
+
+    def get_or_compute(self, key, compute, cached=True):
+        """
+        Return the cached result for a key, computing and storing it on a miss.
+
+        When the same key is already being computed by another caller, wait for that computation instead of
+        starting a new one.
+
+        Args:
+            key (str): The cache key.
+            compute (callable): Called without arguments on a miss; returns the result as bytes.
+            cached (bool, optional): Whether to look up and store the result. When False, only concurrent
+                computations of the key are shared.
+
+        Returns:
+            bytes: The result.
+        """
+        if cached:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self._counters["coalesced"] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as exc:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            if cached:
+                self._put_memory(key, value)
+            del self._inflight[key]
+        # Waiters get the result before the disk write, which is best-effort
+        future.set_result(value)
+        if cached:
+            self._write_disk(key, value)
+        return value
+
+    def stats(self):
+        """
+        Report the cache counters and tier sizes.
+
+        Returns:
+            dict: Hit, miss, coalesced and eviction counters along with the size and entry count of each tier.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["evictions"] = stats["memory_evictions"] + stats["disk_evictions"]
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+            stats["disk_bytes"] = self._disk_bytes
+            return stats
+
+    def _put_memory(self, key, value):
+        if len(value) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._counters["memory_evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as file:
+                value = file.read()
+        except OSError:
+            return None
+        # Refresh the modification time, which orders the on-disk entries for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def _write_disk(self, key, value):
+        if self.disk_dir is None or len(value) > self.max_disk_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+
+        # Write to a temporary file first so that readers never see a partial entry. The on-disk tier is
+        # best-effort: a failed write, e.g. on a full disk, leaves the result in memory only.
+        try:
+            descriptor, temporary_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(value)
+            os.replace(temporary_path, path)
+        except OSError:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._disk_bytes += len(value)
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            self._evict_disk()
+
+    def _evict_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.disk_dir)
+                          if entry.is_file() and not entry.name.endswith(".tmp")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            self._counters["disk_evictions"] += 1
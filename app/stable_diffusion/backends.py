@@ -0,0 +1,163 @@
+import functools
+import math
+import os
+import sys
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+
+# Where the container runtime exposes the CPU quota of the process, for cgroup v2 and v1
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def get_device_type(device):
+    """
+    Return the type of a device, e.g. "cuda" for "cuda:1".
+    """
+    return str(device).split(":")[0]
+
+
+def resolve_device(device="auto"):
+    """
+    Pick the device the pipeline runs on.
+
+    Args:
+        device (str, optional): A device name, or "auto" for CUDA when available, then Apple MPS, then the CPU.
+
+    Returns:
+        str: The device name.
+    """
+    if device != "auto":
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_supports_bfloat16():
+    """
+    Return True if the CPU computes bfloat16 natively, with the AVX512-BF16 or AMX instructions.
+    """
+    try:
+        with open("/proc/cpuinfo") as file:
+            flags = file.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def resolve_dtype(device, torch_dtype="auto"):
+    """
+    Pick the data type of the model weights for a device.
+
+    Args:
+        device (str): The device the pipeline runs on.
+        torch_dtype (torch.dtype or str, optional): A data type or its name in torch, or "auto" for float16 on
+            GPUs, and bfloat16 on CPUs computing it natively or float32 on the others. Half precision is emulated
+            and slow on CPUs.
+
+    Returns:
+        torch.dtype: The data type.
+    """
+    if torch_dtype == "auto":
+        if get_device_type(device) in ("cuda", "mps"):
+            torch_dtype = "float16"
+        else:
+            torch_dtype = "bfloat16" if cpu_supports_bfloat16() else "float32"
+    return getattr(torch, torch_dtype) if isinstance(torch_dtype, str) else torch_dtype
+
+
+def _read_cgroup_cpu_quota():
+    try:
+        with open(CGROUP_V2_CPU_MAX) as file:
+            quota, period = file.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(CGROUP_V1_CPU_QUOTA) as quota_file, open(CGROUP_V1_CPU_PERIOD) as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def get_cpu_quota():
+    """
+    Return the number of CPU cores the process can actually use: the cores it may be scheduled on, bounded by the
+    CPU quota of its container. The core count of the machine overstates it in a container, and threads beyond the
+    quota only get throttled.
+
+    Returns:
+        int: The number of cores, at least 1.
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = _read_cgroup_cpu_quota()
+    if quota is not None:
+        cores = min(cores, math.ceil(quota))
+    return max(cores, 1)
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Size the thread pools of torch for the process.
+
+    When torch is not imported yet, the OpenMP and MKL environment variables are set as well, so that every thread
+    starts with the same setting; `torch.set_num_threads` alone only reliably applies to the calling thread.
+
+    Args:
+        intra_op_threads (int, optional): The threads a single operator is parallelized over; defaults to the CPU
+            quota of the process.
+        inter_op_threads (int, optional): The threads independent operators run on at once; defaults to 1, since a
+            diffusion step is a chain of dependent operators.
+
+    Returns:
+        tuple: The intra-op and inter-op thread counts in effect.
+    """
+    intra_op_threads = intra_op_threads or get_cpu_quota()
+    inter_op_threads = inter_op_threads or 1
+    if "torch" not in sys.modules:
+        for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ[variable] = str(intra_op_threads)
+
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        # It can only be set once, before any inter-op parallel work ran
+        pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def optimize_pipeline(pipe, device, channels_last=None, compile_unet=False):
+    """
+    Apply the device specific optimizations to a loaded pipeline.
+
+    Args:
+        pipe (StableDiffusionImg2ImgPipeline): The pipeline.
+        device (str): The device the pipeline runs on.
+        channels_last (bool, optional): Store the convolution weights of the UNet and the VAE in the channels-last
+            memory format, which the CPU convolution kernels run fastest on. None enables it on the CPU only.
+        compile_unet (bool, optional): Compile the UNet with `torch.compile`. The first calls at every new
+            resolution and batch size are slow while the graph compiles.
+    """
+    if channels_last is None:
+        channels_last = get_device_type(device) == "cpu"
+
+    for name in ("unet", "vae"):
+        module = getattr(pipe, name, None)
+        if channels_last and isinstance(module, torch.nn.Module):
+            module.to(memory_format=torch.channels_last)
+
+    if compile_unet and isinstance(getattr(pipe, "unet", None), torch.nn.Module):
+        pipe.unet = torch.compile(pipe.unet)
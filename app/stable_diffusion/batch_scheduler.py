@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    A micro-batching scheduler that groups concurrent requests with compatible parameters into one call.
+
+    Requests are submitted with a batch key; requests sharing a key are collected for at most `max_wait_ms`
+    milliseconds, or until `max_batch_size` of them are pending, and then handed to `run_batch` together. A
+    single dispatcher thread runs the batches one after another, so requests arriving while a batch runs are
+    collected into the next one.
+
+    Attributes:
+        run_batch (callable): Called as run_batch(key, items) and returns one result per item, in order.
+        max_batch_size (int): The maximum number of items run in a single batch.
+        max_wait_ms (float): How long the oldest pending item waits for others before its batch is run.
+        batch_size_limit (callable or None): Called as batch_size_limit(key) before a batch of the key is formed;
+            returns the largest batch that may run at the moment, e.g. what fits in the free device memory. None
+            always allows `max_batch_size`.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait_ms=10, batch_size_limit=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batch_size_limit = batch_size_limit
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._dispatcher = None
+        self._closed = False
+        self._batch_size_counts = {}
+
+    def submit(self, key, item):
+        """
+        Queue an item for batched execution.
+
+        Args:
+            key (hashable): The batch key; only items with equal keys are run together.
+            item (object): The item passed to `run_batch`.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result produced for this item.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is shut down.")
+            self._ensure_dispatcher()
+            self._pending.setdefault(key, []).append((item, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def stats(self):
+        """
+        Report the number of pending items and the sizes of the batches run so far.
+
+        Returns:
+            dict: The pending item count and the number of batches run per batch size.
+        """
+        with self._condition:
+            return {"pending": sum(len(queued) for queued in self._pending.values()),
+                    "batch_size_counts": dict(self._batch_size_counts)}
+
+    def shutdown(self):
+        """
+        Stop the dispatcher thread once the pending batches have been run.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="batch-scheduler", daemon=True)
+            self._dispatcher.start()
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None, None
+                    self._condition.wait()
+                    continue
+
+                # Serve the key whose oldest item has waited the longest
+                key = min(self._pending, key=lambda k: self._pending[k][0][2])
+                queued = self._pending[key]
+                remaining = queued[0][2] + self.max_wait_ms / 1000 - time.monotonic()
+                batch_size = self.max_batch_size
+                if self.batch_size_limit is not None:
+                    batch_size = max(1, min(batch_size, self.batch_size_limit(key)))
+
+                if len(queued) >= batch_size or remaining <= 0 or self._closed:
+                    batch = queued[:batch_size]
+                    del queued[:batch_size]
+                    if not queued:
+                        del self._pending[key]
+                    return key, batch
+
+                self._condition.wait(timeout=remaining)
+
+    def _dispatch_loop(self):
+        while True:
+            key, batch = self._next_batch()
+            if batch is None:
+                return
+
+            # Skip items whose caller has already given up on them
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            with self._condition:
+                self._batch_size_counts[len(batch)] = self._batch_size_counts.get(len(batch), 0) + 1
+
+            try:
+                results = self.run_batch(key, [item for item, _, _ in batch])
+            except Exception as exc:
+                for _, future, _ in batch:
+                    future.set_exception(exc)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
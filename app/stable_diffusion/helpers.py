@@ -1,6 +1,30 @@
 import numpy as np
 from PIL import Image, ImageOps
-from scipy.ndimage import binary_dilation
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+# Only imported once the color filter first runs
+ndimage = lazy_module("scipy.ndimage")
+
+
+def make_blend_lookup_table(target_color, smooth_factor):
+    """
+    Precompute the blend of every channel value with the target color. The blend of a value only depends on the
+    value itself, so a lookup table with the same truncating arithmetic as the per-pixel float blend replaces it.
+
+    Args:
+        target_color (tuple): The target color in RGB format.
+        smooth_factor (float): The interpolation factor between original and target color.
+
+    Returns:
+        numpy.ndarray: The (3, 256) uint8 table of the blended value of every channel and value.
+    """
+    levels = np.arange(256, dtype=np.uint8)
+    return ((smooth_factor * np.array(target_color)).astype(np.uint8)[:, None] +
+            ((1 - smooth_factor) * levels).astype(np.uint8)[None, :])
 
 
 def extract_features_and_change_their_color(original_image, target_color, smooth_factor=0.5, dilation_radius=5):
@@ -8,35 +32,90 @@ def extract_features_and_change_their_color(original_image, target_color, smooth
     Change the color of extracted features in an image.
 
     Args:
-        original_image (PIL.Image.Image): The original image.
+        original_image (PIL.Image.Image): The original image. Images of other modes than RGB are converted to RGB,
+            dropping their alpha channel, as the diffusion pipeline only takes RGB images.
         target_color (tuple): The target color in RGB format.
         smooth_factor (float, optional): The interpolation factor between original and target color. Defaults to 0.5.
         dilation_radius (int, optional): The radius for dilating the feature mask. Defaults to 5.
 
     Returns:
-        PIL.Image.Image: The resulting image with color-changed features.
+        PIL.Image.Image: The resulting RGB image with color-changed features.
     """
-    # Convert the original image to a NumPy array
-    image_array = np.array(original_image)
+    rgb_image = original_image if original_image.mode == "RGB" else original_image.convert("RGB")
 
     # Extract features (for example, edges) - You can replace this with your feature extraction method
-    # For this example, let's convert the image to grayscale and invert the colors
-    features_array = 255 - np.array(ImageOps.grayscale(original_image))
-
-    # Create a mask where features are present
-    feature_mask = features_array > 0
+    # For this example, features are the pixels whose inverted grayscale value is non-zero
+    feature_mask = np.asarray(ImageOps.grayscale(original_image)) < 255
 
-    # Dilate the feature mask to include surrounding pixels
-    dilated_feature_mask = binary_dilation(feature_mask, iterations=dilation_radius)
+    # Dilating the mask `dilation_radius` times with the default cross structure grows it by a taxicab distance
+    # of `dilation_radius`, so a single chamfer distance transform gives the same mask in two passes
+    if dilation_radius > 0 and feature_mask.any() and not feature_mask.all():
+        keep_original_mask = ndimage.distance_transform_cdt(~feature_mask, metric="taxicab") > dilation_radius
+    else:
+        keep_original_mask = ~feature_mask
 
-    # Smoothly interpolate between the original image and the target color for the features
-    result_array = np.where(dilated_feature_mask[:, :, None],
-                            (smooth_factor * np.array(target_color)).astype(np.uint8) +
-                            ((1 - smooth_factor) * image_array).astype(np.uint8),
-                            image_array)
+    lookup_table = make_blend_lookup_table(target_color, smooth_factor)
 
-    # Convert NumPy array back to an image
-    result_image = Image.fromarray(result_array.astype(np.uint8))
+    # Blend every pixel in one pass, then restore the pixels outside the dilated feature mask in place
+    result_image = rgb_image.point(lookup_table.ravel().tolist())
+    if keep_original_mask.any():
+        result_image.paste(rgb_image, mask=Image.fromarray(keep_original_mask))
 
-    # Save or display the resulting image
     return result_image
+
+
+def get_normalized_geometry(image_size, target_size, multiple=8, max_side=None):
+    """
+    Compute the size an image is normalized to by `normalize_resolution`, and the region of the image it is
+    resized from.
+
+    Args:
+        image_size (tuple): The (width, height) of the image.
+        target_size (tuple): The (width, height) the generated image is finally displayed at.
+        multiple (int, optional): Both sides of the result are a multiple of this value. Defaults to 8.
+        max_side (int, optional): The maximum length of the longer side of the result. Defaults to no limit.
+
+    Returns:
+        tuple: The (width, height) of the normalized image, and the (left, upper, right, lower) box of the image
+            region it is resized from.
+    """
+    target_width, target_height = target_size
+
+    # Cap the longer side while keeping the aspect ratio of the target
+    if max_side is not None and max(target_width, target_height) > max_side:
+        scale = max_side / max(target_width, target_height)
+        target_width = max(multiple, int(target_width * scale) // multiple * multiple)
+        target_height = max(multiple, int(target_height * scale) // multiple * multiple)
+    else:
+        target_width = -(-target_width // multiple) * multiple
+        target_height = -(-target_height // multiple) * multiple
+
+    # The largest centered region with the target aspect ratio
+    width, height = image_size
+    crop_width = min(width, height * target_width / target_height)
+    crop_height = crop_width * target_height / target_width
+    box = ((width - crop_width) / 2, (height - crop_height) / 2,
+           (width + crop_width) / 2, (height + crop_height) / 2)
+    return (target_width, target_height), box
+
+
+def normalize_resolution(image, target_size, multiple=8, max_side=None):
+    """
+    Resize and center crop an image to the smallest size that covers the target size and is a multiple of
+    `multiple` on both sides, as required by the diffusion model.
+
+    Args:
+        image (PIL.Image.Image): The image to normalize.
+        target_size (tuple): The (width, height) the generated image is finally displayed at.
+        multiple (int, optional): Both sides of the result are a multiple of this value. Defaults to 8.
+        max_side (int, optional): The maximum length of the longer side of the result. Defaults to no limit.
+
+    Returns:
+        PIL.Image.Image: The normalized image.
+    """
+    size, box = get_normalized_geometry(image.size, target_size, multiple=multiple, max_side=max_side)
+    if image.size == size:
+        return image
+
+    # Crop the largest centered region with the target aspect ratio and resize it in a single resampling pass
+    return image.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
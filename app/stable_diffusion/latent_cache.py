@@ -0,0 +1,180 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+torch_utils = lazy_module("diffusers.utils.torch_utils")
+
+
+def make_image_key(base_image_digest, **params):
+    """
+    Identify a color filtered base image by what it is computed from, so that a cache lookup needs neither the
+    color filter nor the image itself.
+
+    Args:
+        base_image_digest (bytes or str): The SHA-256 digest of the encoded base image, e.g. its asset ID.
+        **params: The color filter and resolution arguments of `StableDiffusor.prepare_base_image`.
+
+    Returns:
+        str: The hexadecimal SHA-256 key of the color filtered image.
+    """
+    if isinstance(base_image_digest, str):
+        base_image_digest = bytes.fromhex(base_image_digest)
+    digest = hashlib.sha256(base_image_digest)
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def encode_latent_distribution(pipe, image):
+    """
+    Encode an image into the latent distribution of the VAE, which the latents the denoising loop of an img2img
+    pipeline starts from are sampled from.
+
+    Args:
+        pipe (StableDiffusionImg2ImgPipeline): The pipeline whose VAE encodes the image.
+        image (PIL.Image.Image or torch.Tensor): The color filtered base image, or its (1, 3, height, width)
+            tensor in [0, 1].
+
+    Returns:
+        tuple: The mean and the standard deviation of the distribution, of shape (1, 4, height / 8, width / 8),
+            on the device of the pipeline. The standard deviation is None for VAEs encoding to fixed latents.
+    """
+    device = getattr(pipe, "_execution_device", pipe.device)
+    with torch.inference_mode():
+        pixels = pipe.image_processor.preprocess(image).to(device=device, dtype=pipe.vae.dtype)
+        encoded = pipe.vae.encode(pixels)
+        if not hasattr(encoded, "latent_dist"):
+            return encoded.latents, None
+        return encoded.latent_dist.mean, encoded.latent_dist.std
+
+
+def sample_latents(pipe, distribution, generator):
+    """
+    Sample the scaled latents the denoising loop starts from, the way the img2img pipeline samples them when it
+    encodes the image itself, so that a seeded generator gives the same latents with and without the cache.
+
+    Args:
+        pipe (StableDiffusionImg2ImgPipeline): The pipeline whose VAE encoded the image.
+        distribution (tuple): The mean and standard deviation from `encode_latent_distribution`.
+        generator (torch.Generator): The generator of the request, which the pipeline draws its noise from next.
+
+    Returns:
+        torch.Tensor: The latents, of shape (1, 4, height / 8, width / 8).
+    """
+    mean, std = distribution
+    with torch.inference_mode():
+        latents = mean
+        if std is not None:
+            latents = mean + std * torch_utils.randn_tensor(mean.shape, generator=generator, device=mean.device,
+                                                            dtype=mean.dtype)
+        return pipe.vae.config.scaling_factor * latents
+
+
+class LatentCache:
+    """
+    An LRU cache of VAE encoded base images, so that requests iterating on the prompts, strength or texts of the
+    same base image and color skip the color filter and the VAE encoder.
+
+    The latent distributions are cached rather than latents sampled from them, so every request still samples
+    its own latents with its seed. They are keyed by the pipeline they were encoded with and the key of the color
+    filtered image from `make_image_key`, and kept on the pipeline's device until the total size exceeds the
+    memory budget.
+
+    Attributes:
+        max_bytes (int): The size budget of the cached latents.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "encode_seconds": 0.0}
+
+    def lookup(self, model_key, image_key):
+        """
+        Return the cached latent distribution of an image, or None.
+
+        Args:
+            model_key (tuple): The registry key of the pipeline.
+            image_key (str): The key of the color filtered image.
+
+        Returns:
+            tuple or None: The mean and standard deviation from `encode_latent_distribution`.
+        """
+        key = (model_key, image_key)
+        with self._lock:
+            distribution = self._entries.get(key)
+            if distribution is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+            return distribution
+
+    def get_distribution(self, pipe, model_key, image_key, image):
+        """
+        Return the latent distribution of an image, encoding it with the pipeline's VAE on a miss.
+
+        Args:
+            pipe (StableDiffusionImg2ImgPipeline): The pipeline whose VAE encodes the image.
+            model_key (tuple): The registry key of the pipeline.
+            image_key (str or None): The key of the color filtered image. None encodes without caching.
+            image (PIL.Image.Image or torch.Tensor): The color filtered image, or its tensor.
+
+        Returns:
+            tuple: The mean and standard deviation from `encode_latent_distribution`.
+        """
+        if image_key is not None:
+            distribution = self.lookup(model_key, image_key)
+            if distribution is not None:
+                return distribution
+
+        start = time.perf_counter()
+        distribution = encode_latent_distribution(pipe, image)
+        encode_seconds = time.perf_counter() - start
+
+        with self._lock:
+            self._counters["misses"] += 1
+            self._counters["encode_seconds"] += encode_seconds
+            if image_key is not None:
+                self._put((model_key, image_key), distribution)
+        return distribution
+
+    def stats(self):
+        """
+        Report the hit rate of the cache and the VAE encoder time it saved.
+
+        Returns:
+            dict: Hit, miss and eviction counters, the hit ratio, the encoder time spent on misses and the
+                estimated encoder time saved by hits, along with the size of the cache.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+            average_encode_seconds = stats["encode_seconds"] / stats["misses"] if stats["misses"] else 0.0
+            stats["encode_seconds_saved"] = stats["hits"] * average_encode_seconds
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            return stats
+
+    def _put(self, key, distribution):
+        size = self._size(distribution)
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = distribution
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._size(evicted)
+            self._counters["evictions"] += 1
+
+    @staticmethod
+    def _size(distribution):
+        return sum(tensor.numel() * tensor.element_size() for tensor in distribution if tensor is not None)
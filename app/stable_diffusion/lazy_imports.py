@@ -0,0 +1,60 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """
+    A stand-in for a module that is only imported when one of its attributes is first used.
+
+    Heavy dependencies such as torch and diffusers take seconds to import; deferring them keeps them out of the
+    import path of the API, so that the server starts right away and imports them during its warm-up.
+
+    Attributes:
+        name (str): The name of the module.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+
+    def load(self):
+        """
+        Import the module, unless it was already imported.
+
+        Returns:
+            module: The module.
+        """
+        if self._module is None:
+            self._module = importlib.import_module(self.name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+_lazy_modules = {}
+_lock = threading.Lock()
+
+
+def lazy_module(name):
+    """
+    Return the lazily imported stand-in of a module, shared by every caller.
+
+    Args:
+        name (str): The name of the module, e.g. "torch".
+
+    Returns:
+        LazyModule: The stand-in of the module.
+    """
+    with _lock:
+        return _lazy_modules.setdefault(name, LazyModule(name))
+
+
+def preload_modules():
+    """
+    Import every module deferred through `lazy_module`.
+    """
+    with _lock:
+        modules = list(_lazy_modules.values())
+    for module in modules:
+        module.load()
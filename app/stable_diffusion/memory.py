@@ -0,0 +1,270 @@
+import math
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+
+# Execution modes trading speed for device memory, from the fastest to the most frugal. VAE tiling only changes
+# images larger than the tile size of the VAE, so small images decode as before
+MEMORY_MODES = {
+    # The whole pipeline on the device
+    "full": {"attention_slicing": False, "vae_slicing": False, "vae_tiling": False, "offload": None},
+    # Attention computed in slices, and the VAE decoding one image and one tile at a time
+    "balanced": {"attention_slicing": True, "vae_slicing": True, "vae_tiling": True, "offload": None},
+    # Additionally, only the model running at the moment (text encoder, UNet or VAE) on the device
+    "low": {"attention_slicing": True, "vae_slicing": True, "vae_tiling": True, "offload": "model"},
+    # Additionally, the weights streamed to the device one layer at a time; the slowest mode
+    "minimal": {"attention_slicing": True, "vae_slicing": True, "vae_tiling": True, "offload": "sequential"},
+}
+
+
+class DeviceOutOfMemory(Exception):
+    """
+    Raised when a single request does not fit in the device memory, even when run on its own.
+    """
+
+
+def validate_memory_mode(memory_mode):
+    """
+    Raise a ValueError if the memory mode is unknown.
+    """
+    if memory_mode not in MEMORY_MODES:
+        raise ValueError(f"Unknown memory mode {memory_mode!r}, expected one of {', '.join(MEMORY_MODES)}.")
+
+
+def apply_memory_mode(pipe, memory_mode, device):
+    """
+    Configure a pipeline for a memory mode.
+
+    Offloading modes expect the pipeline to be loaded on the CPU; they move the weights to the device as they are
+    needed.
+
+    Args:
+        pipe (StableDiffusionImg2ImgPipeline): The pipeline.
+        memory_mode (str): The memory mode, one of MEMORY_MODES.
+        device (str): The device the pipeline runs on.
+    """
+    settings = MEMORY_MODES[memory_mode]
+    if settings["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    if settings["vae_slicing"]:
+        pipe.enable_vae_slicing()
+    if settings["vae_tiling"]:
+        pipe.enable_vae_tiling()
+    if settings["offload"] == "model":
+        pipe.enable_model_cpu_offload(device=device)
+    elif settings["offload"] == "sequential":
+        pipe.enable_sequential_cpu_offload(device=device)
+
+
+def offloads_weights(memory_mode):
+    """
+    Return True if the pipeline of the memory mode keeps its weights on the CPU.
+    """
+    return MEMORY_MODES[memory_mode]["offload"] is not None
+
+
+def is_cuda_device(device):
+    """
+    Return True if the device is a CUDA device and CUDA is available.
+    """
+    return str(device).startswith("cuda") and torch.cuda.is_available()
+
+
+def is_out_of_memory(exc):
+    """
+    Return True if an error is torch running out of device memory.
+    """
+    out_of_memory_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    if out_of_memory_error is not None and isinstance(exc, out_of_memory_error):
+        return True
+    return isinstance(exc, RuntimeError) and "out of memory" in str(exc)
+
+
+class PeakMemory:
+    """
+    The device memory used while a block of work ran.
+
+    Attributes:
+        baseline_bytes (int): The memory allocated when the block started, e.g. the resident weights.
+        peak_bytes (int or None): The peak memory allocated while the block ran, None when it is not measured.
+    """
+
+    def __init__(self, baseline_bytes=0):
+        self.baseline_bytes = baseline_bytes
+        self.peak_bytes = None
+
+    @property
+    def work_bytes(self):
+        """
+        int or None: The memory the block needed on top of the baseline.
+        """
+        return None if self.peak_bytes is None else max(self.peak_bytes - self.baseline_bytes, 0)
+
+
+_process_peak_bytes = 0
+_peak_lock = threading.Lock()
+
+
+@contextmanager
+def track_peak_device_memory(device):
+    """
+    Measure the peak device memory allocated while the enclosed block runs. Only measured on CUDA devices.
+
+    Args:
+        device (str): The device the work runs on.
+
+    Yields:
+        PeakMemory: Filled in once the block finished.
+    """
+    global _process_peak_bytes
+    if not is_cuda_device(device):
+        yield PeakMemory()
+        return
+
+    # The peak counter of torch is reset for the block; the peak since startup is carried over separately
+    with _peak_lock:
+        _process_peak_bytes = max(_process_peak_bytes, torch.cuda.max_memory_allocated(device))
+    torch.cuda.reset_peak_memory_stats(device)
+    memory = PeakMemory(torch.cuda.memory_allocated(device))
+    try:
+        yield memory
+    finally:
+        memory.peak_bytes = torch.cuda.max_memory_allocated(device)
+        with _peak_lock:
+            _process_peak_bytes = max(_process_peak_bytes, memory.peak_bytes)
+
+
+def get_peak_device_memory():
+    """
+    Return the peak memory allocated by torch on the CUDA device since startup, in bytes, or 0 without CUDA.
+    """
+    # Reporting must not be what imports torch
+    if "torch" not in sys.modules or not torch.cuda.is_available():
+        return 0
+    with _peak_lock:
+        return max(_process_peak_bytes, torch.cuda.max_memory_allocated())
+
+
+class BatchSizeGovernor:
+    """
+    Picks the largest batch that fits in the device memory available at the moment.
+
+    The memory a batch needs on top of the resident weights is measured for every batch run, per image size and
+    guidance setting, and the largest batch whose estimated need fits in the available memory is allowed next.
+    Image sizes not seen yet are estimated from the others, assuming the need grows with the pixel count; with
+    no measurement at all, batches of one are run until the first one is measured. Without CUDA, batches are
+    only bounded by `max_batch_size`.
+
+    Attributes:
+        device (str): The device the batches run on.
+        max_batch_size (int): The largest batch ever allowed.
+        memory_budget_bytes (int or None): The device memory the process may use in total, on top of which the
+            free device memory is also respected. None only respects the free device memory.
+        headroom (float): The share of the available memory batches are planned to fill.
+    """
+
+    def __init__(self, device, max_batch_size, memory_budget_bytes=None, headroom=0.9):
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.memory_budget_bytes = memory_budget_bytes
+        self.headroom = headroom
+        self._bytes_per_item = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(batch_key):
+        """
+        Reduce a batch key of `StableDiffusor` to what the memory need depends on: the image size and whether
+        classifier-free guidance doubles the batch.
+        """
+        _, guidance_scale, _, _, image_size = batch_key
+        return tuple(image_size), guidance_scale > 1
+
+    def limit(self, batch_key):
+        """
+        Return the largest batch that may run now for a batch key. Passed to `BatchScheduler` as its batch size
+        limit.
+
+        Args:
+            batch_key (tuple): The batch key of `StableDiffusor`.
+
+        Returns:
+            int: The batch size, from 1 to `max_batch_size`.
+        """
+        if self.max_batch_size <= 1 or not is_cuda_device(self.device):
+            return self.max_batch_size
+
+        bytes_per_item = self._estimate(self.make_key(batch_key))
+        if bytes_per_item is None:
+            return 1
+        return max(1, min(self.max_batch_size, math.floor(self.available_bytes() / bytes_per_item)))
+
+    def available_bytes(self):
+        """
+        Return the device memory batches may use now, within the headroom.
+        """
+        free_bytes, _ = torch.cuda.mem_get_info(self.device)
+        allocated_bytes = torch.cuda.memory_allocated(self.device)
+        # Memory cached by the allocator of torch is free for torch even though the driver counts it as used
+        available_bytes = free_bytes + torch.cuda.memory_reserved(self.device) - allocated_bytes
+        if self.memory_budget_bytes is not None:
+            available_bytes = min(available_bytes, self.memory_budget_bytes - allocated_bytes)
+        return max(available_bytes, 0) * self.headroom
+
+    def observe(self, batch_key, batch_size, work_bytes):
+        """
+        Record the memory a batch needed on top of the resident weights.
+
+        Args:
+            batch_key (tuple): The batch key of `StableDiffusor`.
+            batch_size (int): The number of images in the batch.
+            work_bytes (int): The peak memory of the batch on top of the memory allocated before it.
+        """
+        key = self.make_key(batch_key)
+        with self._lock:
+            # Keep the largest need seen, so that the estimate errs on the safe side
+            self._bytes_per_item[key] = max(self._bytes_per_item.get(key, 0), work_bytes / batch_size)
+
+    def observe_out_of_memory(self, batch_key, batch_size):
+        """
+        Record that a batch did not fit, so that the next batches of its key are planned smaller.
+
+        Args:
+            batch_key (tuple): The batch key of `StableDiffusor`.
+            batch_size (int): The number of images in the batch that ran out of memory.
+        """
+        if not is_cuda_device(self.device):
+            return
+        key = self.make_key(batch_key)
+        with self._lock:
+            bytes_per_item = self.available_bytes() / max(batch_size - 1, 1)
+            self._bytes_per_item[key] = max(self._bytes_per_item.get(key, 0), bytes_per_item)
+
+    def stats(self):
+        """
+        Report the measured memory need per image.
+
+        Returns:
+            dict: The bytes per image, by "{width}x{height}" and guidance.
+        """
+        with self._lock:
+            return {f"{size[0]}x{size[1]}{'_guided' if guided else ''}": int(bytes_per_item)
+                    for (size, guided), bytes_per_item in self._bytes_per_item.items()}
+
+    def _estimate(self, key):
+        with self._lock:
+            if key in self._bytes_per_item:
+                return self._bytes_per_item[key]
+            # Scale the highest per-pixel need measured at any size with the same guidance setting
+            (width, height), guided = key
+            per_pixel = [bytes_per_item / (size[0] * size[1])
+                         for (size, other_guided), bytes_per_item in self._bytes_per_item.items()
+                         if other_guided == guided]
+        return max(per_pixel) * width * height if per_pixel else None
@@ -0,0 +1,292 @@
+# Third-party libraries
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+diffusers = lazy_module("diffusers")
+
+
+def get_snapshot_path(snapshot_dir, model_id_or_path, torch_dtype):
+    """
+    Return the directory of the local snapshot of a model.
+
+    Args:
+        snapshot_dir (str): The directory holding the snapshots.
+        model_id_or_path (str): The model ID of the Stable Diffusion model.
+        torch_dtype (torch.dtype): The data type of the model weights.
+
+    Returns:
+        str: The snapshot directory, one per model and dtype.
+    """
+    return os.path.join(snapshot_dir, re.sub(r"[^\w.-]", "_", f"{model_id_or_path}-{torch_dtype}"))
+
+
+def save_snapshot(pipe, snapshot_path):
+    """
+    Save a pipeline as a safetensors snapshot. The snapshot only appears once it is complete, and failing to write
+    it leaves the pipeline usable.
+
+    Args:
+        pipe (StableDiffusionImg2ImgPipeline): The loaded pipeline.
+        snapshot_path (str): The directory of the snapshot.
+    """
+    temporary_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    try:
+        pipe.save_pretrained(temporary_path, safe_serialization=True)
+        os.replace(temporary_path, snapshot_path)
+    except OSError:
+        # Another process may have written the snapshot first, or the disk is full or read-only
+        pass
+    finally:
+        # Gone once it became the snapshot, otherwise a partial or redundant copy
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+
+def load_img2img_pipeline(model_id_or_path, device, torch_dtype, snapshot_dir=None):
+    """
+    Load a StableDiffusionImg2ImgPipeline and move it to the given device.
+
+    With a snapshot directory, a model fetched from the hub is saved there in the safetensors format once, and
+    later loads read that snapshot instead. Safetensors files are memory-mapped rather than unpickled, so a restart
+    maps weights that are still in the page cache instead of deserializing them again.
+
+    Args:
+        model_id_or_path (str): The model ID or local path of the Stable Diffusion model.
+        device (str): The device the pipeline should run on (e.g. "cuda").
+        torch_dtype (torch.dtype): The data type of the model weights.
+        snapshot_dir (str, optional): The directory holding the safetensors snapshots of the models.
+
+    Returns:
+        StableDiffusionImg2ImgPipeline: The loaded pipeline.
+    """
+    pipeline_class = diffusers.StableDiffusionImg2ImgPipeline
+    if snapshot_dir is None or os.path.isdir(model_id_or_path):
+        pipe = pipeline_class.from_pretrained(model_id_or_path, torch_dtype=torch_dtype)
+        return pipe.to(device)
+
+    snapshot_path = get_snapshot_path(snapshot_dir, model_id_or_path, torch_dtype)
+    if os.path.isdir(snapshot_path):
+        pipe = pipeline_class.from_pretrained(snapshot_path,
+                                              torch_dtype=torch_dtype,
+                                              use_safetensors=True,
+                                              local_files_only=True)
+    else:
+        pipe = pipeline_class.from_pretrained(model_id_or_path, torch_dtype=torch_dtype)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        save_snapshot(pipe, snapshot_path)
+    return pipe.to(device)
+
+
+def estimate_pipeline_size(pipe):
+    """
+    Estimate the memory held by a pipeline's weights.
+
+    Args:
+        pipe (DiffusionPipeline): The pipeline to measure.
+
+    Returns:
+        int: The total size of all parameters and buffers of the pipeline's torch modules, in bytes.
+    """
+    size_bytes = 0
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            size_bytes += sum(p.numel() * p.element_size() for p in component.parameters())
+            size_bytes += sum(b.numel() * b.element_size() for b in component.buffers())
+    return size_bytes
+
+
+class PipelineEntry:
+    """
+    A pipeline resident in a PipelineRegistry.
+
+    Attributes:
+        key (tuple): The (model_id_or_path, device, dtype) key of the entry.
+        pipeline (DiffusionPipeline): The loaded pipeline.
+        size_bytes (int): The estimated memory held by the pipeline's weights.
+        lock (threading.Lock): Serializes calls into the pipeline, whose scheduler keeps per-call state.
+        default_scheduler (SchedulerMixin): The scheduler the pipeline was loaded with.
+        schedulers (dict): Scheduler instances created for the pipeline, by name.
+        memory_mode (str or None): The memory mode the pipeline was configured for, None until it is configured.
+    """
+
+    def __init__(self, key, pipeline, size_bytes):
+        self.key = key
+        self.pipeline = pipeline
+        self.size_bytes = size_bytes
+        self.lock = threading.Lock()
+        self.default_scheduler = getattr(pipeline, "scheduler", None)
+        self.schedulers = {}
+        self.memory_mode = None
+
+
+class PipelineRegistry:
+    """
+    A process-wide registry of loaded diffusion pipelines shared across requests.
+
+    Pipelines are keyed by model ID, device and dtype, so each model is loaded once and reused. When the total
+    size of the resident pipelines exceeds the memory budget, the least recently used ones are evicted.
+
+    Attributes:
+        memory_budget_bytes (int or None): The maximum total size of resident pipelines. None means unbounded.
+        loader (callable): Called as loader(model_id_or_path, device, torch_dtype) to load a missing pipeline.
+    """
+
+    def __init__(self, memory_budget_bytes=None, loader=load_img2img_pipeline):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loader = loader
+        self._entries = OrderedDict()
+        self._known_sizes = {}
+        self._load_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_id_or_path, device, torch_dtype):
+        """
+        Build the registry key of a pipeline.
+
+        Args:
+            model_id_or_path (str): The model ID or local path.
+            device (str): The device name.
+            torch_dtype (torch.dtype): The data type of the weights.
+
+        Returns:
+            tuple: The registry key.
+        """
+        return model_id_or_path, str(device), str(torch_dtype)
+
+    def get(self, model_id_or_path, device, torch_dtype):
+        """
+        Return the resident pipeline for the given key, loading it first if needed.
+
+        Args:
+            model_id_or_path (str): The model ID or local path.
+            device (str): The device name.
+            torch_dtype (torch.dtype): The data type of the weights.
+
+        Returns:
+            PipelineEntry: The registry entry holding the pipeline.
+        """
+        key = self.make_key(model_id_or_path, device, torch_dtype)
+
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        # Only one thread loads a given key, the others wait for it and reuse its result
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        try:
+            with load_lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry
+
+                # Make room up front when the size of this model is known from an earlier load
+                self._evict(reserve_bytes=self._known_sizes.get(key, 0))
+
+                pipeline = self.loader(model_id_or_path, device, torch_dtype)
+                entry = PipelineEntry(key, pipeline, estimate_pipeline_size(pipeline))
+
+                with self._lock:
+                    self._entries[key] = entry
+                    self._known_sizes[key] = entry.size_bytes
+
+                self._evict(keep=key)
+                return entry
+        finally:
+            # Threads already waiting hold the lock itself, so it is dropped once the load is over
+            with self._lock:
+                if self._load_locks.get(key) is load_lock:
+                    del self._load_locks[key]
+
+    def get_pipeline(self, model_id_or_path, device, torch_dtype):
+        """
+        Return the resident pipeline for the given key, loading it first if needed.
+
+        Args:
+            model_id_or_path (str): The model ID or local path.
+            device (str): The device name.
+            torch_dtype (torch.dtype): The data type of the weights.
+
+        Returns:
+            DiffusionPipeline: The loaded pipeline.
+        """
+        return self.get(model_id_or_path, device, torch_dtype).pipeline
+
+    def resident_models(self):
+        """
+        Report the pipelines currently resident, from least to most recently used.
+
+        Returns:
+            list: One dictionary per pipeline with its model ID, device, dtype and size in bytes.
+        """
+        with self._lock:
+            return [{"model_id": entry.key[0],
+                     "device": entry.key[1],
+                     "dtype": entry.key[2],
+                     "size_bytes": entry.size_bytes} for entry in self._entries.values()]
+
+    def resident_bytes(self):
+        """
+        Return the total estimated size of all resident pipelines, in bytes.
+        """
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def evict(self, model_id_or_path, device, torch_dtype):
+        """
+        Drop a pipeline from the registry.
+
+        Returns:
+            bool: True if the pipeline was resident, False otherwise.
+        """
+        key = self.make_key(model_id_or_path, device, torch_dtype)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._release_device_memory()
+        return True
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _evict(self, reserve_bytes=0, keep=None):
+        if self.memory_budget_bytes is None:
+            return
+
+        evicted = False
+        with self._lock:
+            total = sum(entry.size_bytes for entry in self._entries.values()) + reserve_bytes
+            for key in list(self._entries):
+                if total <= self.memory_budget_bytes:
+                    break
+                if key == keep:
+                    continue
+                total -= self._entries.pop(key).size_bytes
+                evicted = True
+
+        if evicted:
+            self._release_device_memory()
+
+    @staticmethod
+    def _release_device_memory():
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+# The registry shared by every StableDiffusor that is not given one explicitly
+default_pipeline_registry = PipelineRegistry()
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+
+
+class PromptEmbeddingCache:
+    """
+    An LRU cache of text encoder outputs, so that prompts reused across requests are only encoded once.
+
+    Embeddings are keyed by the pipeline they were encoded with and the prompt text, and kept on the pipeline's
+    device until the total size exceeds the memory budget.
+
+    Attributes:
+        max_bytes (int): The size budget of the cached embeddings.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "encode_seconds": 0.0}
+
+    def get_embeddings(self, pipe, model_key, prompt):
+        """
+        Return the embeddings of a prompt, encoding it with the pipeline's text encoder on a miss.
+
+        Args:
+            pipe (StableDiffusionImg2ImgPipeline): The pipeline whose text encoder produces the embeddings.
+            model_key (tuple): The registry key of the pipeline.
+            prompt (str): The prompt text.
+
+        Returns:
+            torch.Tensor: The prompt embeddings, of shape (1, sequence length, hidden size).
+        """
+        key = (model_key, prompt)
+        with self._lock:
+            embeddings = self._entries.get(key)
+            if embeddings is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return embeddings
+
+        start = time.perf_counter()
+        with torch.inference_mode():
+            embeddings, _ = pipe.encode_prompt(prompt,
+                                               device=getattr(pipe, "_execution_device", pipe.device),
+                                               num_images_per_prompt=1,
+                                               do_classifier_free_guidance=False)
+        encode_seconds = time.perf_counter() - start
+
+        with self._lock:
+            self._counters["misses"] += 1
+            self._counters["encode_seconds"] += encode_seconds
+            self._put(key, embeddings)
+        return embeddings
+
+    def stats(self):
+        """
+        Report the hit rate of the cache and the text encoder time it saved.
+
+        Returns:
+            dict: Hit, miss and eviction counters, the hit ratio, the encoder time spent on misses and the
+                estimated encoder time saved by hits, along with the size of the cache.
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+            average_encode_seconds = stats["encode_seconds"] / stats["misses"] if stats["misses"] else 0.0
+            stats["encode_seconds_saved"] = stats["hits"] * average_encode_seconds
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            return stats
+
+    def _put(self, key, embeddings):
+        size = embeddings.numel() * embeddings.element_size()
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = embeddings
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+            self._counters["evictions"] += 1
@@ -0,0 +1,87 @@
+try:
+    from .lazy_imports import lazy_module
+except ImportError:
+    from lazy_imports import lazy_module
+
+diffusers = lazy_module("diffusers")
+
+# Schedulers that can be swapped into a loaded pipeline, by the name of their diffusers class; "default" keeps the
+# one shipped with the model
+SCHEDULERS = {
+    "default": None,
+    "dpm_solver_multistep": "DPMSolverMultistepScheduler",
+    "euler_ancestral": "EulerAncestralDiscreteScheduler",
+    "unipc": "UniPCMultistepScheduler",
+}
+
+# Quality tiers trading image quality for latency: the number of inference steps and the scheduler used
+QUALITY_TIERS = {
+    "draft": {"steps": 12, "scheduler": "dpm_solver_multistep"},
+    "standard": {"steps": 25, "scheduler": "dpm_solver_multistep"},
+    "high": {"steps": 50, "scheduler": "default"},
+}
+
+
+def resolve_quality_tier(quality):
+    """
+    Look up the inference steps and scheduler of a quality tier.
+
+    Args:
+        quality (str): The name of the tier, one of QUALITY_TIERS.
+
+    Raises:
+        ValueError: If the tier is unknown.
+
+    Returns:
+        tuple: The number of inference steps and the scheduler name.
+    """
+    if quality not in QUALITY_TIERS:
+        raise ValueError(f"Unknown quality tier {quality!r}, expected one of {', '.join(QUALITY_TIERS)}.")
+    tier = QUALITY_TIERS[quality]
+    return tier["steps"], tier["scheduler"]
+
+
+def effective_steps(steps, strength):
+    """
+    Return the number of denoising steps an img2img run actually performs.
+
+    Image-to-image generation skips the first (1 - strength) share of the schedule, so only part of the
+    requested inference steps are run.
+
+    Args:
+        steps (int): The number of inference steps.
+        strength (float): The strength of the diffusion process.
+
+    Returns:
+        int: The number of denoising steps run.
+    """
+    return min(int(steps * strength), steps)
+
+
+def get_scheduler(entry, name):
+    """
+    Return a scheduler instance for a pipeline, creating it from the pipeline's scheduler config once.
+
+    Schedulers share no weights with the model, so swapping them never reloads the pipeline.
+
+    Args:
+        entry (PipelineEntry): The registry entry of the pipeline.
+        name (str): The scheduler name, one of SCHEDULERS.
+
+    Raises:
+        ValueError: If the scheduler is unknown.
+
+    Returns:
+        SchedulerMixin: The scheduler instance cached on the entry.
+    """
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name!r}, expected one of {', '.join(SCHEDULERS)}.")
+
+    if name not in entry.schedulers:
+        scheduler_class_name = SCHEDULERS[name]
+        if scheduler_class_name is None:
+            entry.schedulers[name] = entry.default_scheduler
+        else:
+            scheduler_class = getattr(diffusers, scheduler_class_name)
+            entry.schedulers[name] = scheduler_class.from_config(entry.default_scheduler.config)
+    return entry.schedulers[name]
@@ -1,13 +1,48 @@
 # Third-party libraries
-import torch
+import time
+
 from PIL import ImageColor
-from diffusers import StableDiffusionImg2ImgPipeline
 
 # Import helper functions
 try:
     from .helpers import *
+    from .backends import optimize_pipeline, resolve_device, resolve_dtype
+    from .batch_scheduler import BatchScheduler
+    from .latent_cache import make_image_key, sample_latents
+    from .lazy_imports import lazy_module
+    from .memory import (BatchSizeGovernor, DeviceOutOfMemory, apply_memory_mode, is_cuda_device, is_out_of_memory,
+                         offloads_weights, track_peak_device_memory, validate_memory_mode)
+    from .pipeline_registry import default_pipeline_registry
+    from .previews import latents_to_preview
+    from .schedulers import get_scheduler
+    from .tensor_preprocessing import image_to_tensor, preprocess_batch
 except ImportError:
     from helpers import *
+    from backends import optimize_pipeline, resolve_device, resolve_dtype
+    from batch_scheduler import BatchScheduler
+    from latent_cache import make_image_key, sample_latents
+    from lazy_imports import lazy_module
+    from memory import (BatchSizeGovernor, DeviceOutOfMemory, apply_memory_mode, is_cuda_device, is_out_of_memory,
+                        offloads_weights, track_peak_device_memory, validate_memory_mode)
+    from pipeline_registry import default_pipeline_registry
+    from previews import latents_to_preview
+    from schedulers import get_scheduler
+    from tensor_preprocessing import image_to_tensor, preprocess_batch
+
+torch = lazy_module("torch")
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised by `StableDiffusor.generate_similar_image_by_color` when the request was cancelled through its
+    `is_cancelled` callback, before or during denoising.
+    """
+
+
+class _BatchCancelled(Exception):
+    """
+    Raised from the step callback to stop the denoising loop once every request of the batch is cancelled.
+    """
 
 
 class StableDiffusor:
@@ -17,17 +52,53 @@ class StableDiffusor:
 
     Attributes:
         pipe (StableDiffusionImg2ImgPipeline): The configured diffusion pipeline.
+        pipe_lock (threading.Lock): Serializes calls into the shared pipeline.
+        pipe_entry (PipelineEntry): The registry entry of the shared pipeline.
+        model_id_or_path (str): The model ID or path of the Stable Diffusion model.
+        device (str): The device for running the diffusion model. "auto" picks CUDA when available, then Apple
+            MPS, then the CPU, once the pipeline is created.
+        torch_dtype (torch.dtype or str): The data type of the model weights, or its name in torch, e.g. "float16",
+            so that torch is only imported once the pipeline is created. "auto" picks float16 on GPUs, and
+            bfloat16 or float32 on CPUs depending on whether they compute bfloat16 natively.
+        registry (PipelineRegistry): The registry the pipeline is loaded from and shared through.
+        batch_scheduler (BatchScheduler or None): Groups concurrent compatible requests into batched pipeline
+            calls. None when `max_batch_size` is 1.
+        batch_size_governor (BatchSizeGovernor or None): Bounds the batches formed by `batch_scheduler` to what
+            fits in the device memory. None when `max_batch_size` is 1.
+        prompt_cache (PromptEmbeddingCache or None): Caches the encoded prompts so that reused prompts skip the
+            text encoder. None disables it.
+        latent_cache (LatentCache or None): Caches the VAE encoded base images, so that requests reusing a base
+            image and color skip the color filter and the VAE encoder. None disables it.
+        memory_mode (str): How the pipeline trades speed for device memory, one of `memory.MEMORY_MODES`:
+            "full", "balanced" (sliced attention, sliced and tiled VAE), "low" (plus model offloading) or
+            "minimal" (plus sequential offloading). A pipeline shared through the registry keeps the mode of the
+            first StableDiffusor that used it.
+        channels_last (bool or None): Store the UNet and VAE weights in the channels-last memory format. None
+            enables it on the CPU only.
+        compile_unet (bool): Compile the UNet with `torch.compile`; ignored by the offloading memory modes.
+        tensor_preprocessing (bool): Run the color filter and the resolution normalization of each batch as
+            tensor operations on the device, and hand the pipeline the resulting tensors, instead of filtering
+            every image with PIL and NumPy and letting the pipeline convert it. The base image is copied out of
+            Pillow once. The color filter gives the same pixels either way; the resampling to the diffusion
+            resolution uses an antialiased bicubic filter instead of Lanczos.
 
     Methods:
-        __init__():
+        __init__(model_id_or_path='prompthero/openjourney-v4', device='auto', torch_dtype='auto',
+                 registry=None, max_batch_size=1, max_batch_wait_ms=10, prompt_cache=None, memory_mode='full',
+                 memory_budget_bytes=None, channels_last=None, compile_unet=False, latent_cache=None,
+                 tensor_preprocessing=False):
             Initializes a StableDiffusor object.
 
         create_pipeline():
-            Creates and configures a StableDiffusionImg2ImgPipeline for image generation.
+            Fetches the StableDiffusionImg2ImgPipeline from the registry, loading it on first use.
 
         generate_similar_image_by_color(base_image, positive_prompt, negative_prompt, hex_code='#008aed',
                                         smooth_factor=0.5, dilation_radius=5, strength=0.5,
-                                        guidance_scale=7.5, steps=25) -> PIL.Image.Image:
+                                        guidance_scale=7.5, steps=25, seed=None,
+                                        scheduler='default', target_size=None, max_side=None,
+                                        step_callback=None, prepared_base_image=None, stage_callback=None,
+                                        is_cancelled=None, memory_callback=None, base_image_digest=None,
+                                        preview_callback=None, preview_every=5) -> PIL.Image.Image:
             Generates a similar image by changing the color features of the base image.
 
             Args:
@@ -40,6 +111,21 @@ class StableDiffusor:
                 strength (float, optional): The strength parameter for the diffusion process.
                 guidance_scale (float, optional): The scale parameter for guidance in the diffusion process.
                 steps (int, optional): The number of steps in the diffusion process.
+                seed (int, optional): The seed of the random generator, random when omitted.
+                scheduler (str, optional): The name of the scheduler to denoise with.
+                target_size (tuple, optional): The display size the diffused image is normalized to.
+                max_side (int, optional): The maximum longer side of the diffused image.
+                step_callback (callable, optional): Called as step_callback(step, total_steps) after every step.
+                prepared_base_image (PIL.Image.Image, optional): The output of `prepare_base_image`.
+                stage_callback (callable, optional): Called as stage_callback(stage, seconds) for every stage.
+                is_cancelled (callable, optional): Returns True once nobody waits for the result anymore.
+                memory_callback (callable, optional): Called as memory_callback(peak_bytes) with the peak device
+                    memory of the batch.
+                base_image_digest (bytes or str, optional): The SHA-256 digest of the encoded base image, which
+                    the cached latents of its color filtered version are looked up by.
+                preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) with a
+                    low resolution approximation of the image every `preview_every` steps.
+                preview_every (int, optional): The number of denoising steps between two previews.
 
             Returns:
                 PIL.Image.Image: The generated image with similar features.
@@ -49,24 +135,120 @@ class StableDiffusor:
                   For more details about its parameters, refer to its docstring.
     """
 
-    def __init__(self):
+    def __init__(self,
+                 model_id_or_path="prompthero/openjourney-v4",
+                 device="auto",
+                 torch_dtype="auto",
+                 registry=None,
+                 max_batch_size=1,
+                 max_batch_wait_ms=10,
+                 prompt_cache=None,
+                 memory_mode="full",
+                 memory_budget_bytes=None,
+                 channels_last=None,
+                 compile_unet=False,
+                 latent_cache=None,
+                 tensor_preprocessing=False):
+        validate_memory_mode(memory_mode)
         self.pipe = None
+        self.pipe_lock = None
+        self.pipe_entry = None
+        self.model_id_or_path = model_id_or_path
+        self._device = device
+        self.torch_dtype = torch_dtype
+        self.registry = registry if registry is not None else default_pipeline_registry
+        self.prompt_cache = prompt_cache
+        self.latent_cache = latent_cache
+        self.memory_mode = memory_mode
+        self.channels_last = channels_last
+        self.compile_unet = compile_unet
+        self.tensor_preprocessing = tensor_preprocessing
+        self.batch_scheduler = None
+        self.batch_size_governor = None
+        if max_batch_size > 1:
+            self.batch_size_governor = BatchSizeGovernor(device=self._device,
+                                                         max_batch_size=max_batch_size,
+                                                         memory_budget_bytes=memory_budget_bytes)
+            self.batch_scheduler = BatchScheduler(run_batch=self._run_batch,
+                                                  max_batch_size=max_batch_size,
+                                                  max_wait_ms=max_batch_wait_ms,
+                                                  batch_size_limit=self.batch_size_governor.limit)
+
+    @property
+    def device(self):
+        """
+        str: The device the pipeline runs on. "auto" is resolved on first use rather than in `__init__`, so that
+        torch is only imported once the device is needed. Setting it moves the batch size governor along.
+        """
+        if self._device == "auto":
+            self.device = resolve_device(self._device)
+        return self._device
+
+    @device.setter
+    def device(self, device):
+        self._device = device
+        if self.batch_size_governor is not None:
+            self.batch_size_governor.device = device
 
     def create_pipeline(self):
         """
-        Create and configure a StableDiffusionImg2ImgPipeline for image generation.
+        Fetch the StableDiffusionImg2ImgPipeline for image generation from the registry.
+
+        The pipeline is loaded and moved to the device only the first time it is requested; afterwards the
+        resident instance is shared by every StableDiffusor using the same registry. Pipelines of the offloading
+        memory modes are loaded on the CPU and move their weights to the device while they run.
         """
-        # Specify the device for running the diffusion model
-        device = "cuda"
+        torch_dtype = resolve_dtype(self.device, self.torch_dtype)
+        offloading = offloads_weights(self.memory_mode)
+        entry = self.registry.get(self.model_id_or_path, "cpu" if offloading else self.device, torch_dtype)
+        if entry.memory_mode is None:
+            with entry.lock:
+                if entry.memory_mode is None:
+                    optimize_pipeline(entry.pipeline,
+                                      self.device,
+                                      channels_last=self.channels_last,
+                                      compile_unet=self.compile_unet and not offloading)
+                    apply_memory_mode(entry.pipeline, self.memory_mode, self.device)
+                    entry.memory_mode = self.memory_mode
+        self.pipe = entry.pipeline
+        self.pipe_lock = entry.lock
+        self.pipe_entry = entry
 
-        # Define the model ID or path for the Stable Diffusion model
-        model_id_or_path = "prompthero/openjourney-v4"
+    @staticmethod
+    def prepare_base_image(base_image, hex_code='#008aed', smooth_factor=0.5, dilation_radius=5, target_size=None,
+                           max_side=None) -> Image.Image:
+        """
+        Color filter the base image and bring it to the diffusion resolution, producing the initial image of the
+        diffusion process. The result only depends on the arguments, so it can be cached and passed to
+        `generate_similar_image_by_color` as `prepared_base_image`.
 
-        # Instantiate the StableDiffusionImg2ImgPipeline with the specified model and data type
-        self.pipe = StableDiffusionImg2ImgPipeline.from_pretrained(model_id_or_path, torch_dtype=torch.float16)
+        Args:
+            base_image (PIL.Image.Image): The base image to be modified.
+            hex_code (str): The hexadecimal color code which will be applied to the base image.
+            smooth_factor (float, optional): The interpolation factor between original and target color.
+            dilation_radius (int, optional): The radius for dilating the feature mask.
+            target_size (tuple, optional): The (width, height) the generated image is displayed at. When given,
+                the color filtered image is resized and cropped to the smallest multiple of 8 covering it.
+            max_side (int, optional): The maximum longer side of the diffused image when `target_size` is given.
 
-        # Move the pipeline to the specified device (e.g., GPU)
-        self.pipe = self.pipe.to(device)
+        Returns:
+            PIL.Image.Image: The color filtered image.
+        """
+        # Convert the hexadecimal color code to RGB format
+        rgb_color = ImageColor.getcolor(hex_code, "RGB")
+
+        # Extract and change color features of the base image
+        color_filtered_base_image = extract_features_and_change_their_color(original_image=base_image,
+                                                                            target_color=rgb_color,
+                                                                            smooth_factor=smooth_factor,
+                                                                            dilation_radius=dilation_radius)
+
+        # Diffuse at the resolution the image is displayed at rather than at the uploaded resolution
+        if target_size is not None:
+            color_filtered_base_image = normalize_resolution(color_filtered_base_image,
+                                                             target_size=target_size,
+                                                             max_side=max_side)
+        return color_filtered_base_image
 
     def generate_similar_image_by_color(self,
                                         base_image,
@@ -77,7 +259,19 @@ class StableDiffusor:
                                         dilation_radius=5,
                                         strength=0.5,
                                         guidance_scale=7.5,
-                                        steps=25) -> Image.Image:
+                                        steps=25,
+                                        seed=None,
+                                        scheduler="default",
+                                        target_size=None,
+                                        max_side=None,
+                                        step_callback=None,
+                                        prepared_base_image=None,
+                                        stage_callback=None,
+                                        is_cancelled=None,
+                                        memory_callback=None,
+                                        base_image_digest=None,
+                                        preview_callback=None,
+                                        preview_every=5) -> Image.Image:
         """
         Generate a similar image by changing the color features of the base image using the stable diffusion
         Image-to-Image transformation method.
@@ -91,7 +285,43 @@ class StableDiffusor:
             dilation_radius (int, optional): The radius for dilating the feature mask.
             strength (float, optional): The strength parameter for the diffusion process.
             guidance_scale (float, optional): The scale parameter for guidance in the diffusion process.
-            steps (int, optional): The number of steps in the diffusion process.
+            steps (int, optional): The number of inference steps of the diffusion process. With image-to-image
+                generation only about `steps * strength` of them are run.
+            seed (int, optional): The seed of the random generator. The same seed and inputs produce the same
+                image; a random seed is used when omitted.
+            scheduler (str, optional): The name of the scheduler to denoise with, see `schedulers.SCHEDULERS`.
+                Defaults to the scheduler shipped with the model.
+            target_size (tuple, optional): The (width, height) the generated image is displayed at. When given,
+                the color filtered image is resized and cropped to the smallest multiple of 8 covering it before
+                diffusion, instead of diffusing at the uploaded resolution.
+            max_side (int, optional): The maximum longer side of the diffused image when `target_size` is given.
+            step_callback (callable, optional): Called as step_callback(step, total_steps) after every denoising
+                step.
+            prepared_base_image (PIL.Image.Image, optional): The output of `prepare_base_image` for these
+                arguments. When given, `base_image` is not used and the color filter is skipped.
+            stage_callback (callable, optional): Called as stage_callback(stage, seconds) with the time spent in
+                each stage of the generation: "color_filter", "pipeline_load" when the pipeline had to be loaded,
+                "text_encoding" when prompts are encoded through the prompt cache, "vae_encoding" when base images
+                are encoded through the latent cache, and "denoising". The batched stages report the time of the
+                whole batch.
+            is_cancelled (callable, optional): Called without arguments before the pipeline call and after every
+                denoising step; returns True once nobody waits for the result anymore. A cancelled request is left
+                out of its batch, and the denoising loop stops once every request of the batch is cancelled.
+            memory_callback (callable, optional): Called as memory_callback(peak_bytes) with the peak device memory
+                allocated while the batch of the request ran. Only reported on CUDA devices.
+            base_image_digest (bytes or str, optional): The SHA-256 digest of the encoded base image, e.g. its asset
+                ID. With a latent cache, the latents of the color filtered image are looked up by it and the color
+                arguments, and on a hit the color filter and the VAE encoder are skipped.
+            preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) every
+                `preview_every` denoising steps, except after the last one, with an approximation of the image
+                being denoised. The preview is mapped linearly from the latents instead of decoded by the VAE, so
+                it costs next to nothing but is blurry, has 1/8 of the final resolution and shows the noise left
+                at that step.
+            preview_every (int, optional): The number of denoising steps between two previews.
+
+        Raises:
+            GenerationCancelled: If the request was cancelled.
+            DeviceOutOfMemory: If the request does not fit in the device memory, even on its own.
 
         Returns:
             PIL.Image.Image: The generated image with similar features.
@@ -100,28 +330,294 @@ class StableDiffusor:
             - The `extract_features_and_change_their_color` function is used internally to change color features.
               For more details about its parameters, refer to its docstring.
         """
-        # Convert the hexadecimal color code to RGB format
-        rgb_color = ImageColor.getcolor(hex_code, "RGB")
+        # The cached latents are looked up by the inputs of the color filter, so a hit skips the filter as well
+        image_key, latent_distribution = None, None
+        if self.latent_cache is not None and base_image_digest is not None:
+            image_key = make_image_key(base_image_digest,
+                                       hex_code=hex_code,
+                                       smooth_factor=smooth_factor,
+                                       dilation_radius=dilation_radius,
+                                       target_size=target_size,
+                                       max_side=max_side)
+            if self.pipe_entry is not None:
+                latent_distribution = self.latent_cache.lookup(self.pipe_entry.key, image_key)
 
-        # Extract and change color features of the base image
-        color_filtered_base_image = extract_features_and_change_their_color(original_image=base_image,
-                                                                            target_color=rgb_color,
-                                                                            smooth_factor=smooth_factor,
-                                                                            dilation_radius=dilation_radius)
+        color_filtered_base_image = prepared_base_image
+        color_filter = None
+        if color_filtered_base_image is None and latent_distribution is None and self.tensor_preprocessing:
+            # The color filter runs with the batch, on the device
+            color_filter = {"target_color": ImageColor.getcolor(hex_code, "RGB"),
+                            "smooth_factor": smooth_factor,
+                            "dilation_radius": dilation_radius,
+                            "target_size": target_size,
+                            "max_side": max_side}
+        elif color_filtered_base_image is None and latent_distribution is None:
+            start = time.perf_counter()
+            color_filtered_base_image = self.prepare_base_image(base_image,
+                                                                hex_code=hex_code,
+                                                                smooth_factor=smooth_factor,
+                                                                dilation_radius=dilation_radius,
+                                                                target_size=target_size,
+                                                                max_side=max_side)
+            if stage_callback is not None:
+                stage_callback("color_filter", time.perf_counter() - start)
 
-        # Create the transformation pipeline
-        self.create_pipeline()
+        pixels = None
+        if latent_distribution is not None:
+            latent_shape = latent_distribution[0].shape
+            image_size = (latent_shape[3] * 8, latent_shape[2] * 8)
+        else:
+            if color_filter is None:
+                image_size = color_filtered_base_image.size
+            elif target_size is not None:
+                image_size, _ = get_normalized_geometry(base_image.size, target_size, max_side=max_side)
+            else:
+                image_size = base_image.size
+            if self.latent_cache is not None:
+                # The VAE encodes images cropped to a multiple of 8
+                image_size = tuple(side - side % 8 for side in image_size)
+            if self.tensor_preprocessing:
+                pixels = image_to_tensor(base_image if color_filter is not None else color_filtered_base_image)
+
+        # Requests can only share a pipeline call when these parameters and the image size match
+        batch_key = (strength, guidance_scale, steps, scheduler, image_size)
+        request = {"prompt": positive_prompt,
+                   "negative_prompt": negative_prompt,
+                   "image": color_filtered_base_image,
+                   "image_key": image_key,
+                   "latent_distribution": latent_distribution,
+                   "pixels": pixels,
+                   "color_filter": color_filter,
+                   "seed": seed,
+                   "step_callback": step_callback,
+                   "stage_callback": stage_callback,
+                   "is_cancelled": is_cancelled,
+                   "memory_callback": memory_callback,
+                   "preview_callback": preview_callback,
+                   "preview_every": max(int(preview_every), 1)}
 
         # Generate the final output image by applying the stable diffusion process
-        output_image = self.pipe(prompt=positive_prompt,
-                                 negative_prompt=negative_prompt,
-                                 image=color_filtered_base_image,
-                                 strength=strength,
-                                 guidance_scale=guidance_scale,
-                                 steps=steps).images[0]
+        if self.batch_scheduler is None:
+            output_image = self._run_batch(batch_key, [request])[0]
+        else:
+            output_image = self.batch_scheduler.submit(batch_key, request).result()
 
+        # Cancelled requests get no image, or one nobody is waiting for anymore
+        if output_image is None or (is_cancelled is not None and is_cancelled()):
+            raise GenerationCancelled()
         return output_image
 
+    def _run_batch(self, batch_key, requests):
+        """
+        Run a list of compatible requests through the pipeline as a single batched call.
+
+        A batch that runs out of device memory is split in two halves that are run one after the other, and the
+        batch size governor learns to form smaller batches of its kind.
+
+        Args:
+            batch_key (tuple): The (strength, guidance_scale, steps, scheduler, image size) shared by the requests.
+            requests (list): Dictionaries holding the prompt, negative prompt, color filtered image, its pixels
+                and color filter for the tensor preprocessing, or its cached latent distribution, seed and callbacks
+                per item.
+
+        Raises:
+            DeviceOutOfMemory: If a single request runs out of device memory.
+
+        Returns:
+            list: The generated images, in the order of `requests`, None for the cancelled requests.
+        """
+        strength, guidance_scale, steps, scheduler, _ = batch_key
+
+        def cancelled(request):
+            return request.get("is_cancelled") is not None and request["is_cancelled"]()
+
+        # Requests given up on while they were queued are left out of the pipeline call
+        skipped = [cancelled(request) for request in requests]
+        if any(skipped):
+            active = [request for request, skip in zip(requests, skipped) if not skip]
+            images = iter(self._run_batch(batch_key, active) if active else [])
+            return [None if skip else next(images) for skip in skipped]
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            # Report progress to every request taking part in the batch
+            latents = callback_kwargs.get("latents")
+            for index, request in enumerate(requests):
+                if request["step_callback"] is not None:
+                    request["step_callback"](step + 1, pipe.num_timesteps)
+                # The final image follows the last step anyway, so no preview is made for it
+                if request.get("preview_callback") is not None and latents is not None and \
+                        (step + 1) % request["preview_every"] == 0 and step + 1 < pipe.num_timesteps:
+                    request["preview_callback"](step + 1, pipe.num_timesteps, latents_to_preview(latents[index]))
+            # Stop denoising once nobody waits for any of the images; a partly cancelled batch runs to the end
+            if all(cancelled(request) for request in requests):
+                raise _BatchCancelled()
+            return callback_kwargs
+
+        def report_stage(stage, start):
+            seconds = time.perf_counter() - start
+            for request in requests:
+                if request.get("stage_callback") is not None:
+                    request["stage_callback"](stage, seconds)
+
+        # Fetch the shared transformation pipeline
+        previous_entry = self.pipe_entry
+        start = time.perf_counter()
+        self.create_pipeline()
+        if self.pipe_entry is not previous_entry:
+            report_stage("pipeline_load", start)
+
+        # One generator per item keeps every seeded item reproducible regardless of what it is batched with
+        generators = []
+        for request in requests:
+            generator = torch.Generator(device=self.device)
+            if request["seed"] is None:
+                generator.seed()
+            else:
+                generator.manual_seed(request["seed"])
+            generators.append(generator)
+
+        with self.pipe_lock:
+            # Swap the scheduler on the shared pipeline; the weights stay where they are
+            self.pipe.scheduler = get_scheduler(self.pipe_entry, scheduler)
+
+            start = time.perf_counter()
+            prompt_arguments = self._prompt_arguments(requests)
+            if self.prompt_cache is not None:
+                report_stage("text_encoding", start)
+
+            images = [request["image"] for request in requests]
+            if self.tensor_preprocessing:
+                start = time.perf_counter()
+                images = self._preprocess_tensors(requests)
+                report_stage("color_filter", start)
+
+            start = time.perf_counter()
+            image_argument = self._image_argument(requests, images, generators)
+            if self.latent_cache is not None:
+                report_stage("vae_encoding", start)
+
+            start = time.perf_counter()
+            try:
+                with track_peak_device_memory(self.device) as memory:
+                    images = self.pipe(**prompt_arguments,
+                                       image=image_argument,
+                                       strength=strength,
+                                       guidance_scale=guidance_scale,
+                                       num_inference_steps=steps,
+                                       generator=generators,
+                                       callback_on_step_end=on_step_end).images
+            except _BatchCancelled:
+                images = [None] * len(requests)
+            except Exception as exc:
+                if not is_out_of_memory(exc):
+                    raise
+                if self.batch_size_governor is not None:
+                    self.batch_size_governor.observe_out_of_memory(batch_key, len(requests))
+                if len(requests) == 1:
+                    raise DeviceOutOfMemory(f"The image of size {batch_key[-1]} does not fit in the memory of "
+                                            f"{self.device}.") from exc
+                images = None
+            report_stage("denoising", start)
+
+        if images is None:
+            # Hand the memory the failed call left cached back before retrying in halves, outside of the pipeline
+            # lock that each half takes again
+            del prompt_arguments, images, image_argument
+            if is_cuda_device(self.device):
+                torch.cuda.empty_cache()
+            middle = len(requests) // 2
+            return self._run_batch(batch_key, requests[:middle]) + self._run_batch(batch_key, requests[middle:])
+
+        if memory.peak_bytes is not None:
+            if self.batch_size_governor is not None and images[0] is not None:
+                self.batch_size_governor.observe(batch_key, len(requests), memory.work_bytes)
+            for request in requests:
+                if request.get("memory_callback") is not None:
+                    request["memory_callback"](memory.peak_bytes)
+        return images
+
+    def _preprocess_tensors(self, requests):
+        """
+        Color filter and normalize the images of a batch on the device. Images of the same size are filtered
+        together, in a single batched call.
+
+        Args:
+            requests (list): The requests of the batch.
+
+        Returns:
+            list: The (1, 3, height, width) images in [0, 1] on the device, None for the requests starting from
+                cached latents.
+        """
+        device = getattr(self.pipe, "_execution_device", self.device)
+        groups = {}
+        for index, request in enumerate(requests):
+            if request["pixels"] is not None:
+                groups.setdefault(tuple(request["pixels"].shape), []).append(index)
+
+        images = [None] * len(requests)
+        for indices in groups.values():
+            group_images = preprocess_batch([requests[index]["pixels"] for index in indices],
+                                            [requests[index]["color_filter"] for index in indices],
+                                            device)
+            for index, image in zip(indices, group_images):
+                images[index] = image
+        return images
+
+    def _image_argument(self, requests, images, generators):
+        """
+        Build the image argument of a batched pipeline call.
+
+        With a latent cache, the images are passed as their VAE latents, which the pipeline starts denoising from
+        without encoding them again; otherwise the pipeline encodes the color filtered images itself. The latents
+        are sampled from the cached distributions with the generator of each request before the pipeline draws
+        its noise from it, in the order the pipeline itself would, so a seed gives the same image either way.
+
+        Args:
+            requests (list): The requests of the batch.
+            images (list): The color filtered images of the requests, as PIL images or as the tensors of the
+                tensor preprocessing. None for the requests starting from cached latents.
+            generators (list): The generators of the requests.
+
+        Returns:
+            list or torch.Tensor: The color filtered images, the batch of their tensors, or the batch of their
+                latents.
+        """
+        if self.latent_cache is None:
+            return torch.cat(images) if self.tensor_preprocessing else images
+
+        def encode(request, image, generator):
+            distribution = request["latent_distribution"]
+            if distribution is None:
+                distribution = self.latent_cache.get_distribution(self.pipe, self.pipe_entry.key,
+                                                                  request["image_key"], image)
+            return sample_latents(self.pipe, distribution, generator)
+
+        return torch.cat([encode(request, image, generator)
+                          for request, image, generator in zip(requests, images, generators)])
+
+    def _prompt_arguments(self, requests):
+        """
+        Build the prompt arguments of a batched pipeline call.
+
+        With a prompt cache, the prompts are passed as precomputed embeddings so that reused prompts skip the
+        text encoder; otherwise the pipeline encodes the prompt texts itself.
+
+        Args:
+            requests (list): The requests of the batch.
+
+        Returns:
+            dict: The prompt keyword arguments of the pipeline call.
+        """
+        if self.prompt_cache is None:
+            return {"prompt": [request["prompt"] for request in requests],
+                    "negative_prompt": [request["negative_prompt"] for request in requests]}
+
+        def encode(prompt):
+            return self.prompt_cache.get_embeddings(self.pipe, self.pipe_entry.key, prompt)
+
+        return {"prompt_embeds": torch.cat([encode(request["prompt"]) for request in requests]),
+                "negative_prompt_embeds": torch.cat([encode(request["negative_prompt"]) for request in requests])}
+
 
 if __name__ == "__main__":
     # Create an instance of the StableDiffusor class
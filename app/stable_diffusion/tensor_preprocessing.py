@@ -0,0 +1,164 @@
+import warnings
+
+import numpy as np
+
+try:
+    from .helpers import get_normalized_geometry, make_blend_lookup_table
+    from .lazy_imports import lazy_module
+except ImportError:
+    from helpers import get_normalized_geometry, make_blend_lookup_table
+    from lazy_imports import lazy_module
+
+torch = lazy_module("torch")
+
+# The fixed-point weights Pillow converts RGB to grayscale with (ITU-R 601-2 luma, scaled by 2 ** 16)
+GRAYSCALE_WEIGHTS = (19595, 38470, 7471)
+
+# Image modes whose pixels are taken from Pillow as they are; the others are converted to RGB first
+TENSOR_MODES = ("RGB", "RGBA", "L")
+
+
+def image_to_tensor(image):
+    """
+    Take the pixels of a decoded image out of Pillow with a single copy, into a contiguous buffer the device
+    transfer reads from.
+
+    Args:
+        image (PIL.Image.Image): The image. RGB, RGBA and grayscale images are taken as they are and reduced to RGB
+            on the device by `pixels_to_rgb`; other modes are converted to RGB first.
+
+    Returns:
+        torch.Tensor: The uint8 pixels, of shape (height, width, channels), on the CPU.
+    """
+    if image.mode not in TENSOR_MODES:
+        image = image.convert("RGB")
+    with warnings.catch_warnings():
+        # The buffer is only ever read from, so it is wrapped as is even though bytes are immutable
+        warnings.simplefilter("ignore", UserWarning)
+        pixels = torch.frombuffer(image.tobytes(), dtype=torch.uint8)
+    return pixels.view(image.height, image.width, len(image.getbands()))
+
+
+def pixels_to_rgb(pixels):
+    """
+    Bring a batch of pixels from `image_to_tensor` to the channel-first RGB layout of the pipeline.
+
+    Args:
+        pixels (torch.Tensor): uint8 pixels of shape (batch, height, width, channels).
+
+    Returns:
+        torch.Tensor: The uint8 RGB pixels, of shape (batch, 3, height, width). Alpha channels are dropped and
+            grayscale is repeated over the color channels, like a conversion to RGB does.
+    """
+    pixels = pixels.permute(0, 3, 1, 2)
+    if pixels.shape[1] == 1:
+        return pixels.expand(-1, 3, -1, -1)
+    return pixels[:, :3]
+
+
+def change_feature_colors(pixels, target_colors, smooth_factors, dilation_radii):
+    """
+    Batched tensor version of `extract_features_and_change_their_color`, producing the same pixels on any device.
+
+    The grayscale conversion uses the fixed-point arithmetic of Pillow, the dilation grows the feature mask by a
+    taxicab distance of the radius like the distance transform does, in `radius` cross-shaped max pooling passes,
+    and the blend indexes the same lookup tables.
+
+    Args:
+        pixels (torch.Tensor): uint8 RGB pixels of shape (batch, 3, height, width).
+        target_colors (list): The target color of every image, in RGB format.
+        smooth_factors (list): The interpolation factor between original and target color of every image.
+        dilation_radii (list): The radius the feature mask of every image is dilated by.
+
+    Returns:
+        torch.Tensor: The color filtered uint8 pixels, of the same shape and on the same device.
+    """
+    device = pixels.device
+    batch_size = pixels.shape[0]
+    channels = pixels.to(torch.int32)
+
+    # Features are the pixels whose grayscale value is not white
+    red, green, blue = GRAYSCALE_WEIGHTS
+    grayscale = (channels[:, 0] * red + channels[:, 1] * green + channels[:, 2] * blue + 0x8000) >> 16
+    feature_mask = (grayscale < 255).unsqueeze(1).to(torch.float32)
+
+    # Every pass grows the mask by one pixel in the four directions; images with smaller radii stop growing early
+    radii = torch.tensor(dilation_radii, device=device).view(-1, 1, 1, 1)
+    for iteration in range(max(dilation_radii, default=0)):
+        grown = torch.maximum(torch.nn.functional.max_pool2d(feature_mask, (3, 1), stride=1, padding=(1, 0)),
+                              torch.nn.functional.max_pool2d(feature_mask, (1, 3), stride=1, padding=(0, 1)))
+        feature_mask = torch.where(radii > iteration, grown, feature_mask)
+
+    # The tables are built with NumPy, like the PIL implementation does, so both truncate the blend alike
+    lookup_tables = torch.from_numpy(np.stack([make_blend_lookup_table(target_color, smooth_factor)
+                                               for target_color, smooth_factor in zip(target_colors,
+                                                                                       smooth_factors)]))
+    lookup_tables = lookup_tables.to(device).view(-1)
+    offsets = (torch.arange(batch_size, device=device).view(-1, 1, 1, 1) * 3 +
+               torch.arange(3, device=device).view(1, -1, 1, 1)) * 256
+    blended = lookup_tables[channels.to(torch.int64) + offsets]
+
+    return torch.where(feature_mask > 0, blended, pixels)
+
+
+def normalize_tensor_resolution(pixels, target_size, multiple=8, max_side=None):
+    """
+    Tensor version of `normalize_resolution`: center crop and resize images to the diffusion resolution on their
+    device. Resampled with an antialiased bicubic filter instead of Lanczos, so the pixels are close to, but not
+    the same as, the ones of the PIL implementation.
+
+    Args:
+        pixels (torch.Tensor): Float pixels of shape (batch, 3, height, width).
+        target_size (tuple): The (width, height) the generated image is finally displayed at.
+        multiple (int, optional): Both sides of the result are a multiple of this value. Defaults to 8.
+        max_side (int, optional): The maximum length of the longer side of the result. Defaults to no limit.
+
+    Returns:
+        torch.Tensor: The normalized pixels.
+    """
+    height, width = pixels.shape[2:]
+    (target_width, target_height), (left, upper, right, lower) = get_normalized_geometry(
+        (width, height), target_size, multiple=multiple, max_side=max_side)
+    if (width, height) == (target_width, target_height):
+        return pixels
+
+    cropped = pixels[:, :, round(upper):round(lower), round(left):round(right)]
+    return torch.nn.functional.interpolate(cropped, size=(target_height, target_width), mode="bicubic",
+                                           align_corners=False, antialias=True)
+
+
+def preprocess_batch(pixels, color_filters, device):
+    """
+    Color filter and normalize a batch of images of the same size on the device, handing them over the way the
+    pipeline takes them.
+
+    Args:
+        pixels (list): The (height, width, channels) uint8 pixels of every image, from `image_to_tensor`.
+        color_filters (list): Per image, None when the pixels are already color filtered and normalized, or the
+            keyword arguments of the filter: target_color, smooth_factor, dilation_radius, target_size and
+            max_side.
+        device (str or torch.device): The device the images are processed on.
+
+    Returns:
+        list: The (1, 3, height, width) float32 images in [0, 1], on the device.
+    """
+    # Moved one by one and stacked on the device, so the host holds no second copy of the pixels
+    batch = pixels_to_rgb(torch.stack([item.to(device, non_blocking=True) for item in pixels]))
+
+    filtered = [index for index, color_filter in enumerate(color_filters) if color_filter is not None]
+    if filtered:
+        changed = change_feature_colors(batch[filtered],
+                                        target_colors=[color_filters[index]["target_color"] for index in filtered],
+                                        smooth_factors=[color_filters[index]["smooth_factor"] for index in filtered],
+                                        dilation_radii=[color_filters[index]["dilation_radius"] for index in filtered])
+        batch = batch.clone()
+        batch[filtered] = changed
+
+    images = []
+    for index, color_filter in enumerate(color_filters):
+        image = batch[index:index + 1].to(torch.float32)
+        if color_filter is not None and color_filter.get("target_size") is not None:
+            image = normalize_tensor_resolution(image, color_filter["target_size"],
+                                                max_side=color_filter.get("max_side"))
+        images.append((image / 255).clamp(0, 1))
+    return images
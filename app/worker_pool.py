@@ -0,0 +1,422 @@
+import contextvars
+import functools
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from admission import CancellationToken
+from instrumentation import current_timings, record_peak_memory, record_stage, start_request
+from stable_diffusion.backends import get_cpu_quota
+
+
+class WorkerCrashed(RuntimeError):
+    """
+    Raised for the tasks that were in flight on a worker process when it died.
+    """
+
+
+def share_image(image):
+    """
+    Copy the pixels of an image into a new shared memory block.
+
+    The palette of "P" and "PA" images and the transparency of the image travel in the descriptor, since the
+    pixels alone lose them.
+
+    Args:
+        image (PIL.Image.Image): The image.
+
+    Returns:
+        tuple: The shared memory block, to be unlinked by the caller once the image was read, and the descriptor
+            `load_shared_image` reads the image back from.
+    """
+    data = image.tobytes()
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    descriptor = {"type": "image", "name": block.name, "mode": image.mode, "size": image.size, "length": len(data)}
+    if image.palette is not None:
+        descriptor["palette"] = (image.palette.mode, image.palette.tobytes())
+    if "transparency" in image.info:
+        descriptor["transparency"] = image.info["transparency"]
+    return block, descriptor
+
+
+def load_shared_image(descriptor, unlink=False):
+    """
+    Read an image back from the shared memory block described by `share_image`.
+
+    Args:
+        descriptor (dict): The descriptor of the block.
+        unlink (bool, optional): Free the block once it was read.
+
+    Returns:
+        PIL.Image.Image: A copy of the image, independent of the block.
+    """
+    block = shared_memory.SharedMemory(name=descriptor["name"])
+    try:
+        image = Image.frombytes(descriptor["mode"], tuple(descriptor["size"]),
+                                bytes(block.buf[:descriptor["length"]]))
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+    if "palette" in descriptor:
+        palette_mode, palette = descriptor["palette"]
+        image.putpalette(palette, rawmode=palette_mode)
+    if "transparency" in descriptor:
+        image.info["transparency"] = descriptor["transparency"]
+    return image
+
+
+def share_entries(entries):
+    """
+    Copy named files, e.g. encoded images, into a single new shared memory block.
+
+    Args:
+        entries (list): (name, bytes) pairs.
+
+    Returns:
+        tuple: The shared memory block and the descriptor `load_shared_entries` reads the files back from.
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(sum(len(content) for _, content in entries), 1))
+    layout, offset = [], 0
+    for name, content in entries:
+        block.buf[offset:offset + len(content)] = content
+        layout.append((name, offset, len(content)))
+        offset += len(content)
+    return block, {"type": "entries", "name": block.name, "entries": layout}
+
+
+def load_shared_entries(descriptor, unlink=False):
+    """
+    Read the files back from the shared memory block described by `share_entries`.
+
+    Args:
+        descriptor (dict): The descriptor of the block.
+        unlink (bool, optional): Free the block once it was read.
+
+    Returns:
+        list: (name, bytes) pairs.
+    """
+    block = shared_memory.SharedMemory(name=descriptor["name"])
+    try:
+        return [(name, bytes(block.buf[offset:offset + length])) for name, offset, length in descriptor["entries"]]
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+
+
+class _Worker:
+    """
+    The parent side of a worker process.
+    """
+
+    def __init__(self, index, device, cpu_ids):
+        self.index = index
+        self.device = device
+        self.cpu_ids = cpu_ids
+        self.process = None
+        self.task_queue = None
+        self.ready = False
+        self.restarts = 0
+        self.tasks = {}
+
+
+class WorkerPool:
+    """
+    A pool of worker processes, each holding its own diffusion pipeline, fed from the API process.
+
+    Tasks are functions run in a worker with their images and keyword arguments. The images and the results go
+    through shared memory blocks rather than being pickled; only their descriptors and the keyword arguments are
+    sent over the task queues. Each task is routed to the worker with the fewest tasks in flight, and a worker
+    runs up to `concurrency` tasks at once on threads, so that they can share batched pipeline calls. Workers
+    that die are started again, and the tasks they had in flight fail with WorkerCrashed.
+
+    Attributes:
+        initializer (callable or None): Called in every worker as initializer(device, num_threads) before it takes
+            tasks, e.g. to load the pipeline.
+        num_workers (int): The number of worker processes.
+        devices (list): The devices the workers are spread over, in turn.
+        threads_per_worker (int or None): The CPU cores each worker is pinned to; None splits the CPU quota of the
+            container evenly.
+        concurrency (int): The number of tasks a worker runs at once.
+        poll_seconds (float): How often the workers are checked for crashes and the tasks for cancellation.
+        restart_delay_seconds (float): How long to wait before starting a crashed worker again.
+    """
+
+    def __init__(self, initializer=None, num_workers=2, devices=("cpu",), threads_per_worker=None, concurrency=1,
+                 poll_seconds=0.25, restart_delay_seconds=1.0):
+        self.initializer = initializer
+        self.num_workers = num_workers
+        self.devices = list(devices)
+        self.threads_per_worker = threads_per_worker
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.restart_delay_seconds = restart_delay_seconds
+        # CUDA cannot be used in forked processes
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = []
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closed = False
+
+    def start(self):
+        """
+        Start the worker processes, unless they are already running.
+        """
+        with self._lock:
+            if self._workers:
+                return
+            cpu_ids = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+                else list(range(os.cpu_count() or 1))
+            per_worker = self.threads_per_worker or max(get_cpu_quota() // self.num_workers, 1)
+            for index in range(self.num_workers):
+                worker_cpu_ids = [cpu_ids[(index * per_worker + offset) % len(cpu_ids)]
+                                  for offset in range(per_worker)]
+                worker = _Worker(index, self.devices[index % len(self.devices)], worker_cpu_ids)
+                self._workers.append(worker)
+                self._spawn(worker)
+
+    def run(self, fn, images, step_callback=None, cancellation=None, preview_callback=None, **params):
+        """
+        Run a task on the least loaded worker and wait for its result. Starts the workers on first use.
+
+        Args:
+            fn (callable): The task, a module-level function called in the worker as fn(images=..., step_callback=
+                ..., cancellation=..., **params). It returns a PIL image or a list of (name, bytes) pairs.
+            images (dict): The PIL images of the task by name, handed over through shared memory.
+            step_callback (callable, optional): Called as step_callback(step, total_steps) with the progress the
+                task reports.
+            cancellation (CancellationToken, optional): Relayed to the token the task receives in the worker.
+            preview_callback (callable, optional): Called as preview_callback(step, total_steps, image) with the
+                previews the task reports. When given, the task is called with a `preview_callback` as well.
+            **params: Picklable keyword arguments of the task.
+
+        Raises:
+            WorkerCrashed: If the worker died while running the task.
+            Exception: The error raised by the task.
+
+        Returns:
+            PIL.Image.Image or list: The result of the task.
+        """
+        self.start()
+        timings = current_timings()
+        blocks, descriptors = [], {}
+        try:
+            for name, image in images.items():
+                block, descriptors[name] = share_image(image)
+                blocks.append(block)
+
+            future = Future()
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("WorkerPool is shut down.")
+                # Least loaded first, preferring workers that are up over ones still starting
+                worker = min(self._workers, key=lambda item: (not item.ready, len(item.tasks)))
+                task_id = next(self._task_ids)
+                worker.tasks[task_id] = {"future": future,
+                                         "step_callback": step_callback,
+                                         "cancellation": cancellation,
+                                         "preview_callback": preview_callback,
+                                         "cancel_sent": False}
+                worker.task_queue.put(("task", task_id, fn, descriptors, params, preview_callback is not None))
+            descriptor, stages, peak_memory_bytes = future.result()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        # Report the stages timed and the device memory measured in the worker with the request
+        for stage, seconds in stages.items():
+            record_stage(stage, seconds, timings)
+        if peak_memory_bytes is not None:
+            record_peak_memory(peak_memory_bytes, timings)
+
+        # The worker allocated the result block; it is freed here once read
+        if descriptor["type"] == "image":
+            return load_shared_image(descriptor, unlink=True)
+        return load_shared_entries(descriptor, unlink=True)
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until at least one worker has started and is taking tasks.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds.
+
+        Returns:
+            bool: True if a worker is ready.
+        """
+        return self._ready.wait(timeout)
+
+    def stats(self):
+        """
+        Report the state of every worker.
+
+        Returns:
+            list: The index, device, process ID, readiness, tasks in flight and restart count of every worker.
+        """
+        with self._lock:
+            return [{"worker": worker.index,
+                     "device": worker.device,
+                     "pid": worker.process.pid if worker.process is not None else None,
+                     "ready": worker.ready,
+                     "in_flight": len(worker.tasks),
+                     "restarts": worker.restarts} for worker in self._workers]
+
+    def shutdown(self):
+        """
+        Stop the workers once they finished the tasks they were given.
+        """
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            for worker in workers:
+                worker.task_queue.put(None)
+        for worker in workers:
+            worker.process.join()
+
+    def _spawn(self, worker):
+        task_queue, result_queue = self._context.Queue(), self._context.Queue()
+        process = self._context.Process(target=_worker_main,
+                                        args=(worker.index, worker.device, worker.cpu_ids, self.initializer,
+                                              self.concurrency, task_queue, result_queue),
+                                        name=f"ad-worker-{worker.index}",
+                                        daemon=True)
+        process.start()
+        worker.process, worker.task_queue, worker.ready = process, task_queue, False
+        threading.Thread(target=self._collect, args=(worker, process, result_queue),
+                         name=f"ad-worker-{worker.index}-collector", daemon=True).start()
+
+    def _collect(self, worker, process, result_queue):
+        # Each worker has its own result queue, so a crash mid-write cannot corrupt the messages of the others
+        while True:
+            self._relay_cancellations(worker)
+            try:
+                message = result_queue.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                self._handle_exit(worker, process)
+                return
+
+            kind = message[0]
+            if kind == "ready":
+                worker.ready = True
+                self._ready.set()
+                continue
+
+            with self._lock:
+                task = worker.tasks.get(message[1]) if kind in ("progress", "preview") \
+                    else worker.tasks.pop(message[1], None)
+            if task is None:
+                continue
+            if kind == "progress":
+                if task["step_callback"] is not None:
+                    task["step_callback"](*message[2:])
+            elif kind == "preview":
+                if task["preview_callback"] is not None:
+                    task["preview_callback"](*message[2:])
+            elif kind == "done":
+                task["future"].set_result(message[2:])
+            else:
+                task["future"].set_exception(message[2])
+
+    def _relay_cancellations(self, worker):
+        with self._lock:
+            for task_id, task in worker.tasks.items():
+                cancellation = task["cancellation"]
+                if not task["cancel_sent"] and cancellation is not None and cancellation.is_cancelled():
+                    worker.task_queue.put(("cancel", task_id, cancellation.reason))
+                    task["cancel_sent"] = True
+
+    def _handle_exit(self, worker, process):
+        with self._lock:
+            tasks, worker.tasks = worker.tasks, {}
+            closed = self._closed
+        for task in tasks.values():
+            task["future"].set_exception(WorkerCrashed(f"Worker {worker.index} exited with code "
+                                                       f"{process.exitcode} while running the task."))
+        if closed:
+            return
+
+        time.sleep(self.restart_delay_seconds)
+        with self._lock:
+            if not self._closed:
+                worker.restarts += 1
+                self._spawn(worker)
+
+
+def _worker_main(index, device, cpu_ids, initializer, concurrency, task_queue, result_queue):
+    """
+    The main loop of a worker process: takes tasks and cancellations from its task queue until it gets None.
+    """
+    if cpu_ids and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_ids)
+    if initializer is not None:
+        initializer(device=device, num_threads=len(cpu_ids))
+    result_queue.put(("ready",))
+
+    cancellations = {}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"ad-worker-{index}")
+    while True:
+        message = task_queue.get()
+        if message is None:
+            break
+        if message[0] == "cancel":
+            _, task_id, reason = message
+            if task_id in cancellations:
+                cancellations[task_id].cancel(reason)
+            continue
+
+        _, task_id, fn, descriptors, params, previews = message
+        cancellations[task_id] = CancellationToken()
+        if previews:
+            # Previews are a fraction of the size of the result, so they are pickled rather than shared
+            params = {**params, "preview_callback": functools.partial(_send_preview, result_queue, task_id)}
+        executor.submit(_run_task, task_id, fn, descriptors, params, cancellations, result_queue)
+    executor.shutdown(wait=True)
+
+
+def _send_preview(result_queue, task_id, step, total_steps, image):
+    result_queue.put(("preview", task_id, step, total_steps, image))
+
+
+def _run_task(task_id, fn, descriptors, params, cancellations, result_queue):
+    # Every task collects its stage timings in its own context, to be reported with the request in the API process
+    context = contextvars.Context()
+    timings = context.run(start_request)
+    try:
+        images = {name: load_shared_image(descriptor) for name, descriptor in descriptors.items()}
+        result = context.run(fn,
+                             images=images,
+                             step_callback=lambda step, total_steps: result_queue.put(("progress", task_id, step,
+                                                                                       total_steps)),
+                             cancellation=cancellations[task_id],
+                             **params)
+        block, descriptor = share_image(result) if isinstance(result, Image.Image) else share_entries(result)
+        block.close()
+        result_queue.put(("done", task_id, descriptor, dict(timings.stages), timings.peak_device_memory_bytes))
+    except Exception as exc:
+        result_queue.put(("error", task_id, _portable_error(exc)))
+    finally:
+        cancellations.pop(task_id, None)
+
+
+def _portable_error(exc):
+    """
+    Return the error itself if it survives pickling, or else a RuntimeError with its message.
+    """
+    try:
+        return pickle.loads(pickle.dumps(exc))
+    except Exception:
+        return RuntimeError(f"{type(exc).__name__}: {getattr(exc, 'detail', None) or exc}")
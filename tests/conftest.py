@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service modules import each other from the `app` directory, which they are run from
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
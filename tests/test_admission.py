@@ -0,0 +1,111 @@
+"""
+Admission control: bounded queues, priority classes and cancellation.
+"""
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, CancellationToken, Overloaded, PassThroughAdmission, RequestCancelled
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out."
+        time.sleep(0.01)
+
+
+def start_waiter(controller, priority, admitted, cancellation=None, errors=None):
+    """
+    Wait for a slot on a thread, recording the priority once admitted.
+    """
+    def wait():
+        try:
+            with controller.admit(priority, cancellation):
+                admitted.append(priority)
+        except Exception as exc:
+            if errors is None:
+                raise
+            errors.append(exc)
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    return thread
+
+
+def test_requests_are_admitted_up_to_the_concurrency_limit():
+    controller = AdmissionController(max_concurrent=2)
+
+    with controller.admit(), controller.admit("bulk"):
+        stats = controller.stats()
+
+    assert stats["running"] == 2
+    assert stats["admitted"] == {"interactive": 1, "bulk": 1}
+    assert controller.stats()["running"] == 0
+
+
+def test_full_queue_is_rejected_with_a_retry_estimate():
+    controller = AdmissionController(max_concurrent=1, max_queued={"interactive": 1})
+    admitted = []
+
+    with controller.admit():
+        waiter = start_waiter(controller, "interactive", admitted)
+        wait_until(lambda: controller.stats()["queued"]["interactive"] == 1)
+
+        with pytest.raises(Overloaded) as excinfo:
+            with controller.admit():
+                pass
+
+    waiter.join(timeout=5)
+    assert excinfo.value.retry_after >= 1
+    assert controller.stats()["rejected"]["interactive"] == 1
+    assert admitted == ["interactive"]
+
+
+def test_interactive_requests_are_admitted_before_bulk_ones():
+    controller = AdmissionController(max_concurrent=1)
+    admitted = []
+
+    with controller.admit():
+        bulk = start_waiter(controller, "bulk", admitted)
+        wait_until(lambda: controller.stats()["queued"]["bulk"] == 1)
+        interactive = start_waiter(controller, "interactive", admitted)
+        wait_until(lambda: controller.stats()["queued"]["interactive"] == 1)
+
+    bulk.join(timeout=5)
+    interactive.join(timeout=5)
+    assert admitted == ["interactive", "bulk"]
+
+
+def test_waiting_request_leaves_the_queue_once_its_deadline_passes():
+    controller = AdmissionController(max_concurrent=1, poll_seconds=0.01)
+    admitted, errors = [], []
+
+    with controller.admit():
+        waiter = start_waiter(controller, "interactive", admitted, CancellationToken(deadline_seconds=0.05), errors)
+        waiter.join(timeout=5)
+
+    assert admitted == []
+    assert isinstance(errors[0], RequestCancelled)
+    assert errors[0].reason == "deadline"
+    assert controller.stats()["queued"]["interactive"] == 0
+
+
+def test_unknown_priority_is_refused():
+    with pytest.raises(ValueError):
+        with AdmissionController().admit("urgent"):
+            pass
+
+
+def test_pass_through_admission_only_checks_cancellation():
+    admission = PassThroughAdmission()
+    cancellation = CancellationToken()
+
+    with admission.admit("bulk", cancellation):
+        pass
+
+    cancellation.cancel()
+    with pytest.raises(RequestCancelled):
+        with admission.admit("bulk", cancellation):
+            pass
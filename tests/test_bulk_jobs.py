@@ -0,0 +1,108 @@
+"""
+Bulk jobs: running entries of concurrent jobs and resuming interrupted jobs.
+"""
+import io
+import json
+import threading
+import time
+
+from bulk_jobs import BulkJob, BulkJobRunner
+
+
+class Resolver:
+    """
+    Resolves every image reference to the reference itself, as bytes.
+    """
+
+    def __call__(self, reference):
+        return io.BytesIO(reference.encode("utf-8"))
+
+
+def make_manifest(*names):
+    return io.BytesIO("".join(json.dumps({"name": name, "base_image": name, "logo_image": "logo"}) + "\n"
+                              for name in names).encode("utf-8"))
+
+
+def make_runner(jobs_dir, run_spec, max_in_flight=4):
+    return BulkJobRunner(prepare_spec=lambda spec: {"seed": 0},
+                         run_spec=run_spec,
+                         resolve_image=Resolver(),
+                         jobs_dir=str(jobs_dir),
+                         max_in_flight=max_in_flight)
+
+
+def run_spec(base_image_file, logo_image_file, **params):
+    return base_image_file.read(), "image/png"
+
+
+def test_job_finishes_while_another_job_is_in_flight(tmp_path):
+    release = threading.Event()
+
+    def blocking_run_spec(base_image_file, logo_image_file, **params):
+        content = base_image_file.read()
+        if content == b"slow":
+            release.wait(timeout=10)
+        return content, "image/png"
+
+    runner = make_runner(tmp_path, blocking_run_spec)
+    slow_job = BulkJob.create(str(tmp_path), make_manifest("slow"))
+    fast_job = BulkJob.create(str(tmp_path), make_manifest("a", "b"))
+    slow_thread = threading.Thread(target=runner.run, args=(slow_job,))
+    slow_thread.start()
+    try:
+        # Runs on this thread; it must not wait for the entry of the other job
+        runner.run(fast_job)
+
+        assert fast_job.status == "succeeded"
+        assert fast_job.succeeded == 2
+        assert not slow_job.finished
+    finally:
+        release.set()
+        slow_thread.join()
+    assert slow_job.status == "succeeded"
+
+
+def interrupt_after_first_entry(tmp_path):
+    """
+    Create a job that was cut off by a crash while appending the record of its second entry.
+    """
+    job = BulkJob.create(str(tmp_path), make_manifest("a", "b", "c"))
+    job.set_status("running")
+    job.write_result(0, "a", b"a", "image/png")
+    with open(job.results_path, "a") as file:
+        file.write('{"index": 1, "name": "b", "sta')
+    return job.job_id
+
+
+def test_interrupted_job_drops_the_truncated_record_on_load(tmp_path):
+    job_id = interrupt_after_first_entry(tmp_path)
+
+    job = BulkJob.load(str(tmp_path), job_id)
+
+    assert job.status == "interrupted"
+    assert (job.succeeded, job.failed) == (1, 0)
+    assert job.is_recorded(0) and not job.is_recorded(1)
+    with open(job.results_path) as file:
+        assert file.read().endswith("\n")
+
+
+def test_resumed_job_only_runs_the_remaining_entries(tmp_path):
+    job_id = interrupt_after_first_entry(tmp_path)
+    rendered = []
+
+    def recording_run_spec(base_image_file, logo_image_file, **params):
+        rendered.append(base_image_file.read())
+        return rendered[-1], "image/png"
+
+    runner = make_runner(tmp_path, recording_run_spec)
+    job = runner.resume(job_id)
+    deadline = time.monotonic() + 10
+    while not job.finished:
+        assert time.monotonic() < deadline, "Timed out."
+        time.sleep(0.01)
+
+    assert job.status == "succeeded"
+    assert sorted(rendered) == [b"b", b"c"]
+    assert (job.succeeded, job.failed) == (3, 0)
+    assert sorted(record["index"] for record in job.iter_results(follow=False)) == [0, 1, 2]
+    assert runner.resume(job_id).status == "succeeded"
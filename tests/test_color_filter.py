@@ -0,0 +1,49 @@
+"""
+Parity of `extract_features_and_change_their_color` with the original NumPy implementation.
+"""
+import numpy as np
+import pytest
+
+from benchmarks.color_filter import reference_extract_features_and_change_their_color
+from benchmarks.common import make_test_image
+from stable_diffusion.helpers import extract_features_and_change_their_color
+
+# The original implementation dilates until the mask stops growing for a radius of 0, so only positive radii
+# are compared with it
+FILTERS = [{"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5},
+           {"target_color": (0, 138, 237), "smooth_factor": 0.3, "dilation_radius": 2},
+           {"target_color": (255, 255, 255), "smooth_factor": 0.77, "dilation_radius": 1}]
+
+
+@pytest.mark.parametrize("kwargs", FILTERS)
+@pytest.mark.parametrize("size", [(64, 48), (97, 131)])
+def test_matches_reference(size, kwargs):
+    image = make_test_image(*size, seed=sum(size))
+
+    expected = np.asarray(reference_extract_features_and_change_their_color(image, **kwargs))
+    actual = np.asarray(extract_features_and_change_their_color(image, **kwargs))
+
+    assert actual.shape == expected.shape
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("fill", [(255, 255, 255), (12, 34, 56)])
+def test_matches_reference_on_uniform_images(fill):
+    image = make_test_image(32, 32).point(lambda _: 0)
+    image.paste(fill, (0, 0, 32, 32))
+
+    expected = np.asarray(reference_extract_features_and_change_their_color(image, **FILTERS[0]))
+    actual = np.asarray(extract_features_and_change_their_color(image, **FILTERS[0]))
+
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "L"])
+def test_other_modes_give_the_rgb_result(mode):
+    image = make_test_image(64, 48).convert(mode)
+
+    result = extract_features_and_change_their_color(image, **FILTERS[0])
+
+    assert result.mode == "RGB"
+    assert np.array_equal(np.asarray(result),
+                          np.asarray(extract_features_and_change_their_color(image.convert("RGB"), **FILTERS[0])))
@@ -0,0 +1,83 @@
+"""
+Background jobs: bounded queue, results and masked errors.
+"""
+import threading
+import time
+
+import pytest
+
+from job_manager import JobManager, JobQueueFull
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out."
+        time.sleep(0.01)
+
+
+def blocked(release, step_callback):
+    release.wait(timeout=5)
+
+
+@pytest.fixture
+def job_manager():
+    manager = JobManager(max_workers=1, max_queued=2)
+    yield manager
+    manager.shutdown()
+
+
+def test_job_reports_progress_and_result(job_manager):
+    def run(value, step_callback):
+        step_callback(2, 4)
+        return value * 2
+
+    job = job_manager.submit(run, 21)
+    wait_until(lambda: job.status == "succeeded")
+
+    assert job.result == 42
+    assert job.to_dict()["progress"] == 1.0
+    assert job_manager.get(job.job_id) is job
+
+
+def test_full_queue_is_rejected_until_jobs_finish(job_manager):
+    release = threading.Event()
+    jobs = [job_manager.submit(blocked, release) for _ in range(2)]
+
+    with pytest.raises(JobQueueFull) as excinfo:
+        job_manager.submit(blocked, release)
+    assert excinfo.value.retry_after >= 1
+
+    release.set()
+    wait_until(lambda: job_manager.queue_depth() == 0)
+    assert all(job.status == "succeeded" for job in jobs)
+    job_manager.submit(blocked, release)
+
+
+def test_failed_job_reports_the_described_error():
+    def fail(step_callback):
+        raise RuntimeError("CUDA error: device-side assert at 0x7f3a")
+
+    manager = JobManager(describe_error=lambda exc: (503, "The model is unavailable."))
+    try:
+        job = manager.submit(fail)
+        wait_until(lambda: job.status == "failed")
+    finally:
+        manager.shutdown()
+
+    assert job.to_dict()["error_status"] == 503
+    assert job.error == "The model is unavailable."
+
+
+def test_failed_job_without_describe_error_reports_the_exception():
+    def fail(step_callback):
+        raise ValueError()
+
+    manager = JobManager()
+    try:
+        job = manager.submit(fail)
+        wait_until(lambda: job.status == "failed")
+    finally:
+        manager.shutdown()
+
+    assert (job.error_status, job.error) == (500, "ValueError")
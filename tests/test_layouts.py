@@ -0,0 +1,66 @@
+"""
+Declarative layouts: compilation, validation and lookups.
+"""
+import copy
+
+import pytest
+
+from dynamic_template.layouts import (COMPILED_LAYOUTS, LAYOUT_SPECS, CompiledLayout, get_diffusion_target,
+                                      get_layout, get_logo_target, register_layouts)
+
+
+def test_built_in_layouts_compile():
+    classic = get_layout("classic")
+
+    assert set(LAYOUT_SPECS) <= set(COMPILED_LAYOUTS)
+    assert classic.canvas_size == (720, 720)
+    assert classic.image_size == (360, 360)
+    assert classic.image_mask.size == classic.image_size
+    assert (classic.text_top, classic.text_max_bottom) == (528, 612)
+    assert (classic.font_size, classic.min_font_size) == (20, 8)
+
+
+@pytest.mark.parametrize("slot_name, key, value", [("image_slot", "x", 400),
+                                                   ("logo_slot", "width", 0),
+                                                   ("text_box", "max_bottom", 800)])
+def test_slot_outside_the_canvas_is_rejected(slot_name, key, value):
+    spec = copy.deepcopy(LAYOUT_SPECS["classic"])
+    spec[slot_name][key] = value
+
+    with pytest.raises(ValueError, match=slot_name):
+        CompiledLayout("broken", spec)
+
+
+def test_scaled_layouts_are_compiled_once_and_fit():
+    classic = get_layout("classic")
+    preview = classic.scaled(0.25)
+
+    assert classic.scaled(1) is classic
+    assert classic.scaled(0.25) is preview
+    assert preview.canvas_size == (180, 180)
+    assert preview.image_size == (90, 90)
+
+
+def test_diffusion_target_covers_every_layout():
+    assert get_diffusion_target(["classic"]) == ((360, 360), None)
+    assert get_diffusion_target(["square", "landscape"]) == ((640, 640), 768)
+    assert get_diffusion_target(["classic", "story"]) == ((960, 960), None)
+    assert get_logo_target(["classic", "square"]) == (128, 128)
+
+
+def test_unknown_layout_raises_key_error():
+    with pytest.raises(KeyError):
+        get_layout("billboard")
+
+
+def test_registered_layouts_are_available_by_name():
+    spec = copy.deepcopy(LAYOUT_SPECS["square"])
+    spec["diffusion_max_side"] = 512
+    try:
+        register_layouts({"banner": spec})
+        assert get_diffusion_target(["banner", "square"]) == ((640, 640), 768)
+        with pytest.raises(ValueError):
+            register_layouts({"broken": {**spec, "canvas": {"width": 100, "height": 100}}})
+        assert "broken" not in COMPILED_LAYOUTS
+    finally:
+        COMPILED_LAYOUTS.pop("banner", None)
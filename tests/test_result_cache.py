@@ -0,0 +1,118 @@
+"""
+The result cache: content-addressed keys, single-flight computation and the best-effort disk tier.
+"""
+import os
+import threading
+import time
+
+import pytest
+
+import result_cache
+from result_cache import ResultCache, make_cache_key
+
+
+def test_cache_key_ignores_the_order_of_parameters():
+    assert make_cache_key(b"image", seed=1, steps=25) == make_cache_key(b"image", steps=25, seed=1)
+
+
+def test_cache_key_tells_blob_splits_apart():
+    assert make_cache_key(b"ab", b"c") != make_cache_key(b"a", b"bc")
+
+
+def test_miss_computes_and_hit_is_served_from_memory():
+    cache = ResultCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return b"result"
+
+    assert cache.get_or_compute("key", compute) == b"result"
+    assert cache.get_or_compute("key", compute) == b"result"
+    assert len(calls) == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+def run_concurrently(cache, compute, callers, **kwargs):
+    """
+    Call get_or_compute from several threads while the first computation is held up, returning their results.
+    """
+    results = [None] * callers
+
+    def call(index):
+        results[index] = cache.get_or_compute("key", compute, **kwargs)
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+def make_slow_compute():
+    """
+    Build a computation slow enough for concurrent callers to find it in flight, along with its call log.
+    """
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return b"result-%d" % len(calls)
+
+    return compute, calls
+
+
+def test_concurrent_misses_share_a_single_computation():
+    cache = ResultCache()
+    compute, calls = make_slow_compute()
+
+    results = run_concurrently(cache, compute, 4)
+
+    assert results == [b"result-1"] * 4
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 3
+
+
+def test_uncached_computations_are_shared_but_not_stored():
+    cache = ResultCache()
+    compute, calls = make_slow_compute()
+
+    assert run_concurrently(cache, compute, 3, cached=False) == [b"result-1"] * 3
+    assert cache.get("key") is None
+    # A later request for the same key starts a new computation
+    assert cache.get_or_compute("key", compute, cached=False) == b"result-2"
+    assert len(calls) == 2
+
+
+def test_failed_computation_reaches_every_caller_and_is_not_cached():
+    cache = ResultCache()
+
+    def compute():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute("key", compute)
+    assert cache.get_or_compute("key", lambda: b"result") == b"result"
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    ResultCache(disk_dir=str(tmp_path)).get_or_compute("key", lambda: b"result")
+
+    cache = ResultCache(disk_dir=str(tmp_path))
+
+    assert cache.get("key") == b"result"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_failed_disk_write_keeps_the_result(tmp_path, monkeypatch):
+    def replace(source, destination):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(result_cache.os, "replace", replace)
+    cache = ResultCache(disk_dir=str(tmp_path))
+
+    assert cache.get_or_compute("key", lambda: b"result") == b"result"
+    assert cache.get("key") == b"result"
+    assert os.listdir(tmp_path) == []
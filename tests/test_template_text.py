@@ -0,0 +1,50 @@
+"""
+Fitting of the punchline text in `write_multiline_text`.
+"""
+import pytest
+from PIL import Image, ImageDraw
+
+from dynamic_template.helpers import get_font, write_multiline_text
+
+# The text box of the classic layout: the text area width and top, the line margin and the lowest y
+TEXT_WIDTH, TEXT_TOP, MARGIN, MAX_BOTTOM = 720, 528, 15, 612
+
+
+@pytest.fixture(scope="module")
+def font():
+    try:
+        return get_font("DejaVuSans.ttf", 20)
+    except OSError:
+        pytest.skip("The DejaVu Sans font is not installed.")
+
+
+def write(text, font, min_font_size=8):
+    canvas = Image.new("RGB", (TEXT_WIDTH, 720), "white")
+    return write_multiline_text(ImageDraw.Draw(canvas), text, (TEXT_WIDTH, TEXT_TOP), font, "#000000", MARGIN,
+                                MAX_BOTTOM, min_font_size=min_font_size)
+
+
+def make_text(words):
+    return " ".join(f"word{index}" for index in range(words))
+
+
+@pytest.mark.parametrize("words", [3, 20, 40])
+def test_text_ends_above_the_maximum_height(font, words):
+    bottom, _ = write(make_text(words), font)
+
+    assert bottom <= MAX_BOTTOM
+
+
+def test_multiline_text_is_shrunk_to_the_largest_fitting_size(font):
+    text = make_text(20)
+
+    bottom, font_size = write(text, font)
+    # The next size up, which the text is not shrunk below
+    larger_bottom, _ = write(text, font, min_font_size=font_size + 1)
+
+    assert font_size < font.size
+    assert bottom <= MAX_BOTTOM < larger_bottom
+
+
+def test_short_text_keeps_the_font_size(font):
+    assert write("Buy now", font)[1] == font.size
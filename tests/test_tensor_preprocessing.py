@@ -0,0 +1,50 @@
+"""
+Parity of the tensor color filter with `extract_features_and_change_their_color`.
+"""
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from benchmarks.common import make_test_image
+from stable_diffusion.helpers import extract_features_and_change_their_color
+from stable_diffusion.tensor_preprocessing import change_feature_colors, image_to_tensor, pixels_to_rgb
+
+# Filter arguments covering the edge cases: no dilation, odd factors and the defaults of the service
+FILTERS = [{"target_color": (179, 106, 11), "smooth_factor": 0.5, "dilation_radius": 5},
+           {"target_color": (0, 138, 237), "smooth_factor": 0.3, "dilation_radius": 2},
+           {"target_color": (255, 255, 255), "smooth_factor": 0.77, "dilation_radius": 0}]
+
+
+def filter_tensor(images, filters):
+    """
+    Color filter PIL images with the tensor implementation as a single batch, returning (batch, height, width, 3)
+    pixels.
+    """
+    pixels = pixels_to_rgb(torch.stack([image_to_tensor(image) for image in images]))
+    changed = change_feature_colors(pixels,
+                                    target_colors=[item["target_color"] for item in filters],
+                                    smooth_factors=[item["smooth_factor"] for item in filters],
+                                    dilation_radii=[item["dilation_radius"] for item in filters])
+    return changed.permute(0, 2, 3, 1).numpy()
+
+
+def make_images(mode):
+    return [make_test_image(67, 45, seed=seed).convert(mode) for seed in range(len(FILTERS))]
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_matches_pil_one_by_one(mode):
+    for image, kwargs in zip(make_images(mode), FILTERS):
+        expected = np.asarray(extract_features_and_change_their_color(image, **kwargs))
+
+        assert np.array_equal(filter_tensor([image], [kwargs])[0], expected)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_matches_pil_batched(mode):
+    images = make_images(mode)
+    expected = np.stack([np.asarray(extract_features_and_change_their_color(image, **kwargs))
+                         for image, kwargs in zip(images, FILTERS)])
+
+    assert np.array_equal(filter_tensor(images, FILTERS), expected)